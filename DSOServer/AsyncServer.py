@@ -0,0 +1,308 @@
+"""asyncio-based alternative to the selectors loop in Server.run"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from signal import SIGINT
+from sys import stdin
+
+from .Compression import CompressionPolicy
+from .Database import DatabaseThread
+from .Metrics import Metrics, http_response
+from .Multicast import Multicast
+from .Server import CapturingConnection, Connection, console, send_positions
+from .State import State
+
+logger = getLogger(__name__)
+
+
+class TransportSocket:
+    """
+    Gives an asyncio transport the small part of the socket interface Connection writes through.
+
+    The transport does its own buffering, so every write is taken whole; instead, the high-water
+    mark is checked against the transport's buffer.
+    """
+
+    __slots__ = "transport", "high_water"
+
+    def __init__(self, transport, high_water):
+        self.transport = transport
+        self.high_water = high_water
+
+    def sendmsg(self, buffers):
+        if self.transport.is_closing():
+            raise ConnectionError("transport is closed")
+        if self.transport.get_write_buffer_size() > self.high_water:
+            raise ConnectionError("transport write buffer over high-water mark")
+
+        self.transport.writelines(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+    def close(self):
+        self.transport.close()
+
+    def fileno(self):
+        return self.transport.get_extra_info("socket").fileno()
+
+    def __repr__(self):
+        return f"TransportSocket({self.transport.get_extra_info('peername')})"
+
+
+class DSOProtocol(asyncio.BufferedProtocol):
+    """One client connection: asyncio reads straight into the Connection's receive buffer"""
+
+    __slots__ = "server", "connection"
+
+    def __init__(self, server):
+        self.server = server
+        self.connection = None
+
+    def connection_made(self, transport):
+        logger.info(f"Received new incoming connection from {transport.get_extra_info('peername')}")
+        socket = TransportSocket(transport, self.server.high_water)
+        if self.server.capture:
+            self.connection = CapturingConnection(
+                self.server.capture,
+                socket,
+                self.server.policy,
+                self.server.pending,
+                self.server.high_water,
+                self.server.metrics,
+                self.server.multicast,
+            )
+        else:
+            self.connection = Connection(
+                socket,
+                self.server.policy,
+                self.server.pending,
+                self.server.high_water,
+                self.server.metrics,
+                self.server.multicast,
+            )
+        self.server.protocols.add(self)
+
+    def get_buffer(self, sizehint):
+        return self.connection.free_space()
+
+    def buffer_updated(self, nbytes):
+        self.connection.end += nbytes
+        self.server.metrics.wire_in += nbytes
+        if not self.connection.process(self.server.state):
+            self.drop()
+        elif self.connection.waiting:
+            self.wait()
+        self.server.flush()
+
+    def wait(self):
+        # stop reading until the database request the Connection waits on is done
+        self.connection.socket.transport.pause_reading()
+        loop = asyncio.get_running_loop()
+        self.connection.waiting[0].add_done_callback(
+            lambda future: loop.call_soon_threadsafe(self.resume)
+        )
+
+    def resume(self):
+        if not self.connection:
+            # dropped while waiting
+            return
+        if not self.connection.resume(self.server.state):
+            self.drop()
+        elif self.connection.waiting:
+            self.wait()
+        else:
+            self.connection.socket.transport.resume_reading()
+        self.server.flush()
+
+    def connection_lost(self, exc):
+        self.drop()
+        self.server.flush()
+
+    def drop(self):
+        self.server.protocols.discard(self)
+        if self.connection:
+            logger.info(f"Dropping connection {self.connection.socket}")
+            connection, self.connection = self.connection, None
+            connection.close(self.server.state)
+
+
+class AsyncServer:
+    """
+    Runs the same Connection handlers as Server, on an asyncio event loop.
+
+    The database runs on a DatabaseThread, as with Server.  Loading and saving the whole world
+    waits on it, so that is done through run_in_executor to keep the loop free.
+    The State's timer wheel is run from a single loop timer, kept set for its next deadline.
+    """
+
+    __slots__ = (
+        "address_port",
+        "database",
+        "db_thread",
+        "high_water",
+        "capture",
+        "metrics_port",
+        "journal",
+        "state",
+        "policy",
+        "metrics",
+        "multicast",
+        "pending",
+        "protocols",
+        "executor",
+        "ticking",
+        "wakeup",
+        "stopping",
+    )
+
+    # seconds between sending batches of position updates
+    tick_interval = 0.1
+
+    def __init__(
+        self,
+        address_port,
+        database,
+        high_water=0x100000,
+        capture=None,
+        metrics_port=None,
+        journal=None,
+    ):
+        self.address_port = address_port
+        self.database = database
+        self.db_thread = None
+        self.high_water = high_water
+        self.capture = capture
+        self.metrics_port = metrics_port
+        self.journal = journal
+
+        self.state = None
+        self.policy = CompressionPolicy()
+        self.metrics = Metrics()
+        self.multicast = Multicast(self.policy, self.metrics)
+        self.pending = set()
+        # every connected client
+        self.protocols = set()
+        # for waiting on the database thread without blocking the loop
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="database")
+        # whether a batch of position updates is scheduled
+        self.ticking = False
+        # loop timer for the next timer wheel deadline, if any
+        self.wakeup = None
+        self.stopping = None
+
+    def run(self):
+        """Runs the server."""
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Received Ctrl+C, shutting down")
+        finally:
+            self.executor.shutdown()
+
+    def flush(self):
+        """Hand everything queued to the transports"""
+        loop = asyncio.get_running_loop()
+        if self.state.interest.dirty and not self.ticking:
+            self.ticking = True
+            loop.call_later(self.tick_interval, self.tick)
+
+        # the wheel uses the same monotonic clock as the loop
+        timeout = self.state.timers.timeout()
+        if timeout is not None:
+            deadline = loop.time() + timeout
+            if not self.wakeup or deadline < self.wakeup.when():
+                if self.wakeup:
+                    self.wakeup.cancel()
+                self.wakeup = loop.call_at(deadline, self.on_timers)
+
+        # the writes handled are journaled before anyone hears back about them
+        if self.state.journal:
+            self.state.journal.commit()
+        for c in tuple(self.pending):
+            if not c.flush():
+                c.socket.close()
+        self.pending.clear()
+
+    def tick(self):
+        self.ticking = False
+        for c in send_positions(self.state):
+            c.socket.close()
+        self.flush()
+
+    def on_timers(self):
+        self.wakeup = None
+        self.state.timers.run()
+        self.flush()
+
+    def on_console(self, loop):
+        line = stdin.readline()
+        if not line:
+            # stdin closed, nobody left to type commands
+            loop.remove_reader(stdin)
+        elif not console(line, self):
+            self.stopping.set()
+
+    def connection_count(self):
+        return len(self.protocols)
+
+    async def on_metrics_request(self, reader, writer):
+        # every path gets the same answer, so the request itself doesn't matter
+        try:
+            await reader.readline()
+            writer.write(http_response(self.metrics.prometheus(self.state, self.connection_count())))
+            await writer.drain()
+        except OSError:
+            pass
+        writer.close()
+
+    def on_interrupt(self):
+        print("Received Ctrl+C, shutting down")
+        self.stopping.set()
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+
+        # Create world-state off the loop: it reads every region from the database
+        self.db_thread = DatabaseThread(self.database)
+        self.state = await loop.run_in_executor(self.executor, State, self.db_thread, self.journal)
+
+        logger.info(f"Opening listen socket on {self.address_port}")
+        server = await loop.create_server(
+            lambda: DSOProtocol(self), self.address_port[0] or None, self.address_port[1]
+        )
+
+        if self.metrics_port:
+            logger.info(f"Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+            metrics_server = await asyncio.start_server(
+                self.on_metrics_request, "127.0.0.1", self.metrics_port
+            )
+
+        try:
+            loop.add_reader(stdin, self.on_console, loop)
+            loop.add_signal_handler(SIGINT, self.on_interrupt)
+        except (NotImplementedError, ValueError, OSError):
+            # console input and signals aren't supported by every event loop (e.g. Windows proactor)
+            pass
+
+        logger.info("Awaiting incoming connections")
+        async with server:
+            await self.stopping.wait()
+
+            # great, done running, shut everything down
+            server.close()
+            for protocol in tuple(self.protocols):
+                protocol.drop()
+            self.flush()
+
+        if self.metrics_port:
+            metrics_server.close()
+
+        try:
+            loop.remove_reader(stdin)
+            loop.remove_signal_handler(SIGINT)
+        except (NotImplementedError, ValueError, OSError):
+            pass
+
+        await loop.run_in_executor(self.executor, self.state.close)
+        self.db_thread.close()
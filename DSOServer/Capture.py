@@ -0,0 +1,99 @@
+"""Binary packet capture files, for replaying real sessions later"""
+
+import os
+import struct
+from logging import getLogger
+from time import time
+
+logger = getLogger(__name__)
+
+# every capture file starts with this
+MAGIC = b"DSOcap\x00\x01"
+
+# record directions
+IN = 0
+OUT = 1
+# the connection was closed: no data
+CLOSED = 2
+
+# record header: timestamp, connection id, direction, raw frame length, decoded length
+#  the raw frame (header included) is only kept for compressed packets, otherwise it's 0-length
+record = struct.Struct("<dIBII")
+
+
+class Capture:
+    """
+    Appends packets to a capture file, starting a new one once it grows past max_bytes.
+
+    Old files are renamed like log files: path.1 is the most recent, up to path.<backups>.
+    A capture always starts in a new file, so connection ids are unique within a run of files.
+    """
+
+    __slots__ = "path", "max_bytes", "backups", "file", "size", "next_id"
+
+    def __init__(self, path, max_bytes=64 << 20, backups=9):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.next_id = 0
+        self.file = None
+        self.size = 0
+
+        if os.path.exists(path) and os.path.getsize(path):
+            self.rotate()
+        self.open()
+
+    def open(self):
+        logger.info(f"Capturing packets to {self.path}")
+        self.file = open(self.path, "wb")
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+
+    def rotate(self):
+        if self.file:
+            self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+
+    def new_id(self):
+        """Return an id for a new connection"""
+        self.next_id += 1
+        return self.next_id
+
+    def write(self, id, direction, data=b"", raw=b""):
+        size = record.size + len(raw) + len(data)
+        if self.size + size > self.max_bytes:
+            self.rotate()
+            self.open()
+
+        self.file.write(record.pack(time(), id, direction, len(raw), len(data)))
+        if raw:
+            self.file.write(raw)
+        self.file.write(data)
+        self.size += size
+
+    def close(self):
+        self.file.close()
+
+
+def read(path):
+    """Yield (timestamp, connection id, direction, data, raw) for every record in a capture file"""
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a packet capture")
+
+        while header := file.read(record.size):
+            if len(header) < record.size:
+                # the server was cut off mid-write
+                logger.warning(f"{path} ends with a partial record")
+                return
+            timestamp, id, direction, raw_length, length = record.unpack(header)
+            raw = file.read(raw_length)
+            data = file.read(length)
+            if len(data) < length:
+                logger.warning(f"{path} ends with a partial record")
+                return
+            yield timestamp, id, direction, data, raw
@@ -0,0 +1,458 @@
+"""
+Multi-process server: worker processes share the listen port, and GLRG regions are sharded across them
+
+One broker process (the one started from the command line) owns GLOB memory, login tokens and the
+directory of which worker each player is connected to.  It also routes requests between workers.
+Each worker runs an ordinary Server with a ClusterState, which holds the GLRG memory of the regions
+it owns (region % workers == index) and asks the broker for everything else.
+
+When a player moves into a region owned by another worker, their client socket is handed over to that
+worker (over the broker's Unix socket), so from then on their region's memory is local again.
+Until the handover can happen, reads and writes of other workers' regions are proxied through the broker.
+"""
+
+import logging
+import os
+import selectors
+import socket
+from multiprocessing import get_context
+from multiprocessing.connection import Client, Listener, wait
+from multiprocessing.reduction import recv_handle, send_handle
+from sys import stdin
+from tempfile import TemporaryDirectory
+
+from .Database import Sqlite3
+from .Server import Server
+from .State import State
+
+logger = logging.getLogger(__name__)
+
+
+class ClusterState(State):
+    """World-state for one worker: local GLRG shard and players, everything else through the broker"""
+
+    __slots__ = "channel", "index", "count", "seq", "inbox", "migrations"
+
+    def __init__(self, database, channel, index, count):
+        self.channel = channel
+        self.index = index
+        self.count = count
+
+        super().__init__(database)
+        # GLOB memory lives in the broker
+        self.glob = {}
+
+        # sequence number of the last call made to the broker
+        self.seq = 0
+        # broker messages received while waiting on a reply, for the server loop to take care of
+        self.inbox = []
+        # players that moved to a region owned by another worker: player id => worker index
+        self.migrations = {}
+
+    def owns_region(self, region):
+        return region % self.count == self.index
+
+    # #########################################################################
+    def call(self, method, *args):
+        """Make a request of the broker and wait for the result"""
+        self.seq += 1
+        seq = self.seq
+        self.channel.send(("call", seq, method, args))
+
+        while True:
+            message = self.receive()
+            if message is None:
+                continue
+            if message[0] == "reply" and message[1] == seq:
+                return message[2]
+            # anything else can wait for the server loop
+            self.inbox.append(message)
+
+    def notify(self, method, *args):
+        """Tell the broker something, without waiting for a reply"""
+        self.channel.send(("notify", method, args))
+
+    def receive(self):
+        """Read one message from the broker.  Forwarded calls are answered right away, and give None"""
+        message = self.channel.recv()
+        if message[0] == "call":
+            # another worker wants our region or player memory
+            _, seq, method, args = message
+            self.channel.send(("reply", seq, getattr(self, "local_" + method)(*args)))
+            return None
+        if message[0] == "adopt":
+            # the client socket follows its message
+            return message + (recv_handle(self.channel),)
+        return message
+
+    # #########################################################################
+    def issue_token(self, id):
+        # the client may come back on any worker, so tokens are kept in the broker
+        return self.call("issue_token", id)
+
+    def return_login_token(self, token):
+        return self.call("return_login_token", token)
+
+    def add_player(self, id, data=None):
+        # players are only loaded here if the broker agrees nobody else has them
+        if not self.call("claim_player", id, self.index):
+            return None
+        return super().add_player(id, data)
+
+    def drop_player(self, id):
+        super().drop_player(id)
+        self.migrations.pop(id, None)
+        # another worker may load them next, so they must be in the database first
+        self.save_now()
+        self.notify("release_player", id)
+
+    def save_now(self):
+        """Checkpoint, and wait until every player who left is in the database"""
+        self.checkpoint()
+        for _, saving in self.retired.values():
+            if saving:
+                saving.result()
+
+    def player_count(self):
+        return self.call("player_count")
+
+    def player_moved(self, player, old_region):
+        super().player_moved(player, old_region)
+        region = player.slots["region"]
+        self.notify("set_region", player.id, region)
+        if self.owns_region(region):
+            self.migrations.pop(player.id, None)
+        else:
+            self.migrations[player.id] = region % self.count
+
+    def ids_in_region(self, region):
+        return self.call("ids_in_region", region)
+
+    def packed_ids_in_region(self, region):
+        return self.call("packed_ids_in_region", region)
+
+    # #########################################################################
+    def read_glob(self, data_type, addr, length):
+        return self.call("read_glob", data_type, addr, length)
+
+    def write_glob(self, data_type, addr, data):
+        return self.call("write_glob", data_type, addr, bytes(data))
+
+    def read_glrg(self, region, data_type, addr, length):
+        if self.owns_region(region):
+            return super().read_glrg(region, data_type, addr, length)
+        return self.call("read_glrg", region, data_type, addr, length)
+
+    def glob_version(self, data_type):
+        # written by every worker, so only the broker knows
+        return None
+
+    def glrg_version(self, region, data_type):
+        if self.owns_region(region):
+            return super().glrg_version(region, data_type)
+        return None
+
+    def write_glrg(self, region, data_type, addr, data):
+        if self.owns_region(region):
+            return super().write_glrg(region, data_type, addr, data)
+        return self.call("write_glrg", region, data_type, addr, bytes(data))
+
+    def read_player(self, id, data_type, addr, length):
+        if id in self.players:
+            return super().read_player(id, data_type, addr, length)
+        return self.call("read_player", id, data_type, addr, length)
+
+    def write_player(self, id, data_type, addr, data):
+        if id in self.players:
+            return super().write_player(id, data_type, addr, data)
+        return self.call("write_player", id, data_type, addr, bytes(data))
+
+    # calls forwarded from other workers by the broker
+    def local_read_glrg(self, region, data_type, addr, length):
+        return bytes(super().read_glrg(region, data_type, addr, length))
+
+    def local_write_glrg(self, region, data_type, addr, data):
+        return super().write_glrg(region, data_type, addr, data)
+
+    def local_read_player(self, id, data_type, addr, length):
+        try:
+            return bytes(super().read_player(id, data_type, addr, length))
+        except KeyError:
+            # they left while the request was on its way
+            return bytes(length)
+
+    def local_write_player(self, id, data_type, addr, data):
+        try:
+            return super().write_player(id, data_type, addr, data)
+        except KeyError:
+            pass
+
+
+class Worker(Server):
+    """A Server process in the cluster: shares the listen port, and trades clients with the other workers"""
+
+    __slots__ = "channel", "index", "count"
+
+    def __init__(self, address_port, database, channel, index, count, high_water=0x100000):
+        super().__init__(address_port, database, high_water, console=False, reuse_port=True)
+        self.channel = channel
+        self.index = index
+        self.count = count
+
+    def make_state(self):
+        state = ClusterState(self.db_thread, self.channel, self.index, self.count)
+        self.sel.register(self.channel, selectors.EVENT_READ, self.on_broker)
+        return state
+
+    def on_broker(self, mask):
+        try:
+            while self.channel.poll():
+                message = self.state.receive()
+                if message:
+                    self.state.inbox.append(message)
+        except EOFError:
+            # broker is gone, nothing to do but shut down
+            self.running = False
+            self.sel.unregister(self.channel)
+
+    def flush(self):
+        super().flush()
+
+        # messages from the broker
+        while self.state.inbox:
+            message = self.state.inbox.pop(0)
+            if message[0] == "adopt":
+                _, (id, slots), fd = message
+                self.adopt(id, slots, socket.socket(fileno=fd))
+            elif message[0] == "stop":
+                self.running = False
+
+        # hand off any players (that are between packets, with nothing left to send) to the worker owning their new region
+        if self.state.migrations:
+            for c in tuple(self.connections.values()):
+                if (
+                    c.player
+                    and c.player.id in self.state.migrations
+                    and c.start == c.end
+                    and not c.decoder
+                    and not c.waiting
+                    and not c.outgoing
+                    and c.player.id not in self.state.interest.dirty
+                ):
+                    self.migrate(c, self.state.migrations.pop(c.player.id))
+
+    def migrate(self, c, target):
+        logger.info(f"Handing player {c.player.id} to worker {target}")
+        self.remove_connection(c)
+        self.multicast.leave(c)
+
+        # save the player now so the new worker loads it fresh, but keep them in the broker directory
+        player = c.player
+        State.drop_player(self.state, player.id)
+        self.state.save_now()
+
+        self.channel.send(("migrate", target, (player.id, player.slots)))
+        send_handle(self.channel, c.socket.fileno(), os.getppid())
+        c.socket.close()
+
+    def adopt(self, id, slots, conn):
+        logger.info(f"Adopting player {id} from another worker")
+        c = self.add_connection(conn)
+        c.player = State.add_player(self.state, id)
+        c.player.slots = slots
+        self.multicast.join(c)
+        # only the local region index needs to hear about it, the broker knows already
+        State.player_moved(self.state, c.player, 0)
+
+
+def run_worker(address, authkey, address_port, path, index, count, high_water, level):
+    logging.basicConfig(level=logging.getLevelName(level))
+    channel = Client(address, family="AF_UNIX", authkey=authkey)
+    # used from the Server's DatabaseThread
+    with Sqlite3(path, check_same_thread=False) as db:
+        Worker(address_port, db, channel, index, count, high_water).run()
+
+
+class Broker(State):
+    """Owns GLOB memory, login tokens and the player directory; routes calls between workers"""
+
+    __slots__ = "channels", "directory", "pending", "seq"
+
+    def __init__(self, database, channels):
+        super().__init__(database)
+
+        # one channel per worker, in worker index order
+        self.channels = channels
+        # connected players: id => [worker index, region]
+        self.directory = {}
+        # calls forwarded to a worker: our sequence number => (origin channel, their sequence number)
+        self.pending = {}
+        self.seq = 0
+
+    def owns_region(self, region):
+        # GLRG memory is all in the workers
+        return False
+
+    def read_glob(self, data_type, addr, length):
+        # a copy to send, not a view of the page
+        return bytes(super().read_glob(data_type, addr, length))
+
+    # #########################################################################
+    def claim_player(self, id, index):
+        if id in self.directory:
+            return False
+        self.directory[id] = [index, 0]
+        self._enter_region(id, 0)
+        return True
+
+    def release_player(self, id):
+        try:
+            _, region = self.directory.pop(id)
+            self._leave_region(id, region)
+        except KeyError:
+            pass
+
+    def player_count(self):
+        return len(self.directory)
+
+    def set_region(self, id, region):
+        try:
+            entry = self.directory[id]
+        except KeyError:
+            return
+        if entry[1] != region:
+            self._leave_region(id, entry[1])
+            self._enter_region(id, region)
+            entry[1] = region
+
+    def forward(self, channel, seq, index, method, args):
+        self.seq += 1
+        self.pending[self.seq] = (channel, seq)
+        self.channels[index].send(("call", self.seq, method, args))
+
+    # #########################################################################
+    def dispatch(self, channel, message):
+        """Handle one message from a worker"""
+        kind = message[0]
+        if kind == "call":
+            _, seq, method, args = message
+            if method in ("read_glrg", "write_glrg"):
+                # region memory: whichever worker owns the region
+                self.forward(channel, seq, args[0] % len(self.channels), method, args)
+            elif method in ("read_player", "write_player"):
+                # player memory: whichever worker the player is on
+                try:
+                    self.forward(channel, seq, self.directory[args[0]][0], method, args)
+                except KeyError:
+                    channel.send(("reply", seq, bytes(args[3]) if method == "read_player" else None))
+            else:
+                channel.send(("reply", seq, getattr(self, method)(*args)))
+
+        elif kind == "notify":
+            _, method, args = message
+            getattr(self, method)(*args)
+
+        elif kind == "reply":
+            # answer to a forwarded call, pass it back
+            origin, seq = self.pending.pop(message[1])
+            origin.send(("reply", seq, message[2]))
+
+        elif kind == "migrate":
+            _, index, (id, slots) = message
+            fd = recv_handle(channel)
+            try:
+                self.directory[id][0] = index
+            except KeyError:
+                pass
+            self.channels[index].send(("adopt", (id, slots)))
+            send_handle(self.channels[index], fd, 0)
+            os.close(fd)
+
+
+class Cluster:
+    """Starts the broker and worker processes, and runs the broker until told to stop"""
+
+    __slots__ = "address_port", "path", "workers", "high_water", "level"
+
+    def __init__(self, address_port, path, workers, high_water=0x100000, level="NOTSET"):
+        self.address_port = address_port
+        self.path = path
+        self.workers = workers
+        self.high_water = high_water
+        self.level = level
+
+    def run(self):
+        """Runs the cluster."""
+        context = get_context("fork")
+        authkey = os.urandom(32)
+
+        # the broker's db connection is opened first, so the tables exist before workers start
+        with TemporaryDirectory() as tmp, Sqlite3(self.path) as db:
+            address = os.path.join(tmp, "broker")
+            with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+                processes = []
+                channels = []
+                for index in range(self.workers):
+                    process = context.Process(
+                        target=run_worker,
+                        args=(
+                            address,
+                            authkey,
+                            self.address_port,
+                            self.path,
+                            index,
+                            self.workers,
+                            self.high_water,
+                            self.level,
+                        ),
+                        name=f"DSOServer worker {index}",
+                    )
+                    process.start()
+                    processes.append(process)
+                    # wait for each worker to connect before starting the next, so channels stay in index order
+                    channels.append(listener.accept())
+
+            broker = Broker(db, channels)
+            logger.info(f"Started {self.workers} workers on {self.address_port}")
+
+            self.serve(broker, processes)
+
+            for process in processes:
+                process.join()
+            broker.close()
+
+    def serve(self, broker, processes):
+        live = list(broker.channels)
+        watch = live + [stdin]
+        stopping = False
+        while live:
+            try:
+                # wake up for the broker's timers too (login tokens expiring)
+                for ready in wait(watch, broker.timers.timeout()):
+                    if ready is stdin:
+                        # sysop console: only exit / quit is supported here
+                        line = stdin.readline()
+                        if not line:
+                            watch.remove(stdin)
+                        elif line.strip() in ("exit", "quit"):
+                            stopping = True
+
+                    else:
+                        try:
+                            broker.dispatch(ready, ready.recv())
+                        except EOFError:
+                            # worker has shut down
+                            live.remove(ready)
+                            watch.remove(ready)
+
+                broker.timers.run()
+
+            except KeyboardInterrupt:
+                # the workers got it too, and are shutting down
+                print("Received Ctrl+C, shutting down")
+                stopping = True
+
+            if stopping:
+                stopping = False
+                for channel in live:
+                    channel.send(("stop",))
@@ -1,60 +1,224 @@
+import re
+from time import perf_counter
+
+# zero-filled source for expanding zero runs without allocating per-run
+_ZEROS = bytes(129)
+# anything 2 or more zeroes long is worth encoding as a run
+_ZERO_RUN = re.compile(rb"\x00\x00+")
+
+
 def RLECompress(data):
-    result = bytearray()
+    length = len(data)
+    # worst case is a 1-byte header for every 128 literal bytes
+    result = bytearray(length + (length + 127) // 128)
+    out = 0
 
+    # let the regex engine find the zero runs, and copy everything in between as literal slices
     start = 0
-    length = len(data)
-    while start < length:
-        end = start + 1
-
-        if end < length and data[start] == 0 and data[end] == 0:
-            # a run of zeroes, add as many as we can to the list and emit
-            end += 1
-            while end - start < 129 and end < length and data[end] == 0:
-                end += 1
-            result.append(0x101 - (end - start))
-            start = end
+    for match in _ZERO_RUN.finditer(data):
+        zero_start, end = match.span()
+
+        # literal block up to the run, in 128-byte pieces
+        while start < zero_start:
+            chunk = start + 128 if zero_start - start > 128 else zero_start
+            result[out] = chunk - start - 1
+            out += 1
+            result[out : out + chunk - start] = data[start:chunk]
+            out += chunk - start
+            start = chunk
 
+        # emit as many full (129-byte) runs as we can
+        run = end - zero_start
+        if run > 129:
+            full, run = divmod(run, 129)
+            result[out : out + full] = b"\x80" * full
+            out += full
+
+        if run == 1:
+            # a lone trailing zero goes out with the following literal
+            start = end - 1
         else:
-            # advance until we run out of block, or off end of data
-            while end - start < 128 and end < length:
-                # check for 2x zeros and if so exit loop, we'll get it next time
-                if end + 1 < length and data[end] == 0 and data[end + 1] == 0:
-                    break
-                else:
-                    end += 1
-
-            result.append(end - start - 1)
-            while start < end:
-                result.append(data[start])
-                start += 1
+            if run:
+                result[out] = 0x101 - run
+                out += 1
+            start = end
 
+    # trailing literal block
+    while start < length:
+        chunk = start + 128 if length - start > 128 else length
+        result[out] = chunk - start - 1
+        out += 1
+        result[out : out + chunk - start] = data[start:chunk]
+        out += chunk - start
+        start = chunk
+
+    del result[out:]
     return result
 
 
+class RLEDecoder:
+    """
+    Incremental RLE decoder, for decompressing a packet while its bytes are still arriving.
+
+    Create one with the compressed length from the frame header, then feed() it chunks
+    until done is True.  A literal block split across chunks is carried over between calls.
+    """
+
+    __slots__ = "result", "out", "remaining", "literal"
+
+    def __init__(self, length):
+        # output is at least about as long as the input, so start with that much room
+        self.result = bytearray(length)
+        self.out = 0
+        # compressed bytes still expected
+        self.remaining = length
+        # literal bytes still to copy from the last control byte
+        self.literal = 0
+
+    @property
+    def done(self):
+        return self.remaining == 0
+
+    def feed(self, data):
+        """Decode bytes from data, returns how many were consumed (never more than remaining)"""
+        length = min(len(data), self.remaining)
+        result = self.result
+        out = self.out
+
+        # finish any literal block left over from the previous chunk
+        ptr = min(self.literal, length)
+        if ptr:
+            result[out : out + ptr] = data[:ptr]
+            out += ptr
+            self.literal -= ptr
+
+        while ptr < length:
+            count = data[ptr]
+            ptr += 1
+            if count < 0x80:
+                # copy the next (count + 1) bytes to output, or as many as we have
+                end = ptr + count + 1
+                if end > length:
+                    self.literal = end - length
+                    end = length
+                result[out : out + end - ptr] = data[ptr:end]
+                out += end - ptr
+                ptr = end
+            else:
+                # Zero-stuff (0xFF - count + 2) bytes to output
+                count = 0x101 - count
+                result[out : out + count] = _ZEROS[:count]
+                out += count
+
+        self.out = out
+        self.remaining -= length
+        return length
+
+    def finish(self):
+        """Return the decoded packet.  Raises ValueError if the compressed data was incomplete."""
+        if self.remaining or self.literal:
+            raise ValueError("RLE data ended early")
+        del self.result[self.out :]
+        return self.result
+
+
 def RLEUncompress(data):
-    result = bytearray()
+    decoder = RLEDecoder(len(data))
+    decoder.feed(data)
+    return decoder.finish()
 
-    ptr = 0
-    length = len(data)
-    while ptr < length:
-        count = data[ptr]
-        ptr += 1
-        if count < 0x80:
-            # copy the next (count + 1) bytes to output
-            # TODO: use array slices to do this directly
-            while count >= 0:
-                result.append(data[ptr])
-                count -= 1
-                ptr += 1
+
+class OpcodeStats:
+    """Running compression counters for one packet type"""
+
+    __slots__ = "packets", "tried", "won", "skipped", "bytes_in", "bytes_out", "seconds"
+
+    def __init__(self):
+        # packets sent, packets run through RLECompress, and how many of those got smaller
+        self.packets = 0
+        self.tried = 0
+        self.won = 0
+        # packets not compressed because of the learned ratio or the zero estimate
+        self.skipped = 0
+        # payload bytes before and after (whichever form was sent)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # time spent deciding and compressing
+        self.seconds = 0.0
+
+    @property
+    def saved(self):
+        return self.bytes_in - self.bytes_out
+
+
+class CompressionPolicy:
+    """
+    Decides which outgoing packets are worth running through RLECompress.
+
+    Statistics are kept per opcode (the first 4 bytes of a packet).  Once an opcode has been tried
+    warmup times and almost never came out smaller, it is skipped, except for one re-probe every
+    probe packets in case its contents change.  Large payloads are first checked for pairs of
+    zeroes, which are the only thing RLE can shrink.
+    """
+
+    __slots__ = "stats", "warmup", "probe", "min_win", "large", "min_zeros"
+
+    def __init__(self, warmup=16, probe=256, min_win=0.05, large=256, min_zeros=1 / 32):
+        self.stats = {}
+        self.warmup = warmup
+        self.probe = probe
+        # fraction of tries that must shrink for an opcode to stay compressed
+        self.min_win = min_win
+        # payloads at least this long get the zero estimate, and must be at least min_zeros in zero pairs
+        self.large = large
+        self.min_zeros = min_zeros
+
+    def compress(self, data):
+        """Return RLECompress(data) if that is worth sending, otherwise None"""
+        opcode = bytes(data[0:4])
+        try:
+            stats = self.stats[opcode]
+        except KeyError:
+            stats = OpcodeStats()
+            self.stats[opcode] = stats
+
+        start = perf_counter()
+        stats.packets += 1
+        stats.bytes_in += len(data)
+
+        if (
+            stats.tried >= self.warmup
+            and stats.won < stats.tried * self.min_win
+            and stats.packets % self.probe
+        ) or (
+            len(data) >= self.large
+            and data.count(b"\0\0") * 2 < len(data) * self.min_zeros
+        ):
+            # learned not to bother, or there aren't enough zeroes to be worth a pass
+            stats.skipped += 1
+            compressed = None
         else:
-            # Zero-stuff (0xFF - count + 2) bytes to output
-            count = 0x101 - count
-            # TODO: use list comprehension to add multiple elems at once
-            while count:
-                result.append(0)
-                count -= 1
+            stats.tried += 1
+            compressed = RLECompress(data)
+            if len(compressed) < len(data):
+                stats.won += 1
+            else:
+                compressed = None
 
-    return result
+        stats.bytes_out += len(data) if compressed is None else len(compressed)
+        stats.seconds += perf_counter() - start
+        return compressed
+
+    def report(self):
+        """Return a list of printable lines summarizing the counters, most bytes saved first"""
+        lines = [
+            f"{'opcode':<8}{'packets':>9}{'tried':>9}{'won':>9}{'skipped':>9}{'saved':>11}{'cpu ms':>9}"
+        ]
+        for opcode, stats in sorted(self.stats.items(), key=lambda item: -item[1].saved):
+            lines.append(
+                f"{str(opcode, 'ascii', 'replace'):<8}{stats.packets:>9}{stats.tried:>9}{stats.won:>9}{stats.skipped:>9}{stats.saved:>11}{stats.seconds * 1000:>9.1f}"
+            )
+        return lines
 
 
 def EncodeString(string):
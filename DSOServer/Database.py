@@ -1,10 +1,22 @@
 """Sqlite3-powered database for DSOServer"""
 
 import sqlite3
+from concurrent.futures import Future
 from logging import getLogger
+from queue import SimpleQueue
+from threading import Thread
+
+from .Memory import PAGE_SIZE, blocks
 
 logger = getLogger(__name__)
 
+# world and player memory is stored a page per row
+TABLES = {
+    "glob": "CREATE TABLE IF NOT EXISTS glob(key INTEGER NOT NULL, page INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY(key, page)) WITHOUT ROWID, STRICT",
+    "glrg": "CREATE TABLE IF NOT EXISTS glrg(region INTEGER NOT NULL, key INTEGER NOT NULL, page INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY(region, key, page)) WITHOUT ROWID, STRICT",
+    "player": "CREATE TABLE IF NOT EXISTS player(id INTEGER NOT NULL, key TEXT NOT NULL, page INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY(id, key, page), FOREIGN KEY(id) REFERENCES login(id) ON DELETE CASCADE ON UPDATE CASCADE) WITHOUT ROWID, STRICT",
+}
+
 
 class Database:
     """
@@ -19,7 +31,7 @@ class Database:
         return None
 
     def get_glob(self):
-        """Return a dict of key => value read from the db"""
+        """Return a dict of key => Block read from the db"""
         return {}
 
     def get_regions(self):
@@ -27,25 +39,160 @@ class Database:
         return set()
 
     def get_glrg(self, region):
-        """Return a dict of key => value for one region"""
+        """Return a dict of key => Block for one region"""
         return {}
 
     def get_player(self, username):
-        """Return a dict of key => value for the player of id"""
+        """Return a dict of key => Block for the player of id"""
         return {}
 
     def save_glob(self, data):
-        """Save a GLOB dict to the db"""
+        """Save a GLOB dict of Blocks to the db"""
         pass
 
     def save_glrg(self, region, data):
-        """Save one region to the GLRG section of db"""
+        """Save one region's dict of Blocks to the GLRG section of db"""
         pass
 
     def save_player(self, username, data):
-        """Save a player's data to the db"""
+        """Save a player's dict of Blocks to the db"""
+        pass
+
+    def save_checkpoint(self, glob, glrg, player):
+        """Save lists of changed (key, page, data) GLOB, (region, key, page, data) GLRG and (id, key, page, data) player pages, all at once"""
+        pass
+
+    def get_world(self):
+        """Return every (id, username, password) login, and every GLOB, GLRG and player page row, as lists"""
+        return [], [], [], []
+
+    def replace_world(self, logins, glob, glrg, player):
+        """Replace everything with the lists from another database's get_world"""
         pass
 
+    def save_batch(self, calls):
+        """Run a list of (save method name, args), all in one transaction if possible"""
+        for method, args in calls:
+            getattr(self, method)(*args)
+
+    def submit(self, method, *args):
+        """Return a Future of the result of a method.  Here it is run right away, see DatabaseThread."""
+        future = Future()
+        try:
+            future.set_result(getattr(self, method)(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class DatabaseThread(Database):
+    """
+    Runs another Database on a thread of its own, taking requests from a queue.
+
+    submit() returns a Future of the result, for the server loop to carry on without waiting; the
+    ordinary Database methods are also here, and wait for the thread.  Requests run in the order they
+    were made.  Saves that are queued one after another run in a single transaction, so a burst of
+    them costs one sync to disk instead of one each.
+
+    The database is used from this thread only (sqlite3 connections need check_same_thread=False
+    to be handed over to it).
+    """
+
+    __slots__ = "database", "requests", "thread"
+
+    def __init__(self, database):
+        self.database = database
+        # (Future, method name, args), or None to stop
+        self.requests = SimpleQueue()
+        self.thread = Thread(target=self.run, name="database", daemon=True)
+        self.thread.start()
+
+    def submit(self, method, *args):
+        future = Future()
+        self.requests.put((future, method, args))
+        return future
+
+    def call(self, method, *args):
+        """Run a request and wait for its result"""
+        return self.submit(method, *args).result()
+
+    def close(self):
+        """Finish every request already made, and stop the thread"""
+        self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            # take everything waiting, to batch up the saves
+            batch = [self.requests.get()]
+            while not self.requests.empty():
+                batch.append(self.requests.get())
+
+            i = 0
+            while i < len(batch):
+                if batch[i] is None:
+                    return
+                j = i
+                while j < len(batch) and batch[j] and batch[j][1].startswith("save_"):
+                    j += 1
+                if j > i:
+                    self.save(batch[i:j])
+                    i = j
+                else:
+                    future, method, args = batch[i]
+                    try:
+                        future.set_result(getattr(self.database, method)(*args))
+                    except Exception as e:
+                        logger.exception("Database request %s failed", method)
+                        future.set_exception(e)
+                    i += 1
+
+    def save(self, requests):
+        try:
+            self.database.save_batch([(method, args) for _, method, args in requests])
+        except Exception as e:
+            # the transaction was rolled back, so all of them failed
+            logger.exception("Saving %d requests failed", len(requests))
+            for future, _, _ in requests:
+                future.set_exception(e)
+        else:
+            for future, _, _ in requests:
+                future.set_result(None)
+
+    # #########################################################################
+    def get_login(self, username, password):
+        return self.call("get_login", username, password)
+
+    def get_glob(self):
+        return self.call("get_glob")
+
+    def get_regions(self):
+        return self.call("get_regions")
+
+    def get_glrg(self, region):
+        return self.call("get_glrg", region)
+
+    def get_player(self, id):
+        return self.call("get_player", id)
+
+    def save_glob(self, glob):
+        return self.call("save_glob", glob)
+
+    def save_glrg(self, region, glrg):
+        return self.call("save_glrg", region, glrg)
+
+    def save_player(self, id, player):
+        return self.call("save_player", id, player)
+
+    def save_checkpoint(self, glob, glrg, player):
+        return self.call("save_checkpoint", glob, glrg, player)
+
+    def get_world(self):
+        return self.call("get_world")
+
+    def replace_world(self, logins, glob, glrg, player):
+        return self.call("replace_world", logins, glob, glrg, player)
+
 
 class Sqlite3(Database):
     """
@@ -56,27 +203,53 @@ class Sqlite3(Database):
 
     __slots__ = "connection"
 
-    def __init__(self, path):
+    def __init__(self, path, check_same_thread=True):
         logger.info(f"Initializing database from {path}")
         # Open new sqlite connection to named database
-        self.connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+        #  check_same_thread=False lets a worker thread share it, if the caller serializes access
+        self.connection = sqlite3.connect(
+            path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=check_same_thread,
+        )
 
         # initial state setup
         self.connection.execute("PRAGMA foreign_keys=1")
+        # write-ahead log: readers (manage.py, other processes) don't wait on writers, and a commit only
+        #  needs a sync to disk at checkpoints with synchronous=NORMAL (the last commits can be lost in a
+        #  power cut, but the database can't be corrupted)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # 16MB of page cache (negative means KiB), enough for every region of a busy world
+        self.connection.execute("PRAGMA cache_size=-16384")
 
         # create tables if not exist
         self.connection.execute(
             "CREATE TABLE IF NOT EXISTS login(id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL COLLATE NOCASE, password TEXT NOT NULL, UNIQUE(username)) STRICT"
         )
-        self.connection.execute(
-            "CREATE TABLE IF NOT EXISTS glob(key INTEGER PRIMARY KEY, data BLOB NOT NULL) STRICT"
-        )
-        self.connection.execute(
-            "CREATE TABLE IF NOT EXISTS glrg(region INTEGER NOT NULL, key INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY(region, key)) WITHOUT ROWID, STRICT"
-        )
-        self.connection.execute(
-            "CREATE TABLE IF NOT EXISTS player(id INTEGER NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY(id, key), FOREIGN KEY(id) REFERENCES login(id) ON DELETE CASCADE ON UPDATE CASCADE) WITHOUT ROWID, STRICT"
-        )
+        for table, create in TABLES.items():
+            columns = [row[1] for row in self.connection.execute(f"PRAGMA table_info({table})")]
+            if columns and "page" not in columns:
+                self._split_pages(table)
+            else:
+                self.connection.execute(create)
+
+    def _split_pages(self, table):
+        """Convert a table from a row per block to a row per page, leaving out pages of all zeros"""
+        logger.info(f"Converting {table} to pages")
+        pages = [
+            (*keys, offset // PAGE_SIZE, data[offset : offset + PAGE_SIZE])
+            for *keys, data in self.connection.execute(f"SELECT * FROM {table}")
+            for offset in range(0, len(data), PAGE_SIZE)
+            if data[offset : offset + PAGE_SIZE].strip(b"\0")
+        ]
+        self.connection.execute("BEGIN")
+        self.connection.execute(f"DROP TABLE {table}")
+        self.connection.execute(TABLES[table])
+        if pages:
+            placeholders = ", ".join("?" * len(pages[0]))
+            self.connection.executemany(f"INSERT INTO {table} VALUES({placeholders})", pages)
+        self.connection.commit()
 
     def __enter__(self):
         return self
@@ -95,54 +268,92 @@ class Sqlite3(Database):
         return None
 
     def get_glob(self):
-        return {
-            key: bytearray(data)
-            for key, data in self.connection.execute(
-                "SELECT key, data FROM glob ORDER BY key"
-            ).fetchall()
-        }
+        return blocks(self.connection.execute("SELECT key, page, data FROM glob"))
 
     def get_regions(self):
-        return set(
-            self.connection.execute(
+        return {
+            region
+            for (region,) in self.connection.execute(
                 "SELECT DISTINCT region FROM glrg ORDER BY region"
             ).fetchall()
-        )
+        }
 
     def get_glrg(self, region):
-        return {
-            key: bytearray(data)
-            for key, data in self.connection.execute(
-                "SELECT key, data FROM glrg WHERE region=? ORDER BY key", (region,)
-            ).fetchall()
-        }
+        return blocks(
+            self.connection.execute("SELECT key, page, data FROM glrg WHERE region=?", (region,))
+        )
 
     def get_player(self, id):
-        return {
-            key: bytearray(data)
-            for key, data in self.connection.execute(
-                "SELECT key, data FROM player WHERE id=? ORDER BY key",
-                (id,),
-            ).fetchall()
-        }
+        return blocks(self.connection.execute("SELECT key, page, data FROM player WHERE id=?", (id,)))
+
+    # Statements are always the same strings, so sqlite3's statement cache prepares each just once.
+    #  The _save methods don't commit, so save_batch can run many in one transaction.
+    def _save_glob(self, glob):
+        self._save_checkpoint(
+            [(key, page, data) for key, block in glob.items() for page, data in block.present()], (), ()
+        )
+
+    def _save_glrg(self, region, glrg):
+        self._save_checkpoint(
+            (),
+            [(region, key, page, data) for key, block in glrg.items() for page, data in block.present()],
+            (),
+        )
+
+    def _save_player(self, id, player):
+        self._save_checkpoint(
+            (),
+            (),
+            [(id, key, page, data) for key, block in player.items() for page, data in block.present()],
+        )
+
+    def _save_checkpoint(self, glob, glrg, player):
+        self.connection.executemany(
+            "INSERT INTO glob VALUES(?, ?, ?) ON CONFLICT(key, page) DO UPDATE SET data=excluded.data",
+            glob,
+        )
+        self.connection.executemany(
+            "INSERT INTO glrg VALUES(?, ?, ?, ?) ON CONFLICT(region, key, page) DO UPDATE SET data=excluded.data",
+            glrg,
+        )
+        self.connection.executemany(
+            "INSERT INTO player VALUES(?, ?, ?, ?) ON CONFLICT(id, key, page) DO UPDATE SET data=excluded.data",
+            player,
+        )
 
     def save_glob(self, glob):
-        with self.connection as conn:
-            conn.executemany(
-                "INSERT INTO glob VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET data=excluded.data",
-                glob.items(),
-            )
+        with self.connection:
+            self._save_glob(glob)
 
     def save_glrg(self, region, glrg):
-        with self.connection as conn:
-            conn.executemany(
-                "INSERT INTO glrg VALUES(?, ?, ?) ON CONFLICT(region, key) DO UPDATE SET data=excluded.data",
-                [(region, key, data) for key, data in glrg.items()],
-            )
+        with self.connection:
+            self._save_glrg(region, glrg)
 
     def save_player(self, id, player):
-        with self.connection as conn:
-            conn.executemany(
-                "INSERT INTO player VALUES(?, ?, ?) ON CONFLICT(id, key) DO UPDATE SET data=excluded.data",
-                [(id, key, data) for key, data in player.items()],
-            )
+        with self.connection:
+            self._save_player(id, player)
+
+    def save_checkpoint(self, glob, glrg, player):
+        # one transaction, so a crash leaves the whole checkpoint or none of it
+        with self.connection:
+            self._save_checkpoint(glob, glrg, player)
+
+    def save_batch(self, calls):
+        with self.connection:
+            for method, args in calls:
+                getattr(self, "_" + method)(*args)
+
+    def get_world(self):
+        return (
+            self.connection.execute("SELECT id, username, password FROM login").fetchall(),
+            self.connection.execute("SELECT key, page, data FROM glob").fetchall(),
+            self.connection.execute("SELECT region, key, page, data FROM glrg").fetchall(),
+            self.connection.execute("SELECT id, key, page, data FROM player").fetchall(),
+        )
+
+    def replace_world(self, logins, glob, glrg, player):
+        with self.connection:
+            for table in ("player", "glrg", "glob", "login"):
+                self.connection.execute(f"DELETE FROM {table}")
+            self.connection.executemany("INSERT INTO login(id, username, password) VALUES(?, ?, ?)", logins)
+            self._save_checkpoint(glob, glrg, player)
@@ -0,0 +1,120 @@
+"""Interest management: which players are close enough to see each other move"""
+
+# players further apart than this, in x or y, don't get each other's position updates
+VIEW_RANGE = 64
+
+
+class Located:
+    """Where a player was last reported, and who to tell about players near them"""
+
+    __slots__ = "region", "cell", "x", "y", "entry", "receiver"
+
+    def __init__(self, region, cell, x, y, entry, receiver):
+        self.region = region
+        self.cell = cell
+        self.x = x
+        self.y = y
+        # the player's dsPS list entry, as sent to others
+        self.entry = entry
+        # whatever position batches for this player are handed to (a Connection)
+        self.receiver = receiver
+
+
+class Interest:
+    """
+    A uniform grid of player positions for each region, with cells VIEW_RANGE wide, so everyone
+    within range of a player is in the 3x3 block of cells around them.
+
+    Moves are collected as they come in, and tick() works out who should hear about each one.
+    Only the players near a mover are looked at, so the work per tick grows with how crowded
+    it is locally, not with the number of players in the region.
+    """
+
+    __slots__ = "view_range", "regions", "players", "dirty"
+
+    def __init__(self, view_range=VIEW_RANGE):
+        self.view_range = view_range
+        # region => {(cell x, cell y): set of ids}
+        self.regions = {}
+        # id => Located
+        self.players = {}
+        # ids that moved since the last tick, in order (dict as an ordered set)
+        self.dirty = {}
+
+    def moved(self, id, region, x, y, entry, receiver):
+        """Record a player's new position, for the next tick"""
+        cell = (x // self.view_range, y // self.view_range)
+        try:
+            located = self.players[id]
+        except KeyError:
+            self.players[id] = Located(region, cell, x, y, entry, receiver)
+            self._add(id, region, cell)
+        else:
+            if located.region != region or located.cell != cell:
+                self._remove(id, located.region, located.cell)
+                self._add(id, region, cell)
+                located.region = region
+                located.cell = cell
+            located.x = x
+            located.y = y
+            located.entry = entry
+            located.receiver = receiver
+
+        self.dirty[id] = None
+
+    def left(self, id):
+        """Forget a player who is leaving the world"""
+        located = self.players.pop(id, None)
+        if located:
+            self._remove(id, located.region, located.cell)
+            self.dirty.pop(id, None)
+
+    def _add(self, id, region, cell):
+        try:
+            cells = self.regions[region]
+        except KeyError:
+            cells = self.regions[region] = {}
+        try:
+            cells[cell].add(id)
+        except KeyError:
+            cells[cell] = {id}
+
+    def _remove(self, id, region, cell):
+        cells = self.regions[region]
+        ids = cells[cell]
+        ids.discard(id)
+        if not ids:
+            del cells[cell]
+            if not cells:
+                del self.regions[region]
+
+    def tick(self):
+        """Return {receiver: [entries]} of every move since the last tick, for everyone in range of it"""
+        batches = {}
+        players = self.players
+        view_range = self.view_range
+        for id in self.dirty:
+            mover = players[id]
+            cells = self.regions[mover.region]
+            cx, cy = mover.cell
+            for cell in (
+                (cx - 1, cy - 1),
+                (cx, cy - 1),
+                (cx + 1, cy - 1),
+                (cx - 1, cy),
+                (cx, cy),
+                (cx + 1, cy),
+                (cx - 1, cy + 1),
+                (cx, cy + 1),
+                (cx + 1, cy + 1),
+            ):
+                for other in cells.get(cell, ()):
+                    near = players[other]
+                    if abs(near.x - mover.x) <= view_range and abs(near.y - mover.y) <= view_range:
+                        try:
+                            batches[near.receiver].append(mover.entry)
+                        except KeyError:
+                            batches[near.receiver] = [mover.entry]
+
+        self.dirty = {}
+        return batches
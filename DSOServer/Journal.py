@@ -0,0 +1,170 @@
+"""Append-only journal of world and player memory writes, for recovering what the last checkpoint missed"""
+
+import os
+import struct
+from glob import escape, glob
+from logging import getLogger
+from time import time
+
+logger = getLogger(__name__)
+
+# every journal file starts with this
+MAGIC = b"DSOjnl\x00\x01"
+
+# entry header: timestamp, block (GLOB, GLRG, or a player data type like PCSA), index1, index2,
+#  addr, length of the data that follows, and the version the block had after the write
+#  GLOB: index1 is the key.  GLRG: region, key.  Player memory: player id.
+entry = struct.Struct("<d4sIIIIQ")
+
+
+class Journal:
+    """
+    Records every write to GLOB, GLRG and player memory, so a crash loses none of them.
+
+    Writes are only buffered by record(); commit() appends the buffer to the file in one write (and
+    syncs it, if sync), so all the writes of one server loop iteration cost one append between them.
+    The server commits before sending the iteration's replies, so a client never hears back about a
+    write that isn't in the journal.  Each commit also goes to primary's followers, if there is one.
+
+    The journal is a run of numbered files, path.1, path.2, ...: each checkpoint starts the next one,
+    and once the checkpoint is saved, the files before it hold nothing the database lacks and are
+    deleted.  On start, State replays what is left over the database (see State.recover), up to
+    until if that's given, which rewinds the world to that time (but no further back than the last
+    checkpoint saved).
+    """
+
+    __slots__ = (
+        "path",
+        "sync",
+        "until",
+        "primary",
+        "number",
+        "file",
+        "buffer",
+        "covered",
+        "entries",
+        "commits",
+        "bytes",
+    )
+
+    def __init__(self, path, sync=False, until=None):
+        self.path = os.fspath(path)
+        self.sync = sync
+        self.until = until
+        # Primary to stream every commit to followers with, if any (see Replication)
+        self.primary = None
+        # the number of the file being written, and the file, once started
+        self.number = max(self.numbers(), default=0)
+        self.file = None
+        # entries recorded since the last commit
+        self.buffer = bytearray()
+        # (file number, Future of the checkpoint that makes it and those before it unneeded)
+        self.covered = []
+        # counts, for metrics
+        self.entries = 0
+        self.commits = 0
+        self.bytes = 0
+
+    def numbers(self):
+        """The numbers of the journal files there are, in order"""
+        numbers = []
+        for name in glob(f"{escape(self.path)}.*"):
+            suffix = name[len(self.path) + 1 :]
+            if suffix.isdigit():
+                numbers.append(int(suffix))
+        return sorted(numbers)
+
+    def start(self):
+        """Start writing to a new file, after any there are"""
+        self.number += 1
+        self.file = open(f"{self.path}.{self.number}", "wb", buffering=0)
+        self.file.write(MAGIC)
+        logger.info(f"Journaling writes to {self.path}.{self.number}")
+
+    def record(self, block, index1, index2, addr, data, version):
+        self.buffer += entry.pack(time(), block, index1, index2, addr, len(data), version)
+        self.buffer += data
+        self.entries += 1
+
+    def commit(self):
+        """Append everything recorded since the last commit"""
+        if not self.buffer:
+            return
+        self.file.write(self.buffer)
+        if self.sync:
+            os.fsync(self.file.fileno())
+        if self.primary:
+            self.primary.publish(self.buffer)
+        self.bytes += len(self.buffer)
+        self.commits += 1
+        self.buffer = bytearray()
+
+    def checkpoint(self, saving):
+        """A checkpoint of everything written so far is being saved: move on to a new file, and delete this one once it's saved"""
+        self.commit()
+        self.file.close()
+        self.covered.append((self.number, saving))
+        self.start()
+        self.truncate()
+
+    def truncate(self):
+        """Delete the files whose writes have all been saved by a checkpoint"""
+        last = None
+        while self.covered and self.covered[0][1].done():
+            number, saving = self.covered.pop(0)
+            if saving.exception() is None:
+                last = number
+        if last is not None:
+            self.delete(last)
+
+    def delete(self, last):
+        for number in self.numbers():
+            if number <= last:
+                os.remove(f"{self.path}.{number}")
+
+    def replay(self):
+        """Yield every entry in the files there are, in order, up to until (see read)"""
+        for number in self.numbers():
+            for write in read(f"{self.path}.{number}"):
+                if self.until is not None and write[0] > self.until:
+                    return
+                yield write
+
+    def close(self):
+        """Everything has been saved: the journal isn't needed any more"""
+        self.buffer = bytearray()
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.delete(self.number)
+        if self.primary:
+            self.primary.close()
+
+
+def entries(buffer):
+    """Yield (timestamp, block, index1, index2, addr, data, version) for every entry in a buffer of whole ones"""
+    offset = 0
+    while offset < len(buffer):
+        timestamp, block, index1, index2, addr, length, version = entry.unpack_from(buffer, offset)
+        offset += entry.size
+        yield timestamp, block, index1, index2, addr, buffer[offset : offset + length], version
+        offset += length
+
+
+def read(path):
+    """Yield (timestamp, block, index1, index2, addr, data, version) for every entry in a journal file"""
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a journal")
+
+        while header := file.read(entry.size):
+            if len(header) < entry.size:
+                # the server was cut off mid-write
+                logger.warning(f"{path} ends with a partial entry")
+                return
+            timestamp, block, index1, index2, addr, length, version = entry.unpack(header)
+            data = file.read(length)
+            if len(data) < length:
+                logger.warning(f"{path} ends with a partial entry")
+                return
+            yield timestamp, block, index1, index2, addr, data, version
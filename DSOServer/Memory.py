@@ -0,0 +1,123 @@
+"""Sparse, paged blocks of GLOB / GLRG / player memory"""
+
+from itertools import count
+
+# bytes per page: blocks are allocated, tracked and saved a page at a time
+PAGE_SIZE = 0x1000
+
+# what every page not yet written holds
+ZERO = bytes(PAGE_SIZE)
+
+# block versions, from one counter for all blocks so no version is ever seen twice (0 is a missing block)
+_versions = count(1)
+
+
+class Block:
+    """
+    One block of client memory, in fixed-size pages.
+
+    Only pages that have been written are allocated; the rest read back as zeros, so a write far into
+    a block costs a page, not everything before it.  A read that falls within one page is a memoryview
+    of it (or of ZERO), without copying: it is only good until the next write, so it should be used
+    right away, as for building a reply.  Reads across pages are copied together.
+
+    Pages written since the last call to changes() are kept in dirty, for saving just those.  version
+    is new after every write (and for every Block made, even of the same data), so anything derived
+    from the contents can be keyed by it, as ReplyCache does.
+    """
+
+    __slots__ = "pages", "dirty", "version"
+
+    def __init__(self, pages=None):
+        # page number => bytearray(PAGE_SIZE)
+        self.pages = {} if pages is None else pages
+        # numbers of the pages written since the last changes()
+        self.dirty = set()
+        self.version = next(_versions)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """A Block holding data from address 0"""
+        block = cls()
+        block.write(0, data)
+        block.dirty.clear()
+        return block
+
+    def __bytes__(self):
+        """Everything up to the end of the last page present"""
+        if not self.pages:
+            return b""
+        return bytes(self.read(0, (max(self.pages) + 1) * PAGE_SIZE))
+
+    def memory(self):
+        """Bytes allocated for pages"""
+        return len(self.pages) * PAGE_SIZE
+
+    def read(self, addr, length):
+        page, offset = divmod(addr, PAGE_SIZE)
+        if offset + length <= PAGE_SIZE:
+            return memoryview(self.pages.get(page, ZERO))[offset : offset + length]
+
+        result = bytearray(length)
+        pos = 0
+        while pos < length:
+            count = min(PAGE_SIZE - offset, length - pos)
+            data = self.pages.get(page)
+            if data is not None:
+                result[pos : pos + count] = memoryview(data)[offset : offset + count]
+            pos += count
+            page += 1
+            offset = 0
+        return result
+
+    def write(self, addr, data):
+        self.version = next(_versions)
+        data = memoryview(data)
+        page, offset = divmod(addr, PAGE_SIZE)
+        pos = 0
+        while pos < len(data):
+            count = min(PAGE_SIZE - offset, len(data) - pos)
+            try:
+                self.pages[page][offset : offset + count] = data[pos : pos + count]
+            except KeyError:
+                buffer = bytearray(PAGE_SIZE)
+                buffer[offset : offset + count] = data[pos : pos + count]
+                self.pages[page] = buffer
+            self.dirty.add(page)
+            pos += count
+            page += 1
+            offset = 0
+
+    def load(self, page, data):
+        """Put back a page read from the database (which may be short: the rest is zeros)"""
+        buffer = bytearray(PAGE_SIZE)
+        buffer[: len(data)] = data
+        self.pages[page] = buffer
+
+    def present(self):
+        """Copies of every page present, as (page, data)"""
+        return [(page, bytes(data)) for page, data in sorted(self.pages.items())]
+
+    def changes(self):
+        """Copies of the pages written since last asked, as (page, data), and mark them clean"""
+        pages = self.pages
+        changed = [(page, bytes(pages[page])) for page in sorted(self.dirty)]
+        self.dirty.clear()
+        return changed
+
+
+def zeros(length):
+    """length bytes of zeros, a view of ZERO if it's long enough"""
+    return memoryview(ZERO)[:length] if length <= PAGE_SIZE else bytes(length)
+
+
+def blocks(rows):
+    """Build {key: Block} from (key, page, data) rows"""
+    result = {}
+    for key, page, data in rows:
+        try:
+            block = result[key]
+        except KeyError:
+            block = result[key] = Block()
+        block.load(page, data)
+    return result
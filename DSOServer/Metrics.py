@@ -0,0 +1,239 @@
+"""Counters and histograms of server activity, for the console and Prometheus"""
+
+from bisect import bisect_left
+
+# upper bounds of the handler latency histogram buckets, in seconds
+BUCKETS = (
+    0.00001,
+    0.000025,
+    0.00005,
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+)
+
+
+class OpcodeMetrics:
+    """Counters for one packet type"""
+
+    __slots__ = "received", "bytes_in", "seconds", "buckets", "sent", "bytes_out", "wire_out"
+
+    def __init__(self):
+        # packets handled, their decoded size, and time spent in the handler
+        self.received = 0
+        self.bytes_in = 0
+        self.seconds = 0.0
+        # one count per bucket, then one for slower than all of them
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+        # packets sent, their size before and after compression (header included)
+        self.sent = 0
+        self.bytes_out = 0
+        self.wire_out = 0
+
+
+class Metrics:
+    """
+    Server activity counters, updated by Connection as packets come and go.
+
+    Each update is a dict lookup and a few additions, cheap enough to leave on all the time.
+    Things that can be counted up when asked (connections, players, regions) aren't tracked here,
+    they are passed in to report() and prometheus() instead.
+    """
+
+    __slots__ = "opcodes", "wire_in", "unknown"
+
+    def __init__(self):
+        # raw 4-byte tag => OpcodeMetrics
+        self.opcodes = {}
+        # bytes read from client sockets
+        self.wire_in = 0
+        # packets with no handler
+        self.unknown = 0
+
+    def opcode(self, tag):
+        try:
+            return self.opcodes[tag]
+        except KeyError:
+            self.opcodes[tag] = metrics = OpcodeMetrics()
+            return metrics
+
+    def handled(self, tag, length, seconds):
+        metrics = self.opcode(tag)
+        metrics.received += 1
+        metrics.bytes_in += length
+        metrics.seconds += seconds
+        metrics.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def sent(self, tag, length, wire_length, count=1):
+        metrics = self.opcode(tag)
+        metrics.sent += count
+        metrics.bytes_out += length * count
+        metrics.wire_out += wire_length * count
+
+    # #########################################################################
+    def report(self, state, connections):
+        """Return a list of printable lines summarizing activity"""
+        lines = [
+            f"{connections} connections, {len(state.players)} players online, {self.wire_in} bytes received, {self.unknown} unknown packets",
+            f"{'opcode':<8}{'in':>9}{'avg us':>9}{'p99 us':>9}{'out':>9}{'bytes out':>11}{'on wire':>11}",
+        ]
+        for tag, metrics in sorted(self.opcodes.items()):
+            average = metrics.seconds / metrics.received * 1e6 if metrics.received else 0
+            lines.append(
+                f"{str(tag, 'ascii', 'replace'):<8}{metrics.received:>9}{average:>9.1f}{percentile(metrics.buckets, 0.99) * 1e6:>9.0f}"
+                f"{metrics.sent:>9}{metrics.bytes_out:>11}{metrics.wire_out:>11}"
+            )
+
+        population = regions(state)
+        if population:
+            lines.append(
+                "players by region: "
+                + ", ".join(f"{region}: {count}" for region, count in sorted(population.items()))
+            )
+        lines.append(
+            f"{len(state.glrg)} regions loaded ({state.region_memory_used()} bytes), "
+            f"{state.region_loads} loads, {state.region_evictions} unloaded"
+        )
+        replies = state.replies
+        lines.append(
+            f"reply cache: {len(replies.entries)} replies ({replies.bytes} bytes), "
+            f"{replies.hits} hits, {replies.misses} misses ({replies.hit_rate():.1%})"
+        )
+        journal = state.journal
+        if journal:
+            lines.append(
+                f"journal: {journal.entries} writes in {journal.commits} commits ({journal.bytes} bytes), "
+                f"file {journal.number}"
+            )
+            if journal.primary:
+                lines.append(journal.primary.report())
+        return lines
+
+    def prometheus(self, state, connections):
+        """Return everything in the Prometheus text exposition format"""
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP dso_{name} {help}")
+            lines.append(f"# TYPE dso_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"dso_{name}{labels} {value}")
+
+        opcodes = [(f'{{opcode="{str(tag, "ascii", "replace")}"}}', m) for tag, m in sorted(self.opcodes.items())]
+
+        metric("connections_open", "gauge", "Client connections open", [("", connections)])
+        metric("players_online", "gauge", "Players in the world", [("", len(state.players))])
+        metric(
+            "region_players",
+            "gauge",
+            "Players in the world, by region",
+            [(f'{{region="{region}"}}', count) for region, count in sorted(regions(state).items())],
+        )
+        metric("regions_loaded", "gauge", "GLRG regions in memory", [("", len(state.glrg))])
+        metric("region_bytes", "gauge", "Bytes of GLRG memory loaded", [("", state.region_memory_used())])
+        metric("region_loads_total", "counter", "GLRG regions loaded from the database", [("", state.region_loads)])
+        metric("region_evictions_total", "counter", "GLRG regions unloaded to stay in budget", [("", state.region_evictions)])
+        metric("reply_cache_entries", "gauge", "Encoded GLOB / GLRG replies kept", [("", len(state.replies.entries))])
+        metric("reply_cache_bytes", "gauge", "Memory held by kept replies", [("", state.replies.bytes)])
+        metric("reply_cache_hits_total", "counter", "GLOB / GLRG reads answered from kept replies", [("", state.replies.hits)])
+        metric("reply_cache_misses_total", "counter", "GLOB / GLRG reads encoded afresh", [("", state.replies.misses)])
+        if state.journal:
+            metric("journal_entries_total", "counter", "Memory writes journaled", [("", state.journal.entries)])
+            metric("journal_commits_total", "counter", "Appends to the journal file", [("", state.journal.commits)])
+            metric("journal_bytes_total", "counter", "Bytes appended to the journal", [("", state.journal.bytes)])
+            primary = state.journal.primary
+            if primary:
+                metric("replication_followers", "gauge", "Followers being streamed to", [("", len(primary.links))])
+                metric(
+                    "replication_queued_bytes",
+                    "gauge",
+                    "Bytes waiting to be sent to followers",
+                    [("", sum(link.queued for link in primary.links))],
+                )
+        metric("received_bytes_total", "counter", "Bytes read from client sockets", [("", self.wire_in)])
+        metric("unknown_packets_total", "counter", "Packets received with no handler", [("", self.unknown)])
+        metric(
+            "packets_received_total",
+            "counter",
+            "Packets handled, by opcode",
+            [(labels, m.received) for labels, m in opcodes if m.received],
+        )
+        metric(
+            "packet_received_bytes_total",
+            "counter",
+            "Decoded bytes of packets handled, by opcode",
+            [(labels, m.bytes_in) for labels, m in opcodes if m.received],
+        )
+        metric(
+            "packets_sent_total",
+            "counter",
+            "Packets sent, by opcode",
+            [(labels, m.sent) for labels, m in opcodes if m.sent],
+        )
+        metric(
+            "packet_sent_bytes_total",
+            "counter",
+            "Bytes of packets sent before compression, by opcode",
+            [(labels, m.bytes_out) for labels, m in opcodes if m.sent],
+        )
+        metric(
+            "packet_sent_wire_bytes_total",
+            "counter",
+            "Bytes of packets sent after compression, headers included, by opcode",
+            [(labels, m.wire_out) for labels, m in opcodes if m.sent],
+        )
+
+        samples = []
+        for labels, m in opcodes:
+            if not m.received:
+                continue
+            total = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), m.buckets):
+                total += count
+                samples.append((f'_bucket{labels[:-1]},le="{bound}"}}', total))
+            samples.append((f"_sum{labels}", m.seconds))
+            samples.append((f"_count{labels}", m.received))
+        metric("handler_seconds", "histogram", "Time spent handling packets, by opcode", samples)
+
+        return "\n".join(lines) + "\n"
+
+
+def percentile(buckets, fraction):
+    """Upper bound of the bucket a percentile falls in (or the last bound, if past it)"""
+    target = sum(buckets) * fraction
+    if not target:
+        return 0
+    total = 0
+    for bound, count in zip(BUCKETS, buckets):
+        total += count
+        if total >= target:
+            return bound
+    return BUCKETS[-1]
+
+
+def regions(state):
+    """Count players in each region"""
+    population = {}
+    for player in state.players.values():
+        region = player.slots["region"]
+        population[region] = population.get(region, 0) + 1
+    return population
+
+
+def http_response(body):
+    """A complete HTTP response carrying Prometheus text"""
+    body = bytes(body, "utf-8")
+    return (
+        b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: "
+        + bytes(str(len(body)), "ascii")
+        + b"\r\nConnection: close\r\n\r\n"
+        + body
+    )
@@ -0,0 +1,86 @@
+"""Sending one packet to many clients, encoded only once"""
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+def encode(policy, data, allow_compress=True):
+    """Return the (length header, payload) to send for a packet, RLE compressed if the policy thinks it's worth it"""
+    compressed = policy.compress(data) if allow_compress else None
+    if compressed is not None:
+        return ((2 + len(compressed)) | 0x8000).to_bytes(2, "little"), compressed
+    return (2 + len(data)).to_bytes(2, "little"), data
+
+
+class Multicast:
+    """
+    Fan-out of packets to connected players.
+
+    Keeps every logged-in player's Connection by id, so a region or a list of ids can be reached
+    without searching the connections.  A packet is compressed and framed once, and the same header
+    and payload objects are queued on every recipient: the cost per recipient is two list appends.
+
+    Each recipient has its own outgoing queue, so backpressure is per recipient too: a packet that is
+    droppable (chat, announcements) is skipped for anyone it would push over their high-water mark,
+    instead of disconnecting them for it.
+    """
+
+    __slots__ = "policy", "metrics", "connections", "skipped"
+
+    def __init__(self, policy, metrics=None):
+        # the server's shared compression policy and traffic counters
+        self.policy = policy
+        self.metrics = metrics
+        # player id => Connection
+        self.connections = {}
+        # droppable packets not queued because the recipient was too far behind
+        self.skipped = 0
+
+    def join(self, c):
+        """A Connection's player has entered the world"""
+        self.connections[c.player.id] = c
+
+    def leave(self, c):
+        """A Connection's player has left the world (or this process)"""
+        if c.player and self.connections.get(c.player.id) is c:
+            del self.connections[c.player.id]
+
+    def everyone(self):
+        return tuple(self.connections.values())
+
+    def region(self, state, region):
+        """Connections of the players in a region"""
+        return self.players(state.ids_in_region(region))
+
+    def players(self, ids):
+        """Connections of the players with these ids, skipping any that aren't here"""
+        connections = self.connections
+        return [connections[id] for id in ids if id in connections]
+
+    def send(self, data, targets, allow_compress=True, droppable=True):
+        """
+        Queue one packet on every Connection in targets.
+
+        Returns the Connections that went over their high-water mark, which should be dropped as for any
+        other send: with droppable set there are none, the packet is skipped for them instead.
+        """
+        header, payload = encode(self.policy, data, allow_compress)
+        length = len(header) + len(payload)
+
+        failed = []
+        queued = skipped = 0
+        for c in targets:
+            if droppable and c.queued + length > c.high_water:
+                skipped += 1
+                continue
+            queued += 1
+            if not c.queue(data, header, payload):
+                failed.append(c)
+
+        if self.metrics and queued:
+            self.metrics.sent(bytes(data[0:4]), len(data), length, queued)
+        if skipped:
+            logger.info("Skipped %d recipients over their high-water mark", skipped)
+            self.skipped += skipped
+        return failed
@@ -0,0 +1,194 @@
+"""Packet layouts for the DSO protocol"""
+
+import struct
+
+# every known Packet, keyed by its raw 4-byte tag
+registry = {}
+
+
+class Packet:
+    """
+    Layout of one packet type: a 4-byte ASCII tag, then fixed-size little-endian fields.
+
+    Fields are (name, struct format) pairs.  A packet with tail=True may carry variable-length
+    data after the fixed fields (strings, id lists, memory blocks), which is passed through as-is.
+    Every Packet adds itself to the registry when created.
+    """
+
+    __slots__ = "tag", "names", "struct", "tail", "description"
+
+    def __init__(self, tag, fields=(), tail=False, description=""):
+        self.tag = bytes(tag, "ascii")
+        self.names = tuple(name for name, _ in fields)
+        self.struct = struct.Struct("<4s" + "".join(fmt for _, fmt in fields))
+        self.tail = tail
+        self.description = description
+
+        registry[self.tag] = self
+
+    def __repr__(self):
+        return f"Packet({str(self.tag, 'ascii')!r})"
+
+    def __str__(self):
+        return str(self.tag, "ascii")
+
+    def unpack(self, data):
+        """Decode fields of a whole packet (tag included), plus the tail if any"""
+        if self.tail:
+            return self.struct.unpack_from(data)[1:] + (data[self.struct.size :],)
+        # struct checks the length for us
+        return self.struct.unpack(data)[1:]
+
+    def pack(self, *values, tail=b""):
+        """Encode a whole packet from its field values, and optional tail"""
+        if tail:
+            return self.struct.pack(self.tag, *values) + tail
+        return self.struct.pack(self.tag, *values)
+
+    def pack_parts(self, values, parts):
+        """Encode a whole packet from its field values and a list of tail pieces, joined all at once"""
+        return b"".join([self.struct.pack(self.tag, *values), *parts])
+
+    def format(self, values):
+        """Return a printable name=value summary of unpacked fields, for logging"""
+        return ", ".join(f"{name}={value}" for name, value in zip(self.names, values))
+
+
+# shorthand for the common fields
+I = "I"
+BLOCK = "4s"
+
+# #############################################################################
+# Launcher requests and replies
+LAHI = Packet("LAHI", description="launcher info request")
+laHI = Packet("laHI", tail=True, description="launcher info: server description string")
+
+LAUP = Packet("LAUP", tail=True, description="launcher login: username and password strings")
+laOK = Packet("laOK", [("length", I)], tail=True, description="login accepted: token")
+laNO = Packet("laNO", [("length", I)], tail=True, description="login denied: reason")
+
+# #############################################################################
+# Game requests from the client
+DSIT = Packet("DSIT", tail=True, description="TEN Init: login token string")
+DSLG = Packet("DSLG", tail=True, description="client log upload string")
+DSSL = Packet("DSSL", description="ping")
+DSNS = Packet("DSNS", [("slot", I)], description="select character slot")
+DSPS = Packet(
+    "DSPS",
+    [("perm_id", I), ("type", I), ("x", I), ("y", I), ("region", I)],
+    description="set position",
+)
+DSDT = Packet("DSDT", [("perm_id", I)], description="host date request")
+DSRS = Packet("DSRS", [("perm_id", I), ("slot", I)], description="read seed")
+DSRL = Packet("DSRL", [("perm_id", I), ("slot", I)], description="roll dice")
+DSNM = Packet("DSNM", [("slot", I)], tail=True, description="is this name OK?")
+DSRI = Packet("DSRI", [("perm_id", I), ("region", I)], description="region info request")
+DSRD = Packet(
+    "DSRD",
+    [
+        ("perm_id", I),
+        ("block", BLOCK),
+        ("index1", I),
+        ("index2", I),
+        ("addr", I),
+        ("len", I),
+    ],
+    description="read memory block",
+)
+DSWQ = Packet(
+    "DSWQ",
+    [
+        ("perm_id", I),
+        ("block", BLOCK),
+        ("index1", I),
+        ("index2", I),
+        ("key", I),
+        ("addr", I),
+        ("len", I),
+    ],
+    tail=True,
+    description="write shared memory (GLOB / GLRG)",
+)
+DSWT = Packet(
+    "DSWT",
+    [
+        ("perm_id", I),
+        ("block", BLOCK),
+        ("index1", I),
+        ("index2", I),
+        ("key", I),
+        ("addr", I),
+        ("len", I),
+    ],
+    tail=True,
+    description="write player memory (PCSA, PCIN, PCOU, PCQK)",
+)
+
+# #############################################################################
+# Game replies from the server
+dsIN = Packet(
+    "dsIN",
+    [("perm_id", I), ("perm0", "B"), ("perm1", "B"), ("perm2", "B"), ("perm3", "B")],
+    tail=True,
+    description="player info: selected name, 4 slot flags + names, process ID",
+)
+dsNI = Packet("dsNI", description="account still logged on")
+dsSL = Packet("dsSL", [("time", I)], description="ping reply")
+dsPS = Packet(
+    "dsPS",
+    [("perm_id", I), ("count", I)],
+    tail=True,
+    description="positions: count entries laid out like DSPS",
+)
+dsDT = Packet("dsDT", [("seconds", I), ("days", I)], description="host date")
+dsRS = Packet("dsRS", [("perm_id", I), ("slot", I), ("seed", I)], description="seed")
+dsRL = Packet("dsRL", [("perm_id", I), ("slot", I), ("seed", I)], description="dice roll")
+dsNM = Packet("dsNM", [("slot", I)], tail=True, description="name accepted")
+dsRI = Packet(
+    "dsRI",
+    [("perm_id", I), ("region", I), ("count", "i")],
+    tail=True,
+    description="region info: negative count, then that many perm_ids",
+)
+dsRD = Packet(
+    "dsRD",
+    [
+        ("perm_id", I),
+        ("block", BLOCK),
+        ("index1", I),
+        ("index2", I),
+        ("key", I),
+        ("addr", I),
+        ("len", I),
+    ],
+    tail=True,
+    description="memory block contents",
+)
+dsWT = Packet(
+    "dsWT",
+    [
+        ("perm_id", I),
+        ("block", BLOCK),
+        ("index1", I),
+        ("index2", I),
+        ("key", I),
+        ("len", I),
+    ],
+    description="write OK",
+)
+dsWE = Packet(
+    "dsWE",
+    [
+        ("perm_id", I),
+        ("block", BLOCK),
+        ("index1", I),
+        ("index2", I),
+        ("key", I),
+        ("len", I),
+    ],
+    description="write error",
+)
+dsCL = Packet("dsCL", [("perm_id", I)], description="close connection")
+
+# one entry of a dsPS position list
+position = struct.Struct("<5I")
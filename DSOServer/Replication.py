@@ -0,0 +1,414 @@
+"""Hot-standby replication: a primary server streams its writes to follower processes, ready to take over"""
+
+import os
+import pickle
+import selectors
+import socket
+import struct
+from logging import getLogger
+from queue import SimpleQueue
+from sys import stdin
+from threading import Lock, Thread
+from time import monotonic, time
+
+from .Database import DatabaseThread
+from .Journal import entries
+from .Metrics import http_response
+from .State import State
+
+logger = getLogger(__name__)
+
+# message header: kind, payload length
+header = struct.Struct("<BI")
+# the world to start from: pickled get_world() lists, with the primary's memory laid over them
+SNAPSHOT = 1
+# journal entries (see Journal.entry), as committed
+ENTRIES = 2
+# the primary's time(), sent every HEARTBEAT seconds, so lag can be told even when nothing is written
+BEAT = 3
+beat = struct.Struct("<d")
+
+HEARTBEAT = 1.0
+# bytes a follower may fall behind by before it is dropped (to start over when it reconnects)
+MAX_QUEUED = 64 << 20
+
+
+def parse_address(text):
+    """host:port for TCP, or a path for a Unix socket"""
+    host, _, port = text.rpartition(":")
+    if port.isdigit():
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, text
+
+
+def memory_rows(state):
+    """Copies of every page a State holds in memory, as get_world() row lists (without logins)"""
+    glob = [(key, page, data) for key, block in state.glob.items() for page, data in block.present()]
+    glrg = [
+        (region, key, page, data)
+        for region, blocks in state.glrg.items()
+        for key, block in blocks.items()
+        for page, data in block.present()
+    ]
+    players = [*state.players.values(), *(player for player, _ in state.retired.values())]
+    player = [(p.id, key, page, data) for p in players for key, block in p.data.items() for page, data in block.present()]
+    return glob, glrg, player
+
+
+def merge(saved, memory):
+    """Rows from the database, replaced by any of the same page from memory"""
+    rows = {tuple(row[:-1]): row[-1] for row in saved}
+    rows.update((tuple(row[:-1]), row[-1]) for row in memory)
+    return [(*keys, data) for keys, data in rows.items()]
+
+
+class Link:
+    """
+    One follower's connection to the primary.  Messages are queued by the server loop and sent by a
+    thread of its own, so a slow follower never holds up the loop; one that falls too far behind is
+    dropped instead.
+    """
+
+    __slots__ = "socket", "name", "queue", "queued", "lock", "alive", "thread"
+
+    def __init__(self, sock, name):
+        self.socket = sock
+        self.name = name
+        # (kind, payload), or None to finish
+        self.queue = SimpleQueue()
+        # bytes queued and not yet sent, added to by the loop and taken from by the sender, under lock
+        self.queued = 0
+        self.lock = Lock()
+        self.alive = True
+        self.thread = Thread(target=self.run, name=f"replication to {name}", daemon=True)
+        self.thread.start()
+
+    def put(self, kind, payload):
+        with self.lock:
+            behind = self.queued > MAX_QUEUED
+            if not behind:
+                self.queued += len(payload)
+        if behind:
+            logger.warning("Follower %s is too far behind, dropping it", self.name)
+            self.alive = False
+            self.queue.put(None)
+            return
+        self.queue.put((kind, payload))
+
+    def run(self):
+        try:
+            while item := self.queue.get():
+                kind, payload = item
+                size = len(payload)
+                if kind == SNAPSHOT:
+                    # the database's part was only asked for, and is read on its thread meanwhile
+                    saved, memory = payload
+                    logins, *tables = saved.result()
+                    payload = pickle.dumps(
+                        (logins, *(merge(rows, extra) for rows, extra in zip(tables, memory))),
+                        pickle.HIGHEST_PROTOCOL,
+                    )
+                self.socket.sendall(header.pack(kind, len(payload)))
+                self.socket.sendall(payload)
+                with self.lock:
+                    self.queued -= size
+        except OSError as e:
+            logger.info("Lost follower %s: %s", self.name, e)
+        finally:
+            self.alive = False
+            self.socket.close()
+
+
+class Primary:
+    """
+    Streams a server's writes to followers, which connect to address (see parse_address).
+
+    A follower that connects is sent a snapshot of the world as it is at that moment (the database,
+    read in turn after every save before it, overlaid with everything in memory), then every batch
+    of writes the Journal commits after it, and a heartbeat every HEARTBEAT seconds.  Followers are
+    taken on by a timer on the server loop, so the snapshot and the stream line up with no locking.
+    """
+
+    __slots__ = "family", "address", "listener", "links", "state"
+
+    def __init__(self, address):
+        self.family, self.address = address
+        self.listener = None
+        self.links = []
+        self.state = None
+
+    def start(self, state):
+        """Listen for followers of state"""
+        self.state = state
+        if self.family == socket.AF_UNIX:
+            if os.path.exists(self.address):
+                os.remove(self.address)
+            self.listener = socket.socket(socket.AF_UNIX)
+            self.listener.bind(self.address)
+            self.listener.listen()
+        else:
+            self.listener = socket.create_server(self.address)
+        self.listener.setblocking(False)
+        logger.info(f"Replicating to followers at {self.address}")
+        state.timers.every(HEARTBEAT, self.tick)
+
+    def tick(self):
+        """Take on followers that have connected, and send everyone a heartbeat"""
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except BlockingIOError:
+                break
+            sock.setblocking(True)
+            link = Link(sock, addr or self.address)
+            logger.info("Follower %s connected, sending it a snapshot", link.name)
+            link.put(SNAPSHOT, (self.state.database.submit("get_world"), memory_rows(self.state)))
+            self.links.append(link)
+
+        self.links = [link for link in self.links if link.alive]
+        self.publish(beat.pack(time()), BEAT)
+
+    def publish(self, data, kind=ENTRIES):
+        """Send data to every follower.  It must not be changed after this."""
+        for link in self.links:
+            link.put(kind, data)
+
+    def report(self):
+        """Return a printable summary of the followers"""
+        queued = sum(link.queued for link in self.links)
+        return f"replication: {len(self.links)} followers, {queued} bytes queued"
+
+    def close(self):
+        """Send the followers what is left, and hang up"""
+        for link in self.links:
+            link.queue.put(None)
+        for link in self.links:
+            link.thread.join(5)
+        self.links = []
+        if self.listener:
+            self.listener.close()
+            if self.family == socket.AF_UNIX and os.path.exists(self.address):
+                os.remove(self.address)
+
+
+class Follower:
+    """
+    Keeps a copy of a primary's world in its own State and database, from the primary's stream.
+
+    Runs its own loop, much like Server: the stream is applied as it arrives, and the State
+    checkpoints to the database as usual.  Without a primary, it tries to connect again every
+    second, unless promote_on_loss is set: then (or on the console's "promote") run() saves
+    everything and returns True, and the caller serves the world from the database.
+
+    lag is how far behind the primary the copy was when the last message was applied, in seconds;
+    behind() is how long ago the primary last sent it, as of now.
+    """
+
+    __slots__ = (
+        "family",
+        "address",
+        "database",
+        "db_thread",
+        "metrics_port",
+        "promote_on_loss",
+        "console",
+        "state",
+        "socket",
+        "buffer",
+        "sel",
+        "sock_metrics",
+        "retry",
+        "newest",
+        "lag",
+        "applied",
+        "received",
+        "snapshots",
+        "running",
+        "promote",
+    )
+
+    def __init__(self, address, database, metrics_port=None, promote_on_loss=False, console=True):
+        self.family, self.address = address
+        self.database = database
+        self.db_thread = None
+        self.metrics_port = metrics_port
+        self.promote_on_loss = promote_on_loss
+        self.console = console
+
+        # created from the first snapshot
+        self.state = None
+        # the primary, while connected, and what it has sent that isn't a whole message yet
+        self.socket = None
+        self.buffer = bytearray()
+        self.sel = None
+        self.sock_metrics = None
+        # when to next try to connect
+        self.retry = 0.0
+        # the primary's time as of the last message applied, and how far behind that was
+        self.newest = None
+        self.lag = 0.0
+        # counts, for metrics
+        self.applied = 0
+        self.received = 0
+        self.snapshots = 0
+        self.running = False
+        self.promote = False
+
+    def connect(self):
+        self.retry = monotonic() + HEARTBEAT
+        sock = socket.socket(self.family)
+        try:
+            sock.connect(self.address)
+        except OSError as e:
+            sock.close()
+            logger.debug("Can't reach the primary at %s: %s", self.address, e)
+            return
+        logger.info(f"Following the primary at {self.address}")
+        sock.setblocking(False)
+        self.socket = sock
+        self.buffer = bytearray()
+        self.sel.register(sock, selectors.EVENT_READ, self.on_primary)
+
+    def lost(self):
+        logger.warning("Lost the primary")
+        self.sel.unregister(self.socket)
+        self.socket.close()
+        self.socket = None
+        if self.promote_on_loss and self.state:
+            self.promote = True
+            self.running = False
+
+    def on_primary(self, mask):
+        try:
+            data = self.socket.recv(0x10000)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.lost()
+            return
+        self.received += len(data)
+        self.buffer += data
+
+        offset = 0
+        while len(self.buffer) - offset >= header.size:
+            kind, length = header.unpack_from(self.buffer, offset)
+            end = offset + header.size + length
+            if end > len(self.buffer):
+                break
+            self.apply(kind, bytes(self.buffer[offset + header.size : end]))
+            offset = end
+        del self.buffer[:offset]
+
+    def apply(self, kind, payload):
+        if kind == SNAPSHOT:
+            # start over from the primary's world: whatever was here is replaced, not saved
+            self.state = None
+            self.db_thread.replace_world(*pickle.loads(payload))
+            self.state = State(self.db_thread)
+            self.snapshots += 1
+            logger.info("Loaded a snapshot from the primary")
+        elif kind == ENTRIES:
+            for timestamp, block, index1, index2, addr, data, version in entries(payload):
+                self.state.apply(block, index1, index2, addr, data)
+                self.applied += 1
+            self.newest = timestamp
+        elif kind == BEAT:
+            (self.newest,) = beat.unpack(payload)
+        if self.newest is not None:
+            self.lag = max(0.0, time() - self.newest)
+
+    def behind(self):
+        """Seconds since the newest thing the primary sent was made, or None before it has sent anything"""
+        return None if self.newest is None else max(0.0, time() - self.newest)
+
+    def report(self):
+        """Return a list of printable lines about the replication"""
+        behind = self.behind()
+        return [
+            f"following {self.address} ({'connected' if self.socket else 'not connected'}), "
+            f"{self.snapshots} snapshots, {self.applied} writes applied, {self.received} bytes received",
+            f"lag {self.lag * 1000:.1f} ms, primary last heard from "
+            + ("never" if behind is None else f"{behind:.1f} s ago"),
+        ]
+
+    def prometheus(self):
+        behind = self.behind()
+        lines = []
+        for name, kind, help, value in (
+            ("replication_connected", "gauge", "Whether the primary is connected", int(bool(self.socket))),
+            ("replication_lag_seconds", "gauge", "How far behind the primary the last message applied was", self.lag),
+            ("replication_behind_seconds", "gauge", "Seconds since the newest message from the primary was made", -1 if behind is None else behind),
+            ("replication_writes_total", "counter", "Writes applied from the primary", self.applied),
+            ("replication_received_bytes_total", "counter", "Bytes received from the primary", self.received),
+            ("replication_snapshots_total", "counter", "Snapshots loaded from the primary", self.snapshots),
+        ):
+            lines += [f"# HELP dso_{name} {help}", f"# TYPE dso_{name} {kind}", f"dso_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def on_console(self, mask):
+        line = stdin.readline()
+        if not line:
+            self.sel.unregister(stdin)
+            return
+        line = line.strip()
+        if line == "exit" or line == "quit":
+            self.running = False
+        elif line == "promote":
+            if self.state:
+                self.promote = True
+                self.running = False
+            else:
+                print("Nothing to serve yet: no snapshot from the primary")
+        elif line == "metrics":
+            for report_line in self.report():
+                print(report_line)
+
+    def on_metrics_accept(self, mask):
+        conn, addr = self.sock_metrics.accept()
+        try:
+            conn.settimeout(1)
+            conn.recv(0x1000)
+            conn.sendall(http_response(self.prometheus()))
+        except OSError:
+            pass
+        conn.close()
+
+    def run(self):
+        """Follow the primary until stopped.  Returns True if this should now serve the world."""
+        self.sel = selectors.DefaultSelector()
+        self.db_thread = DatabaseThread(self.database)
+        if self.console:
+            self.sel.register(stdin, selectors.EVENT_READ, self.on_console)
+        if self.metrics_port:
+            self.sock_metrics = socket.create_server(("127.0.0.1", self.metrics_port))
+            self.sel.register(self.sock_metrics, selectors.EVENT_READ, self.on_metrics_accept)
+
+        self.running = True
+        while self.running:
+            if not self.socket and monotonic() >= self.retry:
+                self.connect()
+            timeout = self.retry - monotonic() if not self.socket else None
+            if self.state:
+                due = self.state.timers.timeout()
+                if due is not None and (timeout is None or due < timeout):
+                    timeout = due
+            for key, mask in self.sel.select(None if timeout is None else max(0.0, timeout)):
+                key.data(mask)
+                if not self.running:
+                    break
+            if self.state:
+                self.state.timers.run()
+
+        if self.socket:
+            self.socket.close()
+        if self.sock_metrics:
+            self.sock_metrics.close()
+        self.sel.close()
+        if self.state:
+            self.state.close()
+        self.db_thread.close()
+        if self.promote:
+            logger.info("Promoted: taking over from the primary")
+        return self.promote
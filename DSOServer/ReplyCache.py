@@ -0,0 +1,85 @@
+"""Encoded replies to reads of shared memory, kept for as long as the memory is unchanged"""
+
+# perm_id a cached reply is encoded with, patched over for each requester.  With no zero bytes, it
+#  can't be part of an RLE zero run, so it is found at the same place in every encoding of a reply.
+PLACEHOLDER_ID = 0xFFFFFFFF
+PLACEHOLDER = PLACEHOLDER_ID.to_bytes(4, "little")
+# where a reply's perm_id is: right after the tag, and after the first RLE control byte if compressed
+OFFSET = 4
+COMPRESSED_OFFSET = 5
+# rough bytes of bookkeeping per entry, on top of its buffers
+ENTRY_OVERHEAD = 200
+
+
+class ReplyCache:
+    """
+    A bounded LRU of fully encoded dsRD replies to GLOB and GLRG reads.
+
+    Many players in a region read the same blocks, and most reads find them unchanged since the
+    last time.  Entries are keyed by (block, index1, index2, addr, len, version), where version
+    changes with every write to the block (see Memory.Block), so an entry can never be out of
+    date: writes make new keys, and the old entries age out of the LRU.
+
+    Each entry is (packet, frame header, payload, offset of the perm_id in payload).  The packet is
+    kept whole as well as compressed, for whatever is watching the raw traffic (Capture, Metrics).
+    """
+
+    __slots__ = "entries", "max_bytes", "bytes", "hits", "misses"
+
+    def __init__(self, max_bytes=8 << 20):
+        # key => entry, least recently used first
+        self.entries = {}
+        self.max_bytes = max_bytes
+        # memory held by entries, approximately
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the entry for key, or None"""
+        try:
+            entry = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def put(self, key, packet, header, payload):
+        """
+        Keep an encoded reply, made with PLACEHOLDER_ID for its perm_id, and return its entry.  It isn't
+        kept if it's too big for the cache at all.
+        """
+        offset = COMPRESSED_OFFSET if header[1] & 0x80 else OFFSET
+        assert payload[offset : offset + 4] == PLACEHOLDER
+        entry = (packet, header, payload, offset)
+        size = cost(packet, payload)
+        if size > self.max_bytes:
+            return entry
+        old = self.entries.pop(key, None)
+        if old:
+            self.bytes -= cost(old[0], old[2])
+
+        self.entries[key] = entry
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            packet, _, payload, _ = self.entries.pop(next(iter(self.entries)))
+            self.bytes -= cost(packet, payload)
+        return entry
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def cost(packet, payload):
+    """Memory held by an entry"""
+    return ENTRY_OVERHEAD + len(packet) + (0 if payload is packet else len(payload))
+
+
+def patch(buffer, offset, perm_id):
+    """A copy of a cached buffer with the requester's perm_id in place of the placeholder"""
+    result = bytearray(buffer)
+    result[offset : offset + 4] = perm_id.to_bytes(4, "little")
+    return result
@@ -1,16 +1,31 @@
 import selectors
 import socket
+from collections import deque
 from datetime import datetime
-from logging import getLogger
+from logging import DEBUG, getLogger
 from os import getpid
-from time import time
+from time import perf_counter, time
 from sys import stdin
 
-from .Compression import RLECompress, RLEUncompress, DecodeString, EncodeString, i32
+from . import Capture, Packets
+from .Compression import CompressionPolicy, RLEDecoder, DecodeString, EncodeString, i32
+from .Database import DatabaseThread
+from .Metrics import Metrics, http_response
+from .Multicast import Multicast, encode
+from .ReplyCache import OFFSET, PLACEHOLDER_ID, patch
 from .State import State
 
 logger = getLogger(__name__)
 
+# scatter-gather writes where the platform has them (not Windows)
+_sendmsg = hasattr(socket.socket, "sendmsg")
+try:
+    from os import sysconf
+
+    IOV_MAX = sysconf("SC_IOV_MAX")
+except (ImportError, ValueError, OSError):
+    IOV_MAX = 16
+
 
 # helper funcs
 def to_printable_ascii(byte):
@@ -27,602 +42,1068 @@ def hexdump(data: bytes):
         offset += 16
 
 
-def buildSlotResults(state, perm_id):
+def buildSlotResults(player):
     # 'dsIN', 4 bytes myPermId, 4x1 byte slot permission levels
     # perm. id >= 0x80000000 gives "No host response"
-    player = state.players[perm_id]
-
-    response = bytes("dsIN", "ascii") + i32(perm_id)
-    for i in range(4):
-        response += bytes([player.slots["perm"][i]])
 
     # currently selected name
-    response += EncodeString(player.slots["name"][player.slots["slot"]])
+    parts = [EncodeString(player.slots["name"][player.slots["slot"]])]
 
     # all 4 player names w/ flag
     for i in range(4):
-        response += i32(player.slots["flag"][i]) + EncodeString(player.slots["name"][i])
+        parts.append(i32(player.slots["flag"][i]))
+        parts.append(EncodeString(player.slots["name"][i]))
 
     # "Process ID"
-    response += i32(getpid())
+    parts.append(i32(getpid()))
 
     # self.logger.debug("Sending TEN Init response")
-    # hexdump(response)
-    return response
+    # hexdump(b"".join(parts))
+    return Packets.dsIN.pack_parts((player.id, *player.slots["perm"]), parts)
+
+
+# packet handlers, keyed by raw 4-byte tag: (Packet, Connection method)
+handlers = {}
+
+
+def handles(packet):
+    """Decorator that binds a Connection method as the handler for a Packet"""
+
+    def register(func):
+        handlers[packet.tag] = (packet, func)
+        return func
+
+    return register
+
+
+def console(line, server):
+    """Run one sysop console command.  Returns False if the server should shut down."""
+    line = line.strip()
+    if line == "exit" or line == "quit":
+        return False
+    elif line == "compression":
+        for report_line in server.policy.report():
+            print(report_line)
+    elif line == "metrics":
+        for report_line in server.metrics.report(server.state, server.connection_count()):
+            print(report_line)
+    elif line == "broadcast" or line.startswith("broadcast "):
+        # broadcast [region <n>] <tag> <message>
+        #  The client has broadcast / narrate / chat handlers, but their layouts aren't known yet,
+        #  so the sysop names the tag and the message goes after it as a string.
+        words = line.split(maxsplit=4)
+        if len(words) > 3 and words[1] == "region" and words[2].isdigit():
+            targets = server.multicast.region(server.state, int(words[2]))
+            words = words[3:]
+        else:
+            targets = server.multicast.everyone()
+            words = line.split(maxsplit=2)[1:]
+        if len(words) != 2 or len(words[0]) != 4 or not words[0].isascii():
+            print("usage: broadcast [region <n>] <tag> <message>")
+        else:
+            server.multicast.send(bytes(words[0], "ascii") + EncodeString(words[1]), targets)
+            server.flush()
+            print(f"Sent to {len(targets)} players")
+
+    # other things can go here e.g. drop player, etc
+    return True
+
+
+# most dsPS entries that fit in one packet
+MAX_POSITIONS = (0x7FFF - 2 - Packets.dsPS.struct.size) // Packets.position.size
+
+
+def send_positions(state):
+    """Send everyone the position updates near them since the last tick.  Returns the Connections that fell too far behind."""
+    failed = []
+    for c, entries in state.interest.tick().items():
+        for i in range(0, len(entries), MAX_POSITIONS):
+            chunk = entries[i : i + MAX_POSITIONS]
+            if not c.send(Packets.dsPS.pack_parts((c.player.id, len(chunk)), chunk)):
+                failed.append(c)
+                break
+    return failed
 
 
 # A Connection class handles connection to a client
 #  Provides method to read and write - when a complete packet is "read", it takes game action
 class Connection:
-    __slots__ = "socket", "buf", "len", "compressed", "player"
-
-    def __init__(self, socket):
+    __slots__ = (
+        "socket",
+        "policy",
+        "buf",
+        "view",
+        "start",
+        "end",
+        "decoder",
+        "outgoing",
+        "queued",
+        "pending",
+        "high_water",
+        "writing",
+        "player",
+        "metrics",
+        "multicast",
+        "waiting",
+    )
+
+    def __init__(
+        self, socket, policy, pending, high_water=0x100000, metrics=None, multicast=None
+    ):
         self.socket = socket
 
-        # buffers for the incoming packet read
-        self.buf = bytearray()
-        self.len = 0
-        self.compressed = False
+        # shared decision-maker for which outgoing packets to compress
+        self.policy = policy
+
+        # receive buffer: reads go in at end, packets are taken out from start.
+        #  Packets are at most 0x7FFF bytes, so this always has room for a whole one.
+        #  Handlers are given memoryviews into it, so must not hold on to them.
+        self.buf = bytearray(0x10000)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        # compressed packets are decoded as they arrive, instead of buffered first
+        self.decoder = None
+
+        # outgoing buffers not yet written, and their total length
+        self.outgoing = []
+        self.queued = 0
+        # server-wide set of Connections with something queued, to flush at end of the loop
+        self.pending = pending
+        # queued bytes past which the client is dropped
+        self.high_water = high_water
+        # whether the server is waiting on EVENT_WRITE for us
+        self.writing = False
 
         # tracks a player object which can be saved / loaded
         self.player = None
 
-    def handle(self, data, state):
-        # check tag (first 4 bytes) of payload
-        id, payload = str(data[0:4], "ascii"), data[4:]
-
-        # logger.debug("Packet received (id=%s, payload=%s)", id, payload)
-
-        # ###############
-        # The two supported Launcher commands
-        if id == "LAHI":
-            logger.debug("Received launcher info request")
-
-            # TODO: replace this with a user-configurable message
-            info = f"==TEN TWO==\r\n\r\nDevelopment DSO server at greg-kennedy.com\r\nTotal players online: {len(state.players)}"
+        # server-wide Metrics to count traffic in, if any
+        self.metrics = metrics
+        # server-wide Multicast to be reachable through once logged in, if any
+        self.multicast = multicast
 
-            response = bytes("laHI", "ascii") + EncodeString(info)
+        # (Future, method, args) to carry on with when a database request is done, if waiting on one.
+        #  No more packets are handled until then.
+        self.waiting = None
 
-            return self.send(response, False)
-
-        elif id == "LAUP":
-            logger.debug("Received launcher username/password request")
-
-            # TODO: replace this with calls to DecodeString
-            user_len = int.from_bytes(payload[0:4], byteorder="little")
-            assert payload[4 + user_len - 1] == 0
-            username = str(payload[4 : 4 + user_len - 1], "ascii")
-
-            pass_len = int.from_bytes(
-                payload[4 + user_len : 4 + user_len + 4], byteorder="little"
-            )
-            assert payload[4 + user_len + 4 + pass_len - 1] == 0
-            password = str(
-                payload[4 + user_len + 4 : 4 + user_len + 4 + pass_len - 1], "ascii"
+    def handle(self, data, state):
+        # look up the packet layout and handler by tag (first 4 bytes) of payload
+        try:
+            packet, handler = handlers[bytes(data[0:4])]
+        except KeyError:
+            if self.metrics:
+                self.metrics.unknown += 1
+            logger.debug(
+                "Packet received (len=%d, id=%s, payload=%s)",
+                len(data) - 4,
+                data[0:4],
+                data[4:],
             )
+            hexdump(data[4:])
+            logger.debug("Ignoring packet")
+            return True
 
-            # Check login against state db
-            token = state.get_login_token(username, password)
-            if not token:
-                logger.debug(" . Denying login")
-                ok = "laNO"
-                msg = "Invalid username or password.\0"
-            else:
-                # username and password look good!  create a login token
-                #  and put it in the state for later handoff.
-                logger.debug(" . Accepting login, issuing token (token=%s)", token)
-                ok = "laOK"
-                msg = token + "\0"
-
-            response = bytes(ok, "ascii") + i32(len(msg)) + bytes(msg, "ascii")
-            return self.send(response, False)
+        fields = packet.unpack(data)
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("Packet received (id=%s, %s)", packet, packet.format(fields))
+        if self.metrics:
+            start = perf_counter()
+            result = handler(self, state, *fields)
+            self.metrics.handled(packet.tag, len(data), perf_counter() - start)
+            return result
+        return handler(self, state, *fields)
+
+    def wait_for(self, state, future, then, *args):
+        """Finish handling a packet with then(state, result, *args) once a Future is done.  The server calls resume()."""
+        if future.done():
+            return then(state, future.result(), *args)
+        self.waiting = (future, then, args)
+        return True
 
-        #### GAME COMMANDS
-        elif id == "DSIT":
-            # TEN Init
-            token = DecodeString(payload)
-            logger.debug("Received TEN Init packet (token=%s)", token)
+    def resume(self, state):
+        """Carry on after the Future being waited on is done.  Returns False if the client should be dropped."""
+        future, then, args = self.waiting
+        self.waiting = None
+        if not then(state, future.result(), *args):
+            return False
+        # then any packets that arrived in the meantime
+        return self.waiting is not None or self.process(state)
 
-            # if you close the socket after receiving this packet without responding,
-            #  the remote reports this as "Account still logged on".
+    # ###############
+    # The two supported Launcher commands
+    @handles(Packets.LAHI)
+    def on_launcher_info(self, state):
+        logger.debug("Received launcher info request")
 
-            perm_id = state.return_login_token(token)
+        # TODO: replace this with a user-configurable message
+        info = f"==TEN TWO==\r\n\r\nDevelopment DSO server at greg-kennedy.com\r\nTotal players online: {state.player_count()}"
 
-            if perm_id:
-                logger.debug(" . Got valid login token (perm_id=%s)", perm_id)
+        return self.send(Packets.laHI.pack(tail=EncodeString(info)), False)
 
-                if perm_id in state.players:
-                    # player is already logged in!
-                    return self.send(bytes("dsNI", "ascii"), False)
+    @handles(Packets.LAUP)
+    def on_launcher_login(self, state, payload):
+        logger.debug("Received launcher username/password request")
 
-                self.player = state.add_player(perm_id)
-                return self.send(buildSlotResults(state, perm_id))
-            else:
-                logger.debug(" . Invalid login token, disconnecting")
-                # Login error, kill client
-                return False
+        user_len = 4 + int.from_bytes(payload[0:4], byteorder="little")
+        username = DecodeString(payload[:user_len])
+        password = DecodeString(payload[user_len:])
 
-        elif id == "DSLG":
-            # client uploading logs to us
-            #  the format is: 4 bytes string length, null-terminated ASCII string
-            msg = DecodeString(payload)
-            logger.debug("Received client log: %s", msg)
+        # Check login against state db, the reply goes when it answers
+        return self.wait_for(state, state.login(username, password), self.on_login_checked)
 
-            # no response to this
-            return True
-
-        elif id == "DSSL":
-            assert len(payload) == 0
-            logger.info("Received client ping")
-
-            response = bytes("dsSL", "ascii") + i32(int(time()))
-            return self.send(response)
+    def on_login_checked(self, state, id):
+        token = state.issue_token(id) if id else None
+        if not token:
+            logger.debug(" . Denying login")
+            ok = Packets.laNO
+            msg = "Invalid username or password.\0"
+        else:
+            # username and password look good!  create a login token
+            #  and put it in the state for later handoff.
+            logger.debug(" . Accepting login, issuing token (token=%s)", token)
+            ok = Packets.laOK
+            msg = token + "\0"
 
-        elif id == "DSNS":
-            # Client name selection - they want to change the current Slot
-            assert len(payload) == 4
-            slot_id = int.from_bytes(payload[0:4], byteorder="little")
-            logger.info("Received New Slot Choice: %d", slot_id)
-
-            self.player.slots["slot"] = slot_id
-
-            # give back the player info struct again
-            return self.send(buildSlotResults(state, self.player.id))
-
-        elif id == "DSPS":
-            # Client "set position"
-            assert len(payload) == 20
-            perm_id = int.from_bytes(payload[0:4], byteorder="little")
-            unknown = int.from_bytes(payload[4:8], byteorder="little")
-            x = int.from_bytes(payload[8:12], byteorder="little")
-            y = int.from_bytes(payload[12:16], byteorder="little")
-            reg = int.from_bytes(payload[16:20], byteorder="little")
-            logger.info(
-                "Received Set Position for %d (type %d): (x=%d, y=%d, reg=%d)",
-                perm_id,
-                unknown,
-                x,
-                y,
-                reg,
-            )
+        return self.send(ok.pack(len(msg), tail=bytes(msg, "ascii")), False)
 
-            self.player.set_position(x, y, reg)
-
-            # the "response" is a collected list of positions, where "1" is the count and then the payloads are from each other packet
-            response = (
-                bytes("dsPS", "ascii")
-                + i32(perm_id)
-                + i32(1)
-                + i32(perm_id)
-                + i32(unknown)
-                + i32(x)
-                + i32(y)
-                + i32(reg)
-            )
-            return self.send(response)
+    #### GAME COMMANDS
+    @handles(Packets.DSIT)
+    def on_ten_init(self, state, payload):
+        # TEN Init
+        token = DecodeString(payload)
+        logger.debug("Received TEN Init packet (token=%s)", token)
 
-        elif id == "DSDT":
-            # Client requesting Host Date
-            assert len(payload) == 4
-            perm_id = int.from_bytes(payload[0:4], byteorder="little")
-            logger.info("Received Host Date req from %d", perm_id)
-
-            # calculate days and seconds since Jan. 1 of this year
-            #  TODO: this may be incorrect, it might be days since epoch, or seconds since, etc
-            now = datetime.now()
-            epoch = now.replace(
-                month=1, day=1, hour=0, minute=0, second=0, microsecond=0
-            )
-            diff = now - epoch
+        # if you close the socket after receiving this packet without responding,
+        #  the remote reports this as "Account still logged on".
 
-            response = bytes("dsDT", "ascii") + i32(diff.seconds) + i32(diff.days)
-            return self.send(response)
+        perm_id = state.return_login_token(token)
 
-        elif id == "DSRS":
-            # Client making a "Read Seed" request
-            assert len(payload) == 8
-            perm_id = int.from_bytes(payload[0:4], byteorder="little")
-            slot_id = int.from_bytes(payload[4:8], byteorder="little")
-            logger.info("Received 'Read Seed' (%d) request from %d", slot_id, perm_id)
-
-            response = (
-                bytes("dsRS", "ascii")
-                + i32(perm_id)
-                + i32(slot_id)
-                + i32(self.player.slots["seed"][slot_id])
-            )
-            return self.send(response)
+        if perm_id:
+            logger.debug(" . Got valid login token (perm_id=%s)", perm_id)
 
-        elif id == "DSRL":
-            # Client making a "Roll Dice" request
-            assert len(payload) == 8
-            perm_id = int.from_bytes(payload[0:4], byteorder="little")
-            slot_id = int.from_bytes(payload[4:8], byteorder="little")
-            logger.info("Received 'Roll Dice' request from %d:%d", perm_id, slot_id)
-
-            response = (
-                bytes("dsRL", "ascii")
-                + i32(perm_id)
-                + i32(slot_id)
-                + i32(self.player.inc_seed(slot_id))
+            # their saved data comes from the db, the reply goes when it's loaded
+            return self.wait_for(
+                state, state.load_player(perm_id), self.on_player_loaded, perm_id
             )
-            return self.send(response)
+        else:
+            logger.debug(" . Invalid login token, disconnecting")
+            # Login error, kill client
+            return False
 
-        elif id == "DSNM":
-            # Client checking if desired name is OK.
-            slot_id = int.from_bytes(payload[0:4], byteorder="little")
-            name = DecodeString(payload[4:])
-            logger.info("Received 'Name OK?' request, slot=%d name=%s", slot_id, name)
+    def on_player_loaded(self, state, data, perm_id):
+        self.player = state.add_player(perm_id, data)
+        if not self.player:
+            # player is already logged in!
+            return self.send(Packets.dsNI.pack(), False)
 
-            # TODO: We always approve names now, but it would be good to know
-            #  which packet indicates "name no good" (dsNO?  dsNR?)
-            self.player.slots["name"][slot_id] = name
+        if self.multicast:
+            self.multicast.join(self)
+        return self.send(buildSlotResults(self.player))
 
-            # the client also complains if you ack a 0-byte name, so we should not do that either
-            response = bytes("dsNM", "ascii") + i32(slot_id) + EncodeString(name)
-            return self.send(response)
+    @handles(Packets.DSLG)
+    def on_log(self, state, payload):
+        # client uploading logs to us
+        #  the format is: 4 bytes string length, null-terminated ASCII string
+        msg = DecodeString(payload)
+        logger.debug("Received client log: %s", msg)
 
-        elif id == "DSRI":
-            # "Region Info" request - player wants to know who is in the region with them
-            assert len(payload) == 8
-            perm_id = int.from_bytes(payload[0:4], byteorder="little")
-            region_id = int.from_bytes(payload[4:8], byteorder="little")
-            logger.info(
-                "Received Region Info request, perm_id=%d rgn=%d",
-                perm_id,
-                region_id,
-            )
+        # no response to this
+        return True
 
-            ids = state.ids_in_region(region_id)
-            logger.info(
-                " There are " + str(len(ids)) + " players in region: " + str(ids)
-            )
+    @handles(Packets.DSSL)
+    def on_ping(self, state):
+        logger.info("Received client ping")
 
-            response = (
-                bytes("dsRI", "ascii")
-                + i32(perm_id)
-                + i32(region_id)
-                + (-len(ids)).to_bytes(4, "little", signed=True)
-            )
-            for i in ids:
-                response += i32(i)
+        return self.send(Packets.dsSL.pack(int(time())))
 
-            return self.send(response)
+    @handles(Packets.DSNS)
+    def on_slot(self, state, slot_id):
+        # Client name selection - they want to change the current Slot
+        logger.info("Received New Slot Choice: %d", slot_id)
 
-        elif id == "DSRD":
-            # Client making a Read Request of something
-            #  There are different types of things to Read:
-            #  PCSA (save), GLRG (region?), GLOB (global?), PCIN / PCOU, and PCQK
-            # but they all start with an ID...
-            assert len(payload) == 24
-            perm_id = int.from_bytes(payload[0:4], byteorder="little")
-            rd_block = str(payload[4:8], "ascii")
-            rd_index1 = int.from_bytes(payload[8:12], byteorder="little")
-            rd_index2 = int.from_bytes(payload[12:16], byteorder="little")
-            #  address and length of data block to read
-            rd_addr = int.from_bytes(payload[16:20], byteorder="little")
-            rd_len = int.from_bytes(payload[20:24], "little")
-
-            logger.info(
-                "Received 'Read' (block=%s) request from %d: (index1=%d, index2=%d, addr=%d, len=%d)",
-                rd_block,
-                perm_id,
-                rd_index1,
-                rd_index2,
-                rd_addr,
-                rd_len,
-            )
-            if rd_block == "GLOB":
-                # read of "global" shared memory area - things like high score tables, etc
-                #  each type is numbered differently, there are 0x16 of them
-                assert rd_index2 == 0
-
-                # send bytes back by getting them from the global state holder
-                block = state.read_glob(rd_index1, rd_addr, rd_len)
-
-            elif rd_block == "GLRG":
-                # read of "region" shared memory area - things like objects, items, etc
-                # data type, 0-5 or so (actually client usually requests 6?  weird)
-                block = state.read_glrg(rd_index1, rd_index2, rd_addr, rd_len)
-
-            elif rd_block == "PCSA":
-                # Player save file info.  These don't have multiple subsections.  Also you should only read your own data.
-                assert rd_index1 == 0
-                assert rd_index2 == 0
-                #  address and length of data block to read
-                block = self.player.read("PCSA", rd_addr, rd_len)
-
-            elif rd_block == "PCIN" or rd_block == "PCOU" or rd_block == "PCQK":
-                # read of "global" shared memory area - things like high score tables, etc
-                #  each type is numbered differently, there are 0x16 of them
-                # Stub these in for now with all-0
-                assert rd_index2 == 0
-                block = state.players[rd_index1].read(rd_block, rd_addr, rd_len)
+        self.player.slots["slot"] = slot_id
 
-            else:
-                assert False
-
-            key = 1
-            response = (
-                bytes("dsRD", "ascii")
-                + i32(perm_id)
-                + bytes(rd_block, "ascii")
-                + i32(rd_index1)
-                + i32(rd_index2)
-                + i32(key)
-                + i32(rd_addr)
-                + i32(rd_len)
-                + block
-            )
-            return self.send(response)
-
-        elif id == "DSWQ":
-            # Client making a Write Request of some shared memory segment, GLOB or GLRG.
-            #  Since this could be contentious, it expects back a dsWT (write OK)
-            #  or a dsWE (write Error)
-            # The client calls this a "useBroadcast" write
-            perm_id = int.from_bytes(payload[0:4], byteorder="little")
-            wt_block = str(payload[4:8], "ascii")
-            wt_index1 = int.from_bytes(payload[8:12], byteorder="little")
-            wt_index2 = int.from_bytes(payload[12:16], byteorder="little")
-            # key SHOULD likely be used to resolve race conditions, but it's always 0 in 1.0
-            wt_key = int.from_bytes(payload[16:20], byteorder="little")
-            assert wt_key == 0
-            #  address and length of data block to write
-            wt_addr = int.from_bytes(payload[20:24], byteorder="little")
-            wt_len = int.from_bytes(payload[24:28], "little")
-            assert wt_len == len(payload[28:])
-            logger.info(
-                "Received 'Write Broadcast' (block=%s) request from %d: (index1=%d, index2=%d, key=%d, addr=%d, len=%d)",
-                wt_block,
-                perm_id,
-                wt_index1,
-                wt_index2,
-                wt_key,
-                wt_addr,
-                wt_len,
-            )
+        # give back the player info struct again
+        return self.send(buildSlotResults(self.player))
 
-            if wt_block == "GLOB":
-                # write of "global" shared memory area - should never have an index2 set
-                assert wt_index2 == 0
-                success = state.write_glob(wt_index1, wt_addr, payload[28:])
-            elif wt_block == "GLRG":
-                # write of "region" shared memory area
-                success = state.write_glrg(wt_index1, wt_index2, wt_addr, payload[28:])
-            else:
-                assert False
+    @handles(Packets.DSPS)
+    def on_position(self, state, perm_id, unknown, x, y, reg):
+        # Client "set position"
+        logger.info(
+            "Received Set Position for %d (type %d): (x=%d, y=%d, reg=%d)",
+            perm_id,
+            unknown,
+            x,
+            y,
+            reg,
+        )
 
-            # ack or nack this
-            if success:
-                response = bytes("dsWT", "ascii")
-            else:
-                response = bytes("dsWE", "ascii")
-
-            key = 1
-            response += (
-                i32(perm_id)
-                + bytes(wt_block, "ascii")
-                + i32(wt_index1)
-                + i32(wt_index2)
-                + i32(key)
-                + i32(wt_len)
-            )
-            return self.send(response)
+        if not self.player:
+            logger.debug(" . Not logged in, ignoring")
+            return True
 
-        elif id == "DSWT":
-            # Client making a Write Request of something
-            #  There are different types of things to Write:
-            #  PCSA (save), PCQK, PCIN and PCOU
-            perm_id = int.from_bytes(payload[0:4], byteorder="little")
-            wt_block = str(payload[4:8], "ascii")
-            wt_index1 = int.from_bytes(payload[8:12], byteorder="little")
-            wt_index2 = int.from_bytes(payload[12:16], byteorder="little")
-            # key SHOULD likely be used to resolve race conditions, but it's always 0 in 1.0
-            wt_key = int.from_bytes(payload[16:20], byteorder="little")
-            assert wt_key == 0
-            #  address and length of data block to write
-            wt_addr = int.from_bytes(payload[20:24], byteorder="little")
-            wt_len = int.from_bytes(payload[24:28], "little")
-            assert wt_len == len(payload[28:])
-
-            logger.info(
-                "Received 'Write Player Char' (block=%s) request from %d: (index1=%d, index2=%d, key=%d, addr=%d, len=%d)",
-                wt_block,
-                perm_id,
-                wt_index1,
-                wt_index2,
-                wt_key,
-                wt_addr,
-                wt_len,
-            )
+        self.player.set_position(x, y, reg)
 
-            if wt_block == "PCSA":
-                # trying to save character - everything is ignored except the address and payload
-                assert wt_index1 == 0
-                assert wt_index2 == 0
-                self.player.write("PCSA", wt_addr, payload[28:])
+        # the "response" is a collected list of positions, where the count is followed by entries laid out like this packet.
+        #  It goes out on the next position tick, with everyone else nearby who moved (see send_positions).
+        #  Kept under the player's own id, whatever the client sent, so drop_player clears it.
+        id = self.player.id
+        state.interest.moved(id, reg, x, y, Packets.position.pack(id, unknown, x, y, reg), self)
+        return True
 
-            elif wt_block == "PCIN" or wt_block == "PCOU" or wt_block == "PCQK":
-                # trying to write to someone's 'outbox'
-                if wt_index1 == 0:
-                    wt_index1 = self.player.id
-                assert wt_index2 == 0
-                state.players[wt_index1].write(wt_block, wt_addr, payload[28:])
+    @handles(Packets.DSDT)
+    def on_date(self, state, perm_id):
+        # Client requesting Host Date
+        logger.info("Received Host Date req from %d", perm_id)
+
+        # calculate days and seconds since Jan. 1 of this year
+        #  TODO: this may be incorrect, it might be days since epoch, or seconds since, etc
+        now = datetime.now()
+        epoch = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        diff = now - epoch
+
+        return self.send(Packets.dsDT.pack(diff.seconds, diff.days))
+
+    @handles(Packets.DSRS)
+    def on_read_seed(self, state, perm_id, slot_id):
+        # Client making a "Read Seed" request
+        logger.info("Received 'Read Seed' (%d) request from %d", slot_id, perm_id)
+
+        response = Packets.dsRS.pack(perm_id, slot_id, self.player.slots["seed"][slot_id])
+        return self.send(response)
+
+    @handles(Packets.DSRL)
+    def on_roll_dice(self, state, perm_id, slot_id):
+        # Client making a "Roll Dice" request
+        logger.info("Received 'Roll Dice' request from %d:%d", perm_id, slot_id)
+
+        response = Packets.dsRL.pack(perm_id, slot_id, self.player.inc_seed(slot_id))
+        return self.send(response)
+
+    @handles(Packets.DSNM)
+    def on_name(self, state, slot_id, payload):
+        # Client checking if desired name is OK.
+        name = DecodeString(payload)
+        logger.info("Received 'Name OK?' request, slot=%d name=%s", slot_id, name)
+
+        # TODO: We always approve names now, but it would be good to know
+        #  which packet indicates "name no good" (dsNO?  dsNR?)
+        self.player.slots["name"][slot_id] = name
+
+        # the client also complains if you ack a 0-byte name, so we should not do that either
+        return self.send(Packets.dsNM.pack(slot_id, tail=EncodeString(name)))
+
+    @handles(Packets.DSRI)
+    def on_region_info(self, state, perm_id, region_id):
+        # "Region Info" request - player wants to know who is in the region with them
+        logger.info(
+            "Received Region Info request, perm_id=%d rgn=%d",
+            perm_id,
+            region_id,
+        )
+
+        ids = state.packed_ids_in_region(region_id)
+        logger.info(" There are %d players in region", len(ids) // 4)
+
+        response = Packets.dsRI.pack(perm_id, region_id, -(len(ids) // 4), tail=ids)
+        return self.send(response)
+
+    @handles(Packets.DSRD)
+    def on_read(self, state, perm_id, rd_block, rd_index1, rd_index2, rd_addr, rd_len):
+        # Client making a Read Request of something
+        #  There are different types of things to Read:
+        #  PCSA (save), GLRG (region?), GLOB (global?), PCIN / PCOU, and PCQK
+        # but they all start with an ID...
+        rd_block = str(rd_block, "ascii")
+
+        logger.info(
+            "Received 'Read' (block=%s) request from %d: (index1=%d, index2=%d, addr=%d, len=%d)",
+            rd_block,
+            perm_id,
+            rd_index1,
+            rd_index2,
+            rd_addr,
+            rd_len,
+        )
+        # shared memory is read by everyone nearby, and mostly hasn't changed since the last read: the
+        #  reply is encoded once per version of the block and kept, with the perm_id patched in for each reader
+        version = None
+        if rd_block == "GLOB":
+            # read of "global" shared memory area - things like high score tables, etc
+            #  each type is numbered differently, there are 0x16 of them
+            assert rd_index2 == 0
+            version = state.glob_version(rd_index1)
+            if version is not None:
+                cache_key = (rd_block, rd_index1, rd_index2, rd_addr, rd_len, version)
+                entry = state.replies.get(cache_key)
+                if entry:
+                    return self.send_cached(entry, perm_id)
+
+            # send bytes back by getting them from the global state holder
+            block = state.read_glob(rd_index1, rd_addr, rd_len)
+
+        elif rd_block == "GLRG":
+            # read of "region" shared memory area - things like objects, items, etc
+            # data type, 0-5 or so (actually client usually requests 6?  weird)
+            version = state.glrg_version(rd_index1, rd_index2)
+            if version is not None:
+                cache_key = (rd_block, rd_index1, rd_index2, rd_addr, rd_len, version)
+                entry = state.replies.get(cache_key)
+                if entry:
+                    return self.send_cached(entry, perm_id)
+
+            block = state.read_glrg(rd_index1, rd_index2, rd_addr, rd_len)
+
+        elif rd_block == "PCSA":
+            # Player save file info.  These don't have multiple subsections.  Also you should only read your own data.
+            assert rd_index1 == 0
+            assert rd_index2 == 0
+            #  address and length of data block to read
+            block = self.player.read("PCSA", rd_addr, rd_len)
 
-            else:
-                hexdump(payload)
+        elif rd_block == "PCIN" or rd_block == "PCOU" or rd_block == "PCQK":
+            # read of "global" shared memory area - things like high score tables, etc
+            #  each type is numbered differently, there are 0x16 of them
+            # Stub these in for now with all-0
+            assert rd_index2 == 0
+            block = state.read_player(rd_index1, rd_block, rd_addr, rd_len)
 
-            return True
+        else:
+            assert False
+
+        key = 1
+        # block is a view of the page it's in where it can be (see Memory.Block), so this is its only
+        #  copy: the reply is what gets compressed, or queued for the socket as it is
+        response = Packets.dsRD.pack(
+            perm_id if version is None else PLACEHOLDER_ID,
+            bytes(rd_block, "ascii"),
+            rd_index1,
+            rd_index2,
+            key,
+            rd_addr,
+            rd_len,
+            tail=block,
+        )
+        if version is None:
+            return self.send(response)
+        header, payload = encode(self.policy, response)
+        return self.send_cached(state.replies.put(cache_key, response, header, payload), perm_id)
+
+    @handles(Packets.DSWQ)
+    def on_write_shared(
+        self, state, perm_id, wt_block, wt_index1, wt_index2, wt_key, wt_addr, wt_len, data
+    ):
+        # Client making a Write Request of some shared memory segment, GLOB or GLRG.
+        #  Since this could be contentious, it expects back a dsWT (write OK)
+        #  or a dsWE (write Error)
+        # The client calls this a "useBroadcast" write
+        wt_block = str(wt_block, "ascii")
+        # key SHOULD likely be used to resolve race conditions, but it's always 0 in 1.0
+        assert wt_key == 0
+        #  address and length of data block to write
+        assert wt_len == len(data)
+        logger.info(
+            "Received 'Write Broadcast' (block=%s) request from %d: (index1=%d, index2=%d, key=%d, addr=%d, len=%d)",
+            wt_block,
+            perm_id,
+            wt_index1,
+            wt_index2,
+            wt_key,
+            wt_addr,
+            wt_len,
+        )
+
+        if wt_block == "GLOB":
+            # write of "global" shared memory area - should never have an index2 set
+            assert wt_index2 == 0
+            success = state.write_glob(wt_index1, wt_addr, data)
+        elif wt_block == "GLRG":
+            # write of "region" shared memory area
+            success = state.write_glrg(wt_index1, wt_index2, wt_addr, data)
+        else:
+            assert False
+
+        # ack or nack this
+        key = 1
+        response = (Packets.dsWT if success else Packets.dsWE).pack(
+            perm_id, bytes(wt_block, "ascii"), wt_index1, wt_index2, key, wt_len
+        )
+        return self.send(response)
+
+    @handles(Packets.DSWT)
+    def on_write_player(
+        self, state, perm_id, wt_block, wt_index1, wt_index2, wt_key, wt_addr, wt_len, data
+    ):
+        # Client making a Write Request of something
+        #  There are different types of things to Write:
+        #  PCSA (save), PCQK, PCIN and PCOU
+        wt_block = str(wt_block, "ascii")
+        # key SHOULD likely be used to resolve race conditions, but it's always 0 in 1.0
+        assert wt_key == 0
+        #  address and length of data block to write
+        assert wt_len == len(data)
+
+        logger.info(
+            "Received 'Write Player Char' (block=%s) request from %d: (index1=%d, index2=%d, key=%d, addr=%d, len=%d)",
+            wt_block,
+            perm_id,
+            wt_index1,
+            wt_index2,
+            wt_key,
+            wt_addr,
+            wt_len,
+        )
+
+        if wt_block == "PCSA":
+            # trying to save character - everything is ignored except the address and payload
+            assert wt_index1 == 0
+            assert wt_index2 == 0
+            self.player.write("PCSA", wt_addr, data)
+
+        elif wt_block == "PCIN" or wt_block == "PCOU" or wt_block == "PCQK":
+            # trying to write to someone's 'outbox'
+            if wt_index1 == 0:
+                wt_index1 = self.player.id
+            assert wt_index2 == 0
+            state.write_player(wt_index1, wt_block, wt_addr, data)
 
         else:
-            logger.debug(
-                "Packet received (len=%d, id=%s, payload=%s)",
-                len(payload),
-                id,
-                payload,
-            )
-            hexdump(payload)
-            logger.debug("Ignoring packet")
-            return True
+            hexdump(data)
+
+        return True
 
     # helper to send a packet to the connected client
-    #  it tries RLE compression for size reduction, and prepends the length as well
+    #  it tries RLE compression for size reduction (if the policy thinks it's worth it),
+    #  and prepends the length as well
+    # Packets are only queued here: the server flushes every queue once per loop iteration.
     def send(self, data, allow_compress=True):
-        if allow_compress:
-            compressed = RLECompress(data)
-            if len(compressed) < len(data):
-                pkt = ((2 + len(compressed)) | 0x8000).to_bytes(
-                    2, "little"
-                ) + compressed
-            else:
-                pkt = (2 + len(data)).to_bytes(2, "little") + data
-        else:
-            pkt = (2 + len(data)).to_bytes(2, "little") + data
-
-        if len(pkt) < self.socket.send(pkt):
-            # Failed to send all the bytes, which means the client disconnected, or the send-buffer is full.
-            #  It's possible to await EVENT_SEND and send the rest; however, a full send-buffer means a
-            #  significant backlog of packets, and it's probably just as well to disconnect them.
+        header, payload = encode(self.policy, data, allow_compress)
+        if self.metrics:
+            self.metrics.sent(bytes(data[0:4]), len(data), 2 + len(payload))
+        return self.queue(data, header, payload)
+
+    def send_cached(self, entry, perm_id):
+        """Send a ReplyCache entry with perm_id in place of the placeholder: the cached payload is queued
+        as it is, in two views around the id, so nothing is copied"""
+        data, header, payload, offset = entry
+        if self.metrics:
+            self.metrics.sent(bytes(data[0:4]), len(data), 2 + len(payload))
+        view = memoryview(payload)
+        self.outgoing += (header, view[:offset], perm_id.to_bytes(4, "little"), view[offset + 4 :])
+        return self.queued_bytes(2 + len(payload))
+
+    def queue(self, data, header, payload):
+        """Queue an already-encoded packet.  Returns False if that puts the client over the high-water mark."""
+        # header and payload go out as separate buffers of one sendmsg, no need to join them.
+        #  Neither is changed after this, so one encoding can be queued on many connections (see Multicast).
+        self.outgoing.append(header)
+        self.outgoing.append(payload)
+        return self.queued_bytes(2 + len(payload))
+
+    def queued_bytes(self, size):
+        """Count bytes just put on the outgoing queue.  Returns False if that puts the client over the high-water mark."""
+        self.queued += size
+        self.pending.add(self)
+
+        if self.queued > self.high_water:
+            # A client this far behind is either gone or can't keep up, and it's probably
+            #  just as well to disconnect them.
+            logger.info("Outgoing queue over high-water mark (%d bytes)", self.queued)
             return False
         return True
 
-    def recv(self, state):
-        """Read helper for packets - consumes some bytes and triggers the packet handler if done"""
-
-        # read time!  get 2 bytes, then N bytes
-        if self.len == 0:
-            buf = self.socket.recv(2 - len(self.buf))
-            if not buf:
-                # 0-byte response here means the client disconnected.
+    def flush(self):
+        """Write as much of the outgoing queue as the socket will take.  Returns False if the socket failed."""
+        while self.outgoing:
+            try:
+                if _sendmsg:
+                    sent = self.socket.sendmsg(self.outgoing[:IOV_MAX])
+                else:
+                    sent = self.socket.send(b"".join(self.outgoing))
+            except (BlockingIOError, InterruptedError):
+                # send-buffer is full, wait for EVENT_WRITE
+                return True
+            except OSError:
                 return False
-            else:
-                # got at least one byte, append it to our read-buffer
-                self.buf += buf
-                if len(self.buf) == 2:
-                    # got our 2 bytes, now we expect len - 2 more bytes
-                    pkt_len = int.from_bytes(self.buf, byteorder="little")
-                    self.compressed = pkt_len & 0x8000
-                    self.len = (pkt_len & 0x7FFF) - 2
-                    self.buf.clear()
 
-        else:
-            buf = self.socket.recv(self.len - len(self.buf))
-            if not buf:
-                # 0-byte response here means the client disconnected.
-                return False
-            else:
-                self.buf += buf
-                if len(self.buf) == self.len:
-                    if not self.handle(
-                        RLEUncompress(self.buf) if self.compressed else self.buf,
-                        state,
-                    ):
-                        return False
+            self.queued -= sent
+            # drop all fully-written buffers, and trim a partially-written one
+            i = 0
+            while i < len(self.outgoing) and sent >= len(self.outgoing[i]):
+                sent -= len(self.outgoing[i])
+                i += 1
+            del self.outgoing[:i]
+            if sent:
+                self.outgoing[0] = memoryview(self.outgoing[0])[sent:]
+                # short write means the send-buffer is full
+                return True
+
+        return True
+
+    def free_space(self):
+        """Return a writable memoryview of the free end of the receive buffer, room for at least one whole packet"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buf) - self.end < 0x8000:
+            # slide the leftover partial packet back to the beginning
+            length = self.end - self.start
+            self.view[:length] = self.view[self.start : self.end]
+            self.start, self.end = 0, length
 
-                    self.len = 0
-                    self.buf.clear()
+        return self.view[self.end :]
+
+    def recv(self, state):
+        """Read helper for packets - reads as much as is available and handles every complete packet"""
+        try:
+            count = self.socket.recv_into(self.free_space())
+        except ConnectionError:
+            return False
+        if not count:
+            # 0-byte response here means the client disconnected.
+            return False
+        self.end += count
+        if self.metrics:
+            self.metrics.wire_in += count
+
+        return self.process(state)
+
+    def process(self, state):
+        """Split every complete packet out of the receive buffer and handle them in order"""
+        view = self.view
+        pos = self.start
+        end = self.end
+        try:
+            while True:
+                if self.decoder:
+                    # compressed packets are decompressed straight out of the buffer, even if incomplete
+                    pos += self.decoder.feed(view[pos:end])
+                    if not self.decoder.done:
+                        break
+                    data = self.decoder.finish()
+                    self.decoder = None
+
+                else:
+                    # need a 2 byte header, then len - 2 more bytes
+                    if end - pos < 2:
+                        break
+                    pkt_len = view[pos] | view[pos + 1] << 8
+                    length = (pkt_len & 0x7FFF) - 2
+                    if length < 0:
+                        logger.info("Bad packet length %d, disconnecting", pkt_len)
+                        return False
+                    if pkt_len & 0x8000:
+                        pos += 2
+                        self.decoder = RLEDecoder(length)
+                        continue
+                    if end - pos - 2 < length:
+                        break
+                    # uncompressed packets are handled in-place
+                    pos += 2 + length
+                    data = view[pos - length : pos]
+
+                if not self.handle(data, state):
+                    return False
+                if self.waiting:
+                    # the rest waits until the database has answered
+                    break
+
+        finally:
+            self.start = pos
 
         return True
 
     def close(self, state):
         # try dsCL see if we can get them to drop
         if self.player:
+            if self.multicast:
+                self.multicast.leave(self)
             state.drop_player(self.player.id)
-            response = bytes("dsCL", "ascii") + i32(self.player.id)
-            self.send(response)
+            self.send(Packets.dsCL.pack(self.player.id))
 
-        # close socket
+        # last try at anything still queued, then close socket
+        self.flush()
+        self.pending.discard(self)
         self.socket.close()
 
 
-class Server:
-    __slots__ = "address_port", "database"
+class CapturingConnection(Connection):
+    """
+    A Connection that also writes every packet it receives and sends to a Capture.
+
+    Only used when capture is turned on, so ordinary Connections don't pay for it at all.
+    Received bytes are kept until their packet is handled, to save the raw frame of compressed ones.
+    """
+
+    __slots__ = "capture", "id", "wire", "mark"
+
+    def __init__(
+        self, capture, socket, policy, pending, high_water=0x100000, metrics=None, multicast=None
+    ):
+        super().__init__(socket, policy, pending, high_water, metrics, multicast)
+        self.capture = capture
+        self.id = capture.new_id()
+        # bytes received but not yet handled, and how far into the receive buffer they go
+        self.wire = bytearray()
+        self.mark = 0
+
+    def free_space(self):
+        view = super().free_space()
+        self.mark = self.end
+        return view
 
-    def __init__(self, address_port, database):
+    def process(self, state):
+        self.wire += self.view[self.mark : self.end]
+        self.mark = self.end
+        return super().process(state)
+
+    def handle(self, data, state):
+        # the frame this packet came from is at the front of the wire bytes
+        length = (self.wire[0] | self.wire[1] << 8) & 0x7FFF
+        raw = self.wire[:length] if self.wire[1] & 0x80 else b""
+        del self.wire[:length]
+
+        self.capture.write(self.id, Capture.IN, data, raw)
+        return super().handle(data, state)
+
+    def queue(self, data, header, payload):
+        self.capture.write(
+            self.id, Capture.OUT, data, header + payload if header[1] & 0x80 else b""
+        )
+        return super().queue(data, header, payload)
+
+    def send_cached(self, entry, perm_id):
+        # the capture gets copies with the id in, what's sent doesn't need them
+        data, header, payload, offset = entry
+        self.capture.write(
+            self.id,
+            Capture.OUT,
+            patch(data, OFFSET, perm_id),
+            header + patch(payload, offset, perm_id) if header[1] & 0x80 else b"",
+        )
+        return super().send_cached(entry, perm_id)
+
+    def close(self, state):
+        super().close(state)
+        self.capture.write(self.id, Capture.CLOSED)
+
+
+class Server:
+    __slots__ = (
+        "address_port",
+        "database",
+        "db_thread",
+        "high_water",
+        "console",
+        "reuse_port",
+        "capture",
+        "metrics_port",
+        "journal",
+        "state",
+        "connections",
+        "policy",
+        "metrics",
+        "multicast",
+        "pending",
+        "sel",
+        "sock_listen",
+        "sock_metrics",
+        "waker",
+        "resumed",
+        "ticking",
+        "running",
+    )
+
+    # seconds between sending batches of position updates
+    tick_interval = 0.1
+
+    def __init__(
+        self,
+        address_port,
+        database,
+        high_water=0x100000,
+        console=True,
+        reuse_port=False,
+        capture=None,
+        metrics_port=None,
+        journal=None,
+    ):
         # Save the address / port for server launch (below)
         self.address_port = address_port
         self.database = database
+        # runs the database, so the loop doesn't wait on it
+        self.db_thread = None
+        # outgoing bytes a client may fall behind by before it is dropped
+        self.high_water = high_water
+        # whether to take sysop commands from stdin
+        self.console = console
+        # whether other processes may listen on the same port (SO_REUSEPORT)
+        self.reuse_port = reuse_port
+        # Capture to write all client traffic to, if any
+        self.capture = capture
+        # local port to serve metrics to Prometheus on, if any
+        self.metrics_port = metrics_port
+        # Journal to record every write to, and recover from, if any
+        self.journal = journal
+
+        self.state = None
+        # map of all connected clients
+        self.connections = {}
+        # outgoing compression is learned across all clients
+        self.policy = CompressionPolicy()
+        # traffic counters, for the console and Prometheus
+        self.metrics = Metrics()
+        # logged-in players' connections, for packets that go to many of them
+        self.multicast = Multicast(self.policy, self.metrics)
+        # connections with packets queued during this loop iteration
+        self.pending = set()
+        self.sel = None
+        self.sock_listen = None
+        self.sock_metrics = None
+        # socket pair the database thread pokes when a request a Connection waits on is done,
+        #  and those Connections
+        self.waker = None
+        self.resumed = deque()
+        # whether a batch of position updates is scheduled
+        self.ticking = False
+        self.running = False
+
+    def make_state(self):
+        """Create world-state and attach it to the database connection"""
+        return State(self.db_thread, self.journal)
+
+    # Everything registered with the selector carries a callback in its key data,
+    #  except client sockets, which carry their Connection.
+    def on_console(self, mask):
+        # accepting input from the sysop...
+        #  read some bytes looking for linefeeds
+        # this isn't great if stdin is really fast but is OK for console input
+        line = stdin.readline()
+        if not line:
+            # stdin closed, nobody left to type commands
+            self.sel.unregister(stdin)
+        else:
+            self.running = console(line, self)
+
+    def on_accept(self, mask):
+        # activity on the listen-socket is a new connection we can accept
+        #  TODO: accept() can fail, which may raise an exception... I think
+        conn, addr = self.sock_listen.accept()
+
+        logger.info(f"Received new incoming connection from {addr}: {conn}")
+        self.add_connection(conn)
+
+    def on_wake(self, mask):
+        # database requests are done: carry on with the Connections waiting for them
+        self.waker[0].recv(0x1000)
+        while self.resumed:
+            c = self.resumed.popleft()
+            if c.socket.fileno() < 0:
+                # dropped while waiting
+                continue
+            if not c.resume(self.state):
+                self.drop(c)
+            elif c.waiting:
+                self.wait(c)
+            else:
+                self.watch(c)
+
+    def on_done(self, c):
+        # called on the database thread
+        self.resumed.append(c)
+        try:
+            self.waker[1].send(b"\0")
+        except BlockingIOError:
+            # already a wake-up waiting to be read
+            pass
+
+    def on_metrics_accept(self, mask):
+        # a Prometheus scrape: wait for the request to arrive, then answer and hang up
+        conn, addr = self.sock_metrics.accept()
+        conn.setblocking(False)
+        self.sel.register(
+            conn, selectors.EVENT_READ, lambda mask: self.on_metrics_request(conn)
+        )
+
+    def on_metrics_request(self, conn):
+        self.sel.unregister(conn)
+        try:
+            # every path gets the same answer, so the request itself doesn't matter
+            conn.recv(0x1000)
+            conn.sendall(
+                http_response(self.metrics.prometheus(self.state, self.connection_count()))
+            )
+        except OSError:
+            pass
+        conn.close()
+
+    def connection_count(self):
+        return len(self.connections)
+
+    def add_connection(self, conn):
+        """Wrap the socket in a Connection object and add to the connections dict"""
+        conn.setblocking(False)
+        if self.capture:
+            c = CapturingConnection(
+                self.capture,
+                conn,
+                self.policy,
+                self.pending,
+                self.high_water,
+                self.metrics,
+                self.multicast,
+            )
+        else:
+            c = Connection(
+                conn, self.policy, self.pending, self.high_water, self.metrics, self.multicast
+            )
+        self.connections[conn.fileno()] = c
+
+        # request notif. of future bytes available for reading
+        self.sel.register(conn, selectors.EVENT_READ, c)
+        return c
+
+    def wait(self, c):
+        """Stop reading from a Connection until the database request it waits on is done"""
+        c.waiting[0].add_done_callback(lambda future: self.on_done(c))
+        self.watch(c)
+
+    def watch(self, c):
+        """Select the events a Connection needs: reads unless it waits on the database, writes if it has a backlog"""
+        events = (0 if c.waiting else selectors.EVENT_READ) | (
+            selectors.EVENT_WRITE if c.writing else 0
+        )
+        try:
+            if events:
+                self.sel.modify(c.socket, events, c)
+            else:
+                self.sel.unregister(c.socket)
+        except KeyError:
+            # not registered while it had nothing to wait for
+            self.sel.register(c.socket, events, c)
+
+    def remove_connection(self, c):
+        # do not notify about this again
+        try:
+            self.sel.unregister(c.socket)
+        except KeyError:
+            pass
+        # drop conn from list
+        del self.connections[c.socket.fileno()]
+        self.pending.discard(c)
+
+    def drop(self, c):
+        logger.info(f"Dropping connection {c.socket}")
+        self.remove_connection(c)
+        c.close(self.state)
+
+    def tick(self):
+        self.ticking = False
+        for c in send_positions(self.state):
+            self.drop(c)
+
+    def flush(self):
+        """Write out everything queued this iteration, one sendmsg per connection,
+        and only wait on EVENT_WRITE for the ones that couldn't take it all"""
+        # the iteration's writes are journaled before anyone hears back about them
+        if self.state.journal:
+            self.state.journal.commit()
+        for c in tuple(self.pending):
+            if c.socket.fileno() < 0:
+                # dropped earlier in this iteration
+                continue
+            if not c.flush():
+                self.drop(c)
+            elif bool(c.outgoing) != c.writing:
+                c.writing = bool(c.outgoing)
+                self.watch(c)
+        self.pending.clear()
 
     def run(self):
         """Runs the server."""
 
-        # Create world-state and attach it to the database connection
-        state = State(self.database)
+        # create a selectors object and register stdin to it (to accept console commands)
+        self.sel = selectors.DefaultSelector()
 
-        # map of all connected clients
-        connections = {}
+        self.db_thread = DatabaseThread(self.database)
+        self.waker = socket.socketpair()
+        for sock in self.waker:
+            sock.setblocking(False)
+        self.sel.register(self.waker[0], selectors.EVENT_READ, self.on_wake)
 
-        # create a selectors object and register stdin to it (to accept console commands)
-        sel = selectors.DefaultSelector()
-        sel.register(stdin, selectors.EVENT_READ)
+        # Create world-state and attach it to the database connection
+        self.state = self.make_state()
+
+        if self.console:
+            self.sel.register(stdin, selectors.EVENT_READ, self.on_console)
 
         # get a listen socket, IPV4-only
         logger.info(f"Opening listen socket on {self.address_port}")
-        sock_listen = socket.create_server(self.address_port)
-        sock_listen.setblocking(False)
-        sel.register(sock_listen, selectors.EVENT_READ)
+        self.sock_listen = socket.create_server(
+            self.address_port, reuse_port=self.reuse_port
+        )
+        self.sock_listen.setblocking(False)
+        self.sel.register(self.sock_listen, selectors.EVENT_READ, self.on_accept)
+
+        if self.metrics_port:
+            logger.info(f"Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+            self.sock_metrics = socket.create_server(("127.0.0.1", self.metrics_port))
+            self.sock_metrics.setblocking(False)
+            self.sel.register(self.sock_metrics, selectors.EVENT_READ, self.on_metrics_accept)
 
         logger.info("Awaiting incoming connections")
 
         # main server loop
-        running = True
-        while running:
+        self.running = True
+        while self.running:
             try:
-                events = sel.select()
+                # sleep until there is socket activity or a timer is due
+                events = self.sel.select(self.state.timers.timeout())
                 for key, mask in events:
-                    if key.fileobj == stdin:
-                        # accepting input from the sysop...
-                        #  read some bytes looking for linefeeds
-                        # this isn't great if stdin is really fast but is OK for console input
-                        line = stdin.readline().strip()
-                        if line == "exit" or line == "quit":
-                            running = False
-
-                        # other things can go here e.g. broadcast, drop player, etc
-
-                    elif key.fileobj == sock_listen:
-                        # activity on the listen-socket is a new connection we can accept
-                        #  TODO: accept() can fail, which may raise an exception... I think
-                        conn, addr = sock_listen.accept()
-
-                        logger.info(
-                            f"Received new incoming connection from {addr}: {conn}"
-                        )
-
-                        # Wrap the socket in a Connection object and add to the connections dict
-                        conn.setblocking(False)
-                        conn_obj = Connection(conn)
-                        connections[conn.fileno()] = conn_obj
-
-                        # request notif. of future bytes available for reading
-                        sel.register(conn, selectors.EVENT_READ)
+                    c = key.data
+                    if not isinstance(c, Connection):
+                        c(mask)
+                    elif c.socket.fileno() < 0:
+                        # dropped earlier in this iteration
+                        continue
                     else:
-                        # activity on a different socket
+                        # activity on a client socket
+                        if mask & selectors.EVENT_WRITE:
+                            # room in the send-buffer again, it gets flushed below
+                            self.pending.add(c)
                         if mask & selectors.EVENT_READ:
-                            c = connections[key.fd]
-                            if not c.recv(state):
-                                logger.info(f"Dropping connection {key}")
-                                # do not notify about this again
-                                sel.unregister(key.fileobj)
-                                # drop conn from list
-                                c.close(state)
-                                del connections[key.fd]
+                            if not c.recv(self.state):
+                                self.drop(c)
+                            elif c.waiting:
+                                self.wait(c)
+
+                self.state.timers.run()
+                if self.state.interest.dirty and not self.ticking:
+                    self.ticking = True
+                    self.state.timers.after(self.tick_interval, self.tick)
+
+                self.flush()
 
             except KeyboardInterrupt:
                 print("Received Ctrl+C, shutting down")
-                running = False
+                self.running = False
 
             except Exception as e:
                 print("Got an error: ", e)
-                running = False
+                self.running = False
 
         # great, done running, shut everything down
-        sel.close()
+        self.sel.close()
 
-        for c in connections.values():
-            c.close(state)
+        for c in self.connections.values():
+            c.close(self.state)
+        self.connections = {}
 
-        sock_listen.close()
+        self.sock_listen.close()
+        if self.sock_metrics:
+            self.sock_metrics.close()
 
-        state.close()
+        self.state.close()
+        self.db_thread.close()
+        for sock in self.waker:
+            sock.close()
@@ -0,0 +1,188 @@
+"""Single-file binary snapshots of the whole world, mapped into memory to load"""
+
+import mmap
+import os
+import struct
+from logging import getLogger
+
+from .Database import Database
+from .Memory import PAGE_SIZE, Block
+
+logger = getLogger(__name__)
+
+# every snapshot file starts with this
+MAGIC = b"DSOsnp\x00\x01"
+
+# file header: magic, bytes of logins, number of directory entries, number of index entries
+header = struct.Struct("<8sIII")
+# each login: id, then the lengths of the UTF-8 username and password that follow
+login = struct.Struct("<IHH")
+# directory entry: scope, region or player id (0 for GLOB), and where its index entries are
+#  (the first and how many), so opening a snapshot doesn't mean reading the whole index
+directory = struct.Struct("<BIII")
+# index entry: scope, region or player id, key, page, offset of its data, length
+#  key is 4 bytes: a little-endian number for GLOB and GLRG, the data type (like PCSA) for players
+index = struct.Struct("<BI4sIQI")
+
+# scopes
+GLOB = 0
+GLRG = 1
+PLAYER = 2
+
+
+def align(offset):
+    """offset rounded up to a whole page"""
+    return -(-offset // PAGE_SIZE) * PAGE_SIZE
+
+
+def write(path, logins, glob, glrg, player):
+    """
+    Write get_world() lists to a snapshot at path.  It's written beside it and renamed over it once
+    it's all on disk, so path always holds a whole snapshot, old or new.
+    """
+    names = bytearray()
+    for id, username, password in logins:
+        username = bytes(username, "utf-8")
+        password = bytes(password, "utf-8")
+        names += login.pack(id, len(username), len(password)) + username + password
+
+    pages = [(GLOB, 0, key.to_bytes(4, "little"), page, data) for key, page, data in glob]
+    pages += [(GLRG, region, key.to_bytes(4, "little"), page, data) for region, key, page, data in glrg]
+    pages += [(PLAYER, id, bytes(key, "ascii"), page, data) for id, key, page, data in player]
+    # each region's (or player's) entries together, for the directory to point at
+    pages.sort(key=lambda row: row[:4])
+
+    owners = []
+    for i, (scope, owner, *_) in enumerate(pages):
+        if not owners or owners[-1][:2] != [scope, owner]:
+            owners.append([scope, owner, i, 0])
+        owners[-1][3] += 1
+
+    # pages start on page boundaries, so each can be mapped (and left unread) on its own
+    start = align(header.size + len(names) + directory.size * len(owners) + index.size * len(pages))
+    head = (
+        header.pack(MAGIC, len(names), len(owners), len(pages))
+        + names
+        + b"".join(directory.pack(*owner) for owner in owners)
+        + b"".join(
+            index.pack(scope, owner, key, page, start + i * PAGE_SIZE, len(data))
+            for i, (scope, owner, key, page, data) in enumerate(pages)
+        )
+    )
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(head)
+        file.write(bytes(start - len(head)))
+        for *_, data in pages:
+            file.write(data)
+            if len(data) < PAGE_SIZE:
+                file.write(bytes(PAGE_SIZE - len(data)))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    logger.info(f"Wrote a snapshot of {len(pages)} pages to {path}")
+
+
+class Snapshot(Database):
+    """
+    A snapshot file, read as a Database.
+
+    Opening one only reads its logins and directory: the index entries of a region or player are
+    read when it's asked for.  The file is mapped copy-on-write, and the Blocks handed out are views
+    of their pages in the mapping, so no page is read from disk until it's touched, and writing to
+    them changes only this process's copy.  The same pages are handed out each time, so whatever was
+    written to a block is there when it's asked for again, but saving does nothing: a snapshot is
+    only ever replaced whole, by write().
+    """
+
+    __slots__ = "path", "map", "logins", "owners", "index"
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            # the mapping keeps the file open for itself
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, names_length, owners, count = header.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a world snapshot")
+
+        # (id, username, password)
+        self.logins = []
+        offset = header.size
+        end = offset + names_length
+        while offset < end:
+            id, username_length, password_length = login.unpack_from(self.map, offset)
+            offset += login.size
+            username = str(self.map[offset : offset + username_length], "utf-8")
+            offset += username_length
+            password = str(self.map[offset : offset + password_length], "utf-8")
+            offset += password_length
+            self.logins.append((id, username, password))
+
+        # (scope, region or player id) => (first index entry, count)
+        self.owners = {
+            (scope, owner): (first, length)
+            for scope, owner, first, length in directory.iter_unpack(
+                self.map[end : end + directory.size * owners]
+            )
+        }
+        # where the index starts
+        self.index = end + directory.size * owners
+
+    def _blocks(self, scope, owner):
+        """{key: Block} of views of the mapped pages of a region, player or GLOB"""
+        try:
+            first, count = self.owners[scope, owner]
+        except KeyError:
+            return {}
+        view = memoryview(self.map)
+        start = self.index + first * index.size
+        result = {}
+        for _, _, key, page, offset, length in index.iter_unpack(view[start : start + count * index.size]):
+            key = str(key, "ascii") if scope == PLAYER else int.from_bytes(key, "little")
+            try:
+                block = result[key]
+            except KeyError:
+                block = result[key] = Block()
+            block.pages[page] = view[offset : offset + PAGE_SIZE]
+        return result
+
+    def get_login(self, username, password):
+        for id, name, secret in self.logins:
+            if name.lower() == username.lower() and secret == password:
+                return id
+        return None
+
+    def get_glob(self):
+        return self._blocks(GLOB, 0)
+
+    def get_regions(self):
+        return {owner for scope, owner in self.owners if scope == GLRG}
+
+    def get_glrg(self, region):
+        return self._blocks(GLRG, region)
+
+    def get_player(self, id):
+        return self._blocks(PLAYER, id)
+
+    def get_world(self):
+        rows = [[], [], []]
+        for scope, owner in self.owners:
+            prefix = () if scope == GLOB else (owner,)
+            rows[scope] += [
+                (*prefix, key, page, data)
+                for key, block in self._blocks(scope, owner).items()
+                for page, data in block.present()
+            ]
+        return list(self.logins), *rows
+
+
+def export(database, path):
+    """Write everything in a Database to a snapshot"""
+    write(path, *database.get_world())
+
+
+def restore(path, database):
+    """Replace everything in a Database with a snapshot"""
+    database.replace_world(*Snapshot(path).get_world())
@@ -4,24 +4,39 @@ from logging import getLogger
 
 logger = getLogger(__name__)
 
-from time import time
+from concurrent.futures import Future
+from struct import pack
 from random import Random, randbytes
 
+from .Interest import Interest
+from .Memory import PAGE_SIZE, Block, zeros
+from .ReplyCache import ReplyCache
+from .Timers import TimerWheel
+
+# seconds a login token from the launcher stays good for
+TOKEN_LIFETIME = 60
+# seconds between saving everything that changed
+CHECKPOINT_INTERVAL = 30
+# seconds a region must go untouched, with nobody in it, before it may be unloaded
+REGION_IDLE = 60
+
 
 class Player:
     """A class for a single player"""
 
-    __slots__ = "database", "id", "data", "slots"
+    __slots__ = "state", "database", "id", "data", "dirty", "slots"
 
-    def __init__(self, database, id):
-        # shared db
-        self.database = database
+    def __init__(self, state, id, data=None, dirty=None):
+        # the world this player is in, and its shared db
+        self.state = state
+        self.database = state.database
 
         # account ID (perm_id)
         self.id = id
 
-        # save/resumable player info
-        self.data = database.get_player(id)
+        # save/resumable player info (from the db, unless already loaded), and the keys changed since the last checkpoint
+        self.data = self.database.get_player(id) if data is None else data
+        self.dirty = set() if dirty is None else dirty
 
         # TODO: could this be built from PCSA data or something?
         self.slots = {
@@ -34,9 +49,6 @@ class Player:
             "region": 0,
         }
 
-    def close(self):
-        self.database.save_player(self.id, self.data)
-
     def inc_seed(self, slot):
         # personal RNG
         random = Random()
@@ -46,137 +58,386 @@ class Player:
         return self.slots["seed"][slot]
 
     def set_position(self, x, y, region):
+        old_region = self.slots["region"]
         self.slots["position"] = [x, y]
         self.slots["region"] = region
+        self.state.player_moved(self, old_region)
 
     def read(self, data_type, addr, length):
         """Read from player-scoped memory"""
         try:
-            data = self.data[data_type][addr : addr + length]
-            return data + bytes(length - len(data))
+            return self.data[data_type].read(addr, length)
         except KeyError:
-            return bytes(length)
+            return zeros(length)
 
     def write(self, data_type, addr, data):
         """Write to player-scoped memory"""
         try:
-            self.data[data_type][addr : addr + len(data)] = data
+            block = self.data[data_type]
         except KeyError:
-            self.data[data_type] = bytearray(addr) + data
+            block = self.data[data_type] = Block()
+        block.write(addr, data)
+        self.dirty.add(data_type)
+        journal = self.state.journal
+        if journal:
+            journal.record(bytes(data_type, "ascii"), self.id, 0, addr, data, block.version)
 
 
 class State:
-    """A class that manages all World State.  Also contains functions to load or save Players in the world"""
-
-    __slots__ = "glob", "glrg", "players", "tokens", "database"
-
-    def __init__(self, database):
+    """
+    A class that manages all World State.  Also contains functions to load or save Players in the world
+
+    GLRG regions are loaded from the database when first used (or ahead of it, when a player enters
+    them), and unloaded again once they have gone unused for a while, if more than region_memory
+    bytes of them are loaded.
+    """
+
+    __slots__ = (
+        "glob",
+        "glrg",
+        "region_used",
+        "region_bytes",
+        "loading",
+        "region_loads",
+        "region_evictions",
+        "players",
+        "regions",
+        "region_ids",
+        "interest",
+        "timers",
+        "tokens",
+        "dirty_glob",
+        "dirty_glrg",
+        "retired",
+        "saving",
+        "replies",
+        "journal",
+        "database",
+    )
+
+    # bytes of GLRG memory that may stay loaded before unused regions are unloaded
+    region_memory = 64 << 20
+    # bytes of encoded GLOB / GLRG replies kept for sending again
+    reply_memory = 8 << 20
+
+    def __init__(self, database, journal=None):
         self.database = database
 
         self.glob = database.get_glob()
+        # loaded regions: region => {key: bytearray}
         self.glrg = {}
-        for region in database.get_regions():
-            self.glrg[region] = database.get_glrg(region)
+        # when each loaded region was last read or written, least recently first
+        self.region_used = {}
+        # bytes of pages in the loaded regions, kept up to date as they load, unload and grow
+        self.region_bytes = 0
+        # regions being loaded ahead of use: region => Future of their blocks
+        self.loading = {}
+        # regions loaded and unloaded so far
+        self.region_loads = 0
+        self.region_evictions = 0
 
         # connected players
         self.players = {}
-
-        # login tokens
+        # ids of the players in each region: region => set
+        self.regions = {}
+        # sorted ids of the players in a region, and the same packed for a dsRI reply
+        #  region => (tuple, bytes), dropped whenever someone enters or leaves the region
+        self.region_ids = {}
+        # who is close enough to see who move
+        self.interest = Interest()
+        # everything to be done later, run from the server loop
+        self.timers = TimerWheel()
+
+        # login tokens: token => account id, each removed by a timer
         self.tokens = {}
 
+        # GLOB keys and GLRG (region, key) changed since the last checkpoint
+        self.dirty_glob = set()
+        self.dirty_glrg = set()
+        # players who left with changes not yet in the database: id => (Player, Future of the checkpoint saving them, or None)
+        self.retired = {}
+        # Future of the last checkpoint
+        self.saving = None
+        self.timers.every(CHECKPOINT_INTERVAL, self.checkpoint)
+
+        # encoded replies to shared memory reads, by what was read and its version
+        self.replies = ReplyCache(self.reply_memory)
+
+        # where every write is recorded, if anywhere, once what it holds already is replayed
+        self.journal = None
+        if journal:
+            self.recover(journal)
+
+    def recover(self, journal):
+        """Replay the writes in a journal over what the database has, then carry on journaling to it"""
+        count = 0
+        for timestamp, block, index1, index2, addr, data, version in journal.replay():
+            self.apply(block, index1, index2, addr, data)
+            count += 1
+
+        journal.start()
+        self.journal = journal
+        if count:
+            logger.info("Recovered %d writes from the journal", count)
+            # saved right away, after which the files replayed are deleted
+            self.checkpoint()
+        else:
+            journal.delete(journal.number - 1)
+        if journal.primary:
+            # followers get a copy of the world to start from, then every write journaled after it
+            journal.primary.start(self)
+
+    def apply(self, block, index1, index2, addr, data):
+        """Make a write from a journal entry (see Journal.entry)"""
+        if block == b"GLOB":
+            self.write_glob(index1, addr, data)
+        elif block == b"GLRG":
+            self.write_glrg(index1, index2, addr, data)
+        else:
+            self._recovered_player(index1).write(str(block, "ascii"), addr, data)
+
+    def _recovered_player(self, id):
+        """A player with writes from a journal, kept as if they had just left"""
+        try:
+            return self.retired[id][0]
+        except KeyError:
+            player = Player(self, id)
+            self.retired[id] = (player, None)
+            return player
+
     def close(self):
         self.tokens = {}
 
-        for player in self.players.values():
-            player.close()
-        self.players = {}
-
-        for region, data in self.glrg.items():
-            self.database.save_glrg(region, data)
+        # saved after any checkpoint still in progress
+        self.database.save_checkpoint(*self._changes())
+        self.retired = {}
+        if self.journal:
+            self.journal.close()
+            self.journal = None
 
+        self.players = {}
+        self.regions = {}
+        self.region_ids = {}
         self.glrg = {}
-        self.database.save_glob(self.glob)
+        self.region_used = {}
+        self.region_bytes = 0
+        self.loading = {}
         self.glob = {}
 
+    def _changes(self):
+        """Copy every page changed since the last checkpoint, and mark them clean"""
+        glob = [(key, page, data) for key in self.dirty_glob for page, data in self.glob[key].changes()]
+        glrg = [
+            (region, key, page, data)
+            for region, key in self.dirty_glrg
+            for page, data in self.glrg[region][key].changes()
+        ]
+        self.dirty_glob = set()
+        self.dirty_glrg = set()
+
+        player = []
+        for p in self.players.values():
+            player.extend((p.id, key, page, data) for key in p.dirty for page, data in p.data[key].changes())
+            p.dirty.clear()
+        for p, _ in self.retired.values():
+            player.extend((p.id, key, page, data) for key in p.dirty for page, data in p.data[key].changes())
+            p.dirty.clear()
+        return glob, glrg, player
+
+    def checkpoint(self):
+        """Hand everything changed since the last checkpoint to the database to save, without waiting for it"""
+        # players whose last changes are in the database now can be forgotten
+        for id, (player, saving) in tuple(self.retired.items()):
+            if saving is not None and saving.done() and not player.dirty:
+                del self.retired[id]
+
+        glob, glrg, player = self._changes()
+        if glob or glrg or player:
+            logger.info("Checkpoint: %d blocks", len(glob) + len(glrg) + len(player))
+            self.saving = self.database.submit("save_checkpoint", glob, glrg, player)
+            for id, (p, _) in self.retired.items():
+                self.retired[id] = (p, self.saving)
+            if self.journal:
+                self.journal.checkpoint(self.saving)
+        elif self.journal:
+            self.journal.truncate()
+
+        # regions loaded ahead of use but not used yet are taken in, to be unloaded in turn if need be
+        for region, future in tuple(self.loading.items()):
+            if future.done():
+                self._load_region(region)
+        # nothing is dirty now, so unloading costs no writes
+        self.evict_regions()
+
+    def owns_region(self, region):
+        """Whether this State holds the GLRG memory of a region (all of them, unless sharded)"""
+        return True
+
+    # #########################################################################
+    def _region(self, region):
+        """The blocks of a region, loaded if they aren't already, and marked used"""
+        try:
+            blocks = self.glrg[region]
+        except KeyError:
+            return self._load_region(region)
+        del self.region_used[region]
+        self.region_used[region] = self.timers.clock()
+        return blocks
+
+    def _load_region(self, region):
+        future = self.loading.pop(region, None)
+        blocks = self.database.get_glrg(region) if future is None else future.result()
+        self.glrg[region] = blocks
+        self.region_used[region] = self.timers.clock()
+        self.region_bytes += sum(block.memory() for block in blocks.values())
+        self.region_loads += 1
+        logger.debug("Loaded region %d", region)
+        # may be over budget now
+        self.evict_regions()
+        return blocks
+
+    def prefetch_region(self, region):
+        """Start loading a region from the database, if it isn't loaded already, without waiting for it"""
+        if region not in self.glrg and region not in self.loading and self.owns_region(region):
+            self.loading[region] = self.database.submit("get_glrg", region)
+
+    def region_memory_used(self):
+        """Bytes of GLRG memory loaded"""
+        return self.region_bytes
+
+    def evict_regions(self):
+        """Unload the least recently used regions, while over budget, that nobody has been in for REGION_IDLE seconds"""
+        if self.region_bytes <= self.region_memory:
+            return
+        idle = self.timers.clock() - REGION_IDLE
+        for region, last in tuple(self.region_used.items()):
+            if self.region_bytes <= self.region_memory or last > idle:
+                # the rest were used more recently
+                break
+            if region not in self.regions:
+                self._evict_region(region)
+
+    def _evict_region(self, region):
+        blocks = self.glrg.pop(region)
+        del self.region_used[region]
+        self.region_bytes -= sum(block.memory() for block in blocks.values())
+        # write back changes not yet checkpointed.  Requests run in order, so loading the region again
+        #  later will read them back.
+        dirty = [
+            (region, key, page, data)
+            for key, block in blocks.items()
+            if (region, key) in self.dirty_glrg
+            for page, data in block.changes()
+        ]
+        if dirty:
+            self.dirty_glrg.difference_update((region, key) for key in blocks)
+            self.database.submit("save_checkpoint", (), dirty, ())
+        self.region_evictions += 1
+        logger.debug("Unloaded region %d (%d pages written back)", region, len(dirty))
+
     # #########################################################################
     def read_glob(self, data_type, addr, length):
         """Read from GLOBal memory"""
         try:
-            data = self.glob[data_type][addr : addr + length]
-            return data + bytes(length - len(data))
+            return self.glob[data_type].read(addr, length)
         except KeyError:
-            return bytes(length)
+            return zeros(length)
 
     def read_glrg(self, region, data_type, addr, length):
         """Read from glReGional memory"""
         try:
-            data = self.glrg[region][data_type][addr : addr + length]
-            return data + bytes(length - len(data))
+            return self._region(region)[data_type].read(addr, length)
         except KeyError:
-            return bytes(length)
+            return zeros(length)
+
+    def glob_version(self, data_type):
+        """The version of a GLOB block (see Memory.Block), 0 if it doesn't exist, or None if it isn't kept here"""
+        block = self.glob.get(data_type)
+        return block.version if block else 0
+
+    def glrg_version(self, region, data_type):
+        """The version of a GLRG block, 0 if it doesn't exist, or None if it isn't kept here"""
+        block = self._region(region).get(data_type)
+        return block.version if block else 0
 
     # #########################################################################
     def write_glob(self, data_type, addr, data):
         """Write to global memory"""
         try:
-            self.glob[data_type][addr : addr + len(data)] = data
+            block = self.glob[data_type]
         except KeyError:
-            self.glob[data_type] = bytearray(addr) + data
+            block = self.glob[data_type] = Block()
+        block.write(addr, data)
+        self.dirty_glob.add(data_type)
+        if self.journal:
+            self.journal.record(b"GLOB", data_type, 0, addr, data, block.version)
 
     def write_glrg(self, region, data_type, addr, data):
         """Write to glReGional memory"""
+        region_data = self._region(region)
         try:
-            region_data = self.glrg[region]
+            block = region_data[data_type]
         except KeyError:
-            region_data = {}
-            self.glrg[region] = region_data
-
-        try:
-            region_data[data_type][addr : addr + len(data)] = data
-        except KeyError:
-            region_data[data_type] = bytearray(addr) + data
+            block = region_data[data_type] = Block()
+        pages = len(block.pages)
+        block.write(addr, data)
+        # pages the write allocated
+        self.region_bytes += (len(block.pages) - pages) * PAGE_SIZE
+        self.dirty_glrg.add((region, data_type))
+        if self.journal:
+            self.journal.record(b"GLRG", region, data_type, addr, data, block.version)
 
     # #########################################################################
-    def _expire_tokens(self):
-        # remove any "expired" logins from the table
-        #  that is anything > 60 seconds old
-        expiration = time() - 60
+    def _expire_token(self, token):
+        self.tokens.pop(token, None)
 
-        tokens = {}
-        for token, (id, timestamp) in self.tokens.items():
-            if timestamp > expiration:
-                tokens[token] = (id, timestamp)
+    def login(self, username, password):
+        """Start checking a username + password.  Returns a Future of the account id or None, for issue_token."""
+        return self.database.submit("get_login", username, password)
 
-        self.tokens = tokens
+    def issue_token(self, id):
+        """Returns a new login token for an account id"""
+        token = randbytes(7).hex()
+        self.tokens[token] = id
+        self.timers.after(TOKEN_LIFETIME, self._expire_token, token)
+        return token
 
     def get_login_token(self, username, password):
         """Checks a username + password and returns a login token or None"""
 
-        self._expire_tokens()
-
         id = self.database.get_login(username, password)
         if id:
-            token = randbytes(7).hex()
-            self.tokens[token] = (id, time())
-            return token
-
+            return self.issue_token(id)
         else:
             return None
 
     def return_login_token(self, token):
         """Returns the ID for a supplied login token"""
-
-        self._expire_tokens()
-
-        # now try to retrieve the player ID
-        id, _ = self.tokens.get(token, (None, None))
-        return id
+        return self.tokens.get(token)
 
     # #########################################################################
-    def add_player(self, id):
+    def load_player(self, id):
+        """Start loading a player's saved data.  Returns a Future of it, for add_player."""
+        if id in self.players or id in self.retired:
+            # nothing to load: already here, or their data is still in memory
+            future = Future()
+            future.set_result(None)
+            return future
+        return self.database.submit("get_player", id)
+
+    def add_player(self, id, data=None):
+        """Put a player in the world, with their data from load_player (or loaded now if not given)"""
         if id not in self.players:
-            player = Player(self.database, id)
+            retired = self.retired.pop(id, None)
+            if retired:
+                # back before their last session was saved: carry on from that instead of the db
+                player = Player(self, id, retired[0].data, retired[0].dirty)
+            else:
+                player = Player(self, id, data)
             self.players[id] = player
+            # everyone starts out in region 0 until their first position says where they are,
+            #  so nothing is loaded for it until then
+            self._enter_region(id, player.slots["region"], False)
             return player
 
         print(f"Couldn't add player {id} because they are already added")
@@ -184,15 +445,69 @@ class State:
 
     def drop_player(self, id):
         try:
-            self.players[id].close()
-            del self.players[id]
+            player = self.players.pop(id)
         except KeyError:
             print(f"Couldn't drop player {id} because they are already dropped")
+            return
+
+        self._leave_region(id, player.slots["region"])
+        self.interest.left(id)
+        # kept until the database has their last changes: the next checkpoint's, or the one being written
+        if player.dirty:
+            self.retired[id] = (player, None)
+        elif self.saving and not self.saving.done():
+            self.retired[id] = (player, self.saving)
+
+    def _enter_region(self, id, region, prefetch=True):
+        try:
+            self.regions[region].add(id)
+        except KeyError:
+            self.regions[region] = {id}
+            # the first one in: load the region before they start reading it
+            if prefetch:
+                self.prefetch_region(region)
+        self.region_ids.pop(region, None)
+
+    def _leave_region(self, id, region):
+        ids = self.regions[region]
+        ids.discard(id)
+        if not ids:
+            del self.regions[region]
+        self.region_ids.pop(region, None)
+
+    def _region_ids(self, region):
+        try:
+            return self.region_ids[region]
+        except KeyError:
+            ids = tuple(sorted(self.regions.get(region, ())))
+            self.region_ids[region] = result = (ids, pack(f"<{len(ids)}I", *ids))
+            return result
 
     def ids_in_region(self, region):
-        ids = []
-        for id, player in self.players.items():
-            if player.slots["region"] == region:
-                ids.append(id)
+        """Return a tuple of the ids of every player in a region"""
+        return self._region_ids(region)[0]
+
+    def packed_ids_in_region(self, region):
+        """The ids of every player in a region, as 32-bit little-endian integers"""
+        return self._region_ids(region)[1]
+
+    def player_count(self):
+        return len(self.players)
+
+    def player_moved(self, player, old_region):
+        """Called by Player.set_position after a player's position changes"""
+        region = player.slots["region"]
+        if region != old_region:
+            self._leave_region(player.id, old_region)
+            self._enter_region(player.id, region)
+        else:
+            # a first position in region 0, which wasn't loaded for them at login
+            self.prefetch_region(region)
+
+    def read_player(self, id, data_type, addr, length):
+        """Read from another player's memory (PCIN, PCOU, PCQK)"""
+        return self.players[id].read(data_type, addr, length)
 
-        return ids
+    def write_player(self, id, data_type, addr, data):
+        """Write to another player's memory (PCIN, PCOU, PCQK)"""
+        self.players[id].write(data_type, addr, data)
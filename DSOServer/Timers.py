@@ -0,0 +1,171 @@
+"""A hierarchical timer wheel, for everything the server does later or periodically"""
+
+from math import ceil
+from time import monotonic
+
+# each wheel has 2 ** SLOT_BITS slots
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+MASK = SLOTS - 1
+# wheels of increasing granularity: with 10ms ticks, 4 wheels reach about 46 hours ahead
+LEVELS = 4
+
+
+class Timer:
+    """One scheduled call, as returned by TimerWheel.after and .every, for cancelling it"""
+
+    __slots__ = "deadline", "expires", "interval", "callback", "args", "slot"
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        # the tick it fires on
+        self.expires = 0
+        # seconds between calls if it repeats, otherwise None
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        # the wheel slot it's in, None once fired or cancelled
+        self.slot = None
+
+
+class TimerWheel:
+    """
+    Timers sorted into slots by the tick they are due on.
+
+    The first wheel has a slot per tick, the next a slot per SLOTS ticks, and so on.  Adding or
+    cancelling a timer is a dict insert or delete.  As time passes, each slot of a coarser wheel is
+    emptied into the finer ones when its span comes up (cascading), so a timer moves at most once per
+    wheel no matter how many timers there are.  Timers past the range of the last wheel wait in its
+    furthest slot, and are sorted again when it comes up.
+
+    run() fires everything due, and timeout() says how long the event loop can sleep before the next
+    call to run() has something to do.  Timers never fire early, and late by at most a tick.
+    """
+
+    __slots__ = "resolution", "clock", "wheels", "tick", "count", "wake"
+
+    def __init__(self, resolution=0.01, clock=monotonic):
+        # seconds per tick
+        self.resolution = resolution
+        self.clock = clock
+        # LEVELS wheels of SLOTS slots, each a dict of Timers (as an ordered set)
+        self.wheels = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        # the next tick to process: everything due before it has fired
+        self.tick = int(clock() / resolution)
+        # timers scheduled
+        self.count = 0
+        # earliest tick that may have something to do, None if not worked out
+        self.wake = None
+
+    def __len__(self):
+        return self.count
+
+    def after(self, delay, callback, *args):
+        """Call callback(*args) once, delay seconds from now"""
+        timer = Timer(self.clock() + delay, None, callback, args)
+        self._add(timer)
+        return timer
+
+    def every(self, interval, callback, *args):
+        """Call callback(*args) every interval seconds, starting one interval from now"""
+        timer = Timer(self.clock() + interval, interval, callback, args)
+        self._add(timer)
+        return timer
+
+    def cancel(self, timer):
+        """Stop a timer from firing (again).  Cancelling one that already fired does nothing."""
+        if timer.slot is not None:
+            del timer.slot[timer]
+            timer.slot = None
+            self.count -= 1
+
+    def _add(self, timer):
+        expires = max(ceil(timer.deadline / self.resolution), self.tick)
+        timer.expires = expires
+        self._place(timer)
+        self.count += 1
+
+    def _place(self, timer):
+        tick = self.tick
+        # furthest the last wheel reaches: anything beyond is parked there until it comes around again
+        expires = min(timer.expires, tick + (1 << (SLOT_BITS * LEVELS)) - 1)
+        delta = expires - tick
+        level = 0
+        while delta >= 1 << (SLOT_BITS * (level + 1)):
+            level += 1
+        shift = SLOT_BITS * level
+        timer.slot = self.wheels[level][(expires >> shift) & MASK]
+        timer.slot[timer] = None
+
+        # the slot is looked at when its span starts
+        start = (expires >> shift) << shift
+        if self.wake is not None and start < self.wake:
+            self.wake = start
+
+    def _cascade(self, level):
+        """Sort the timers of the current slot of a coarse wheel into the finer ones"""
+        slot = self.wheels[level][(self.tick >> (SLOT_BITS * level)) & MASK]
+        if slot:
+            timers = tuple(slot)
+            slot.clear()
+            for timer in timers:
+                self._place(timer)
+
+    def _next_wake(self):
+        """Earliest tick at which a non-empty slot comes up"""
+        if self.wake is None:
+            wake = None
+            for level, wheel in enumerate(self.wheels):
+                shift = SLOT_BITS * level
+                # slots are emptied when their span starts, so the first one still waiting is the
+                #  first span starting at or after the next tick
+                first = -(-self.tick >> shift)
+                for block in range(first, first + SLOTS):
+                    if wheel[block & MASK]:
+                        if wake is None or block << shift < wake:
+                            wake = block << shift
+                        break
+            self.wake = wake
+        return self.wake
+
+    def timeout(self):
+        """Seconds until run() next has something to do, or None if no timers are scheduled"""
+        if not self.count:
+            return None
+        return max(0.0, self._next_wake() * self.resolution - self.clock())
+
+    def run(self):
+        """Fire every timer that is due.  Returns the number fired."""
+        target = int(self.clock() / self.resolution)
+        fired = 0
+        while self.tick <= target:
+            wake = self._next_wake() if self.count else None
+            if wake is None or wake > target:
+                # nothing to do until after now: skip the empty slots
+                self.tick = target + 1
+                break
+            self.tick = wake
+            self.wake = None
+
+            # start of a span of a coarser wheel: bring its timers down
+            level = 1
+            while level < LEVELS and not self.tick & ((1 << (SLOT_BITS * level)) - 1):
+                self._cascade(level)
+                level += 1
+
+            slot = self.wheels[0][self.tick & MASK]
+            self.tick += 1
+            if slot:
+                timers = tuple(slot)
+                slot.clear()
+                self.count -= len(timers)
+                for timer in timers:
+                    timer.slot = None
+                for timer in timers:
+                    if timer.interval is not None:
+                        # repeat from when it was due, but don't try to catch up on missed calls
+                        timer.deadline = max(timer.deadline + timer.interval, self.clock())
+                        self._add(timer)
+                    timer.callback(*timer.args)
+                    fired += 1
+        return fired
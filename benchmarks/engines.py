@@ -0,0 +1,123 @@
+#!/bin/env python3
+
+"""
+engines.py - Compare the selectors and asyncio server engines side by side
+Greg Kennedy, 2025
+
+Starts server.py once per engine on a scratch database, then measures
+ * connections/sec: connect, LAHI launcher info round trip, disconnect
+ * packet latency: many clients sending DSSL pings back to back
+
+Run from the root folder with: python3 -m benchmarks.engines
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+import asyncio
+import subprocess
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from DSOServer.Compression import RLEUncompress
+
+LAHI = (6).to_bytes(2, "little") + b"LAHI"
+DSSL = (6).to_bytes(2, "little") + b"DSSL"
+
+
+async def read_packet(reader):
+    header = await reader.readexactly(2)
+    length = int.from_bytes(header, "little")
+    data = await reader.readexactly((length & 0x7FFF) - 2)
+    return RLEUncompress(data) if length & 0x8000 else data
+
+
+async def connect(port):
+    # the server may still be starting up
+    for _ in range(50):
+        try:
+            return await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+async def connection_rate(port, count, concurrency):
+    async def one():
+        reader, writer = await connect(port)
+        writer.write(LAHI)
+        await read_packet(reader)
+        writer.close()
+        await writer.wait_closed()
+
+    start = perf_counter()
+    for _ in range(count // concurrency):
+        await asyncio.gather(*(one() for _ in range(concurrency)))
+    return count // concurrency * concurrency / (perf_counter() - start)
+
+
+async def ping_latency(port, clients, pings):
+    async def one():
+        reader, writer = await connect(port)
+        times = []
+        for _ in range(pings):
+            start = perf_counter()
+            writer.write(DSSL)
+            await read_packet(reader)
+            times.append(perf_counter() - start)
+        writer.close()
+        await writer.wait_closed()
+        return times
+
+    start = perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(clients)))
+    elapsed = perf_counter() - start
+    times = sorted(t for result in results for t in result)
+    return len(times) / elapsed, times[len(times) // 2], times[int(len(times) * 0.99)]
+
+
+def measure(engine, port, args):
+    with TemporaryDirectory() as tmp:
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                str(Path(__file__).parent.parent / "server.py"),
+                "-e",
+                engine,
+                "-p",
+                str(port),
+                "-d",
+                str(Path(tmp) / "bench.db"),
+                "-l",
+                "WARNING",
+            ],
+            stdin=subprocess.PIPE,
+        )
+        try:
+            rate = asyncio.run(connection_rate(port, args.connections, args.concurrency))
+            throughput, p50, p99 = asyncio.run(ping_latency(port, args.clients, args.pings))
+        finally:
+            server.communicate(b"exit\n", timeout=30)
+
+    return rate, throughput, p50, p99
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the server engines against each other.")
+    parser.add_argument("-p", "--port", type=int, default=24902, help="first TCP port to use")
+    parser.add_argument("--connections", type=int, default=1000, help="connections to open")
+    parser.add_argument("--concurrency", type=int, default=20, help="connections opened at once")
+    parser.add_argument("--clients", type=int, default=50, help="clients sending pings")
+    parser.add_argument("--pings", type=int, default=200, help="pings sent by each client")
+    args = parser.parse_args()
+
+    print(f"{'engine':<10} {'conn/s':>9} {'packets/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for i, engine in enumerate(("selectors", "asyncio")):
+        rate, throughput, p50, p99 = measure(engine, args.port + i, args)
+        print(f"{engine:<10} {rate:>9.0f} {throughput:>10.0f} {p50 * 1000:>8.2f} {p99 * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/bin/env python3
+
+"""
+interest.py - Cost of batching position updates as a region fills up
+Greg Kennedy, 2025
+
+Puts more and more players in one region, with the area growing to keep the density the same,
+has a tenth of them move, and times a tick of Interest.  For comparison, it also counts what
+sending every move to everyone in the region would have cost in entries sent.
+
+Run from the root folder with: python3 -m benchmarks.interest
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+from random import Random
+from time import perf_counter
+
+from DSOServer.Interest import VIEW_RANGE, Interest
+
+# players per VIEW_RANGE x VIEW_RANGE square
+DENSITY = 4
+
+
+def measure(players, movers, ticks=20):
+    rng = Random(14902)
+    side = int((players / DENSITY) ** 0.5 * VIEW_RANGE)
+    interest = Interest()
+    for id in range(players):
+        interest.moved(id, 1, rng.randrange(side), rng.randrange(side), b"", id)
+    interest.tick()
+
+    seconds = 0.0
+    entries = 0
+    for _ in range(ticks):
+        for id in rng.sample(range(players), movers):
+            interest.moved(id, 1, rng.randrange(side), rng.randrange(side), b"", id)
+        start = perf_counter()
+        batches = interest.tick()
+        seconds += perf_counter() - start
+        entries += sum(len(batch) for batch in batches.values())
+
+    return seconds / ticks, entries / ticks
+
+
+def main():
+    print(f"{'players':>8} {'movers':>7} {'tick ms':>8} {'entries':>9} {'per mover':>10} {'to everyone':>12}")
+    for players in (500, 2000, 8000, 32000):
+        movers = players // 10
+        seconds, entries = measure(players, movers)
+        print(
+            f"{players:>8} {movers:>7} {seconds * 1000:>8.2f} {entries:>9.0f} {entries / movers:>10.1f} {movers * players:>12}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/bin/env python3
+
+"""
+regions.py - Compare region membership lookups against scanning every player
+Greg Kennedy, 2025
+
+Fills a State with thousands of players spread over regions, then runs a mix of DSRI lookups
+and DSPS moves, the way a busy server sees them.
+
+Run from the root folder with: python3 -m benchmarks.regions
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+from random import Random
+from time import perf_counter
+
+from DSOServer.Compression import i32
+from DSOServer.Database import Database
+from DSOServer.State import State
+
+
+def scan(state, region):
+    """How DSRI replies were built before the region index"""
+    ids = []
+    for id, player in state.players.items():
+        if player.slots["region"] == region:
+            ids.append(id)
+    return b"".join(i32(i) for i in ids)
+
+
+def run(lookup, players, regions, operations, moves):
+    rng = Random(14902)
+    state = State(Database())
+    for id in range(1, players + 1):
+        state.add_player(id).set_position(0, 0, rng.randrange(regions))
+
+    # decide everything up front, so both lookups do the same work
+    plan = [
+        (rng.random() < moves, rng.randrange(1, players + 1), rng.randrange(regions))
+        for _ in range(operations)
+    ]
+
+    start = perf_counter()
+    for move, id, region in plan:
+        if move:
+            state.players[id].set_position(1, 1, region)
+        else:
+            lookup(state, state.players[id].slots["region"])
+    return operations / (perf_counter() - start)
+
+
+def main():
+    print(f"{'players':>8} {'regions':>8} {'moves':>6} {'scan ops/s':>12} {'index ops/s':>12}")
+    for players in (100, 1000, 5000):
+        for moves in (0.1, 0.5):
+            regions = max(4, players // 50)
+            operations = 200000 // players * 10
+            old = run(scan, players, regions, operations, moves)
+            new = run(State.packed_ids_in_region, players, regions, operations, moves)
+            print(f"{players:>8} {regions:>8} {moves:>6.0%} {old:>12.0f} {new:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
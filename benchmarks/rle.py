@@ -0,0 +1,73 @@
+#!/bin/env python3
+
+"""
+rle.py - Measure RLE codec throughput on packet-like payloads
+Greg Kennedy, 2025
+
+Run from the root folder with: python3 -m benchmarks.rle
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+from random import Random
+from time import perf_counter
+
+from DSOServer.Compression import RLECompress, RLEUncompress, i32
+
+
+def dsrd_reply(rng, block, length, density):
+    """A dsRD reply header followed by a sparsely-populated memory block"""
+    data = bytearray(length)
+    for _ in range(int(length * density) // 4):
+        addr = rng.randrange(0, length - 4, 4)
+        data[addr : addr + 4] = i32(rng.randrange(1, 0x10000))
+
+    return (
+        bytes("dsRD", "ascii")
+        + i32(1234)
+        + bytes(block, "ascii")
+        + i32(rng.randrange(16))
+        + i32(rng.randrange(6))
+        + i32(1)
+        + i32(0)
+        + i32(length)
+        + data
+    )
+
+
+def payloads():
+    rng = Random(14902)
+    return {
+        "dsRD GLRG 4k sparse": [dsrd_reply(rng, "GLRG", 4096, 0.05) for _ in range(64)],
+        "dsRD GLRG 16k half": [dsrd_reply(rng, "GLRG", 16384, 0.5) for _ in range(16)],
+        "dsRD GLOB 512 sparse": [dsrd_reply(rng, "GLOB", 512, 0.1) for _ in range(256)],
+        "dsRD PCSA 8k dense": [dsrd_reply(rng, "PCSA", 8192, 1.0) for _ in range(32)],
+    }
+
+
+def measure(func, items, seconds=0.5):
+    """Return MB/s of input processed by func over the items"""
+    size = sum(len(item) for item in items)
+    rounds = 0
+    start = perf_counter()
+    while True:
+        for item in items:
+            func(item)
+        rounds += 1
+        elapsed = perf_counter() - start
+        if elapsed >= seconds:
+            return size * rounds / elapsed / 1e6
+
+
+def main():
+    print(f"{'payload':<24} {'ratio':>6} {'compress MB/s':>14} {'uncompress MB/s':>16}")
+    for name, items in payloads().items():
+        compressed = [RLECompress(item) for item in items]
+        ratio = sum(map(len, compressed)) / sum(map(len, items))
+        print(
+            f"{name:<24} {ratio:>6.2f} {measure(RLECompress, items):>14.1f} {measure(RLEUncompress, compressed):>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
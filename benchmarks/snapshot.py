@@ -0,0 +1,121 @@
+#!/bin/env python3
+
+"""
+snapshot.py - Compare saving and loading a large world in sqlite3 and in a snapshot file
+Greg Kennedy, 2025
+
+Builds worlds of more and more regions (each with 6 GLRG blocks of a few pages), then times, for
+the sqlite3 database and for a snapshot of the same world:
+ * save: writing all of it (one transaction / one file written and renamed)
+ * start: opening it and getting GLOB and one region, as a server does before its first player
+ * load all: getting every region, and reading a byte of every page
+
+Files are written to a scratch directory, and the OS cache is warm for every load.
+
+Run from the root folder with: python3 -m benchmarks.snapshot
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from DSOServer.Database import Sqlite3
+from DSOServer.Memory import PAGE_SIZE
+from DSOServer.Snapshot import Snapshot, write
+
+# GLRG blocks per region, and pages in each
+KEYS = 6
+PAGES = 3
+
+
+def world(regions):
+    """get_world() lists for a world of this many regions, mostly zeros like the client's tables"""
+    rng = Random(14902)
+    # a few distinct pages, shared between rows to save building time
+    samples = []
+    for _ in range(16):
+        page = bytearray(PAGE_SIZE)
+        for _ in range(PAGE_SIZE // 32):
+            page[rng.randrange(PAGE_SIZE)] = rng.randrange(256)
+        samples.append(bytes(page))
+    glob = [(key, page, rng.choice(samples)) for key in range(0x16) for page in range(PAGES)]
+    glrg = [
+        (region, key, page, rng.choice(samples))
+        for region in range(regions)
+        for key in range(KEYS)
+        for page in range(PAGES)
+    ]
+    return [(1, "username", "password")], glob, glrg, []
+
+
+def touch(blocks):
+    """Read a byte of every page, so a lazily loaded one is really read"""
+    return sum(block.read(page * PAGE_SIZE, 1)[0] for block in blocks.values() for page in block.pages)
+
+
+def timed(function):
+    start = perf_counter()
+    function()
+    return perf_counter() - start
+
+
+def measure(tmp, regions):
+    logins, glob, glrg, player = world(regions)
+    path = Path(tmp) / f"world{regions}"
+
+    with Sqlite3(f"{path}.db") as db:
+        db.connection.executemany("INSERT INTO login(id, username, password) VALUES(?, ?, ?)", logins)
+        sqlite_save = timed(lambda: db.save_checkpoint(glob, glrg, player))
+    snapshot_save = timed(lambda: write(f"{path}.snap", logins, glob, glrg, player))
+
+    def sqlite_start():
+        with Sqlite3(f"{path}.db") as db:
+            touch(db.get_glob())
+            touch(db.get_glrg(regions // 2))
+
+    def snapshot_start():
+        snapshot = Snapshot(f"{path}.snap")
+        touch(snapshot.get_glob())
+        touch(snapshot.get_glrg(regions // 2))
+
+    def sqlite_all():
+        with Sqlite3(f"{path}.db") as db:
+            touch(db.get_glob())
+            for region in db.get_regions():
+                touch(db.get_glrg(region))
+
+    def snapshot_all():
+        snapshot = Snapshot(f"{path}.snap")
+        touch(snapshot.get_glob())
+        for region in snapshot.get_regions():
+            touch(snapshot.get_glrg(region))
+
+    return [
+        (sqlite_save, snapshot_save),
+        (min(timed(sqlite_start) for _ in range(3)), min(timed(snapshot_start) for _ in range(3))),
+        (min(timed(sqlite_all) for _ in range(3)), min(timed(snapshot_all) for _ in range(3))),
+    ]
+
+
+def main():
+    parser = ArgumentParser(description="Compare saving and loading a large world in sqlite3 and in a snapshot file.")
+    parser.add_argument("-r", "--regions", type=int, nargs="+", default=[100, 1000, 5000], help="world sizes to try, in regions (default: %(default)s)")
+    args = parser.parse_args()
+
+    print(f"{'regions':>8} {'MB':>6}  {'save: sqlite':>12} {'snapshot':>9}  {'start: sqlite':>13} {'snapshot':>9}  {'load all: sqlite':>16} {'snapshot':>9}")
+    with TemporaryDirectory() as tmp:
+        for regions in args.regions:
+            megabytes = regions * KEYS * PAGES * PAGE_SIZE / (1 << 20)
+            (a, b), (c, d), (e, f) = measure(tmp, regions)
+            print(
+                f"{regions:>8} {megabytes:>6.0f}  {a * 1000:>10.1f}ms {b * 1000:>7.1f}ms  {c * 1000:>11.1f}ms {d * 1000:>7.1f}ms"
+                f"  {e * 1000:>14.1f}ms {f * 1000:>7.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/bin/env python3
+
+"""
+suite.py - Micro-benchmarks of the codec, memory operations, packet handlers and database
+Greg Kennedy, 2025
+
+Times each case with timeit (best of several runs), and prints microseconds per call.
+Results can be written as JSON, and compared against an earlier run: any case slower than
+the baseline by more than the threshold fails, and the exit code is 1.
+
+Run from the root folder with e.g.:
+  python3 -m benchmarks.suite --save benchmarks/baseline.json     (on the old code)
+  python3 -m benchmarks.suite --compare benchmarks/baseline.json  (on the new code)
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+import json
+import platform
+from argparse import ArgumentParser
+from pathlib import Path
+from random import Random
+from sys import exit
+from tempfile import TemporaryDirectory
+from timeit import Timer
+
+from DSOServer import Packets
+from DSOServer.Compression import CompressionPolicy, EncodeString, RLECompress, RLEUncompress
+from DSOServer.Database import Database, Sqlite3
+from DSOServer.Memory import Block
+from DSOServer.Metrics import Metrics
+from DSOServer.Multicast import Multicast
+from DSOServer.Server import Connection
+from DSOServer.State import State
+from DSOServer.Timers import TimerWheel
+
+from .rle import payloads
+
+# (offset, length) pairs for memory reads and writes
+ACCESSES = ((0, 4), (0x100, 64), (0x1000, 1024), (0x3000, 4096))
+
+# perm_id of the player connected in handler benchmarks
+PERM_ID = 1
+
+
+class NullSocket:
+    """Takes everything sent to it"""
+
+    __slots__ = ()
+
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+
+    def close(self):
+        pass
+
+
+def codec_cases():
+    for name, items in payloads().items():
+        compressed = [RLECompress(item) for item in items]
+        # time per payload, not per list
+        yield f"rle/compress {name}", lambda items=items: [RLECompress(item) for item in items], len(items)
+        yield f"rle/uncompress {name}", lambda items=compressed: [RLEUncompress(item) for item in items], len(items)
+
+
+def memory_cases():
+    rng = Random(14902)
+    state = State(Database())
+    for data_type in range(6):
+        state.write_glob(data_type, 0, rng.randbytes(0x4000))
+        state.write_glrg(1, data_type, 0, rng.randbytes(0x4000))
+    player = state.add_player(PERM_ID)
+    player.write("PCSA", 0, rng.randbytes(0x4000))
+
+    for addr, length in ACCESSES:
+        data = rng.randbytes(length)
+        size = f"{length}@{addr:#x}"
+        yield f"state/read_glob {size}", lambda addr=addr, length=length: state.read_glob(3, addr, length), 1
+        yield f"state/read_glrg {size}", lambda addr=addr, length=length: state.read_glrg(1, 3, addr, length), 1
+        yield f"state/write_glob {size}", lambda addr=addr, data=data: state.write_glob(3, addr, data), 1
+        yield f"state/write_glrg {size}", lambda addr=addr, data=data: state.write_glrg(1, 3, addr, data), 1
+        yield f"player/read {size}", lambda addr=addr, length=length: player.read("PCSA", addr, length), 1
+        yield f"player/write {size}", lambda addr=addr, data=data: player.write("PCSA", addr, data), 1
+
+    # the first write far into a block allocates one page, not everything before it
+    data = rng.randbytes(16)
+    yield "memory/new block 16@0x100000", lambda: Block().write(0x100000, data), 1
+
+
+def handler_cases():
+    rng = Random(14902)
+    state = State(Database())
+    for data_type in range(6):
+        state.write_glob(data_type, 0, bytes(0x4000))
+        state.write_glrg(1, data_type, 0, bytes(0x4000))
+
+    connection = Connection(NullSocket(), CompressionPolicy(), set())
+    connection.player = state.add_player(PERM_ID)
+    connection.player.write("PCSA", 0, bytes(0x4000))
+    connection.player.set_position(10, 10, 1)
+    # some company in the region
+    for id in range(2, 50):
+        state.add_player(id).set_position(id, id, 1)
+
+    # sparse block contents, as the client writes them
+    block = bytearray(1024)
+    for _ in range(64):
+        block[rng.randrange(1024)] = rng.randrange(256)
+    block = bytes(block)
+
+    packets = {
+        "LAHI": Packets.LAHI.pack(),
+        "LAUP": Packets.LAUP.pack(tail=EncodeString("username") + EncodeString("password")),
+        "DSLG": Packets.DSLG.pack(tail=EncodeString("client log line " * 4)),
+        "DSSL": Packets.DSSL.pack(),
+        "DSNS": Packets.DSNS.pack(0),
+        "DSPS": Packets.DSPS.pack(PERM_ID, 0, 10, 10, 1),
+        "DSDT": Packets.DSDT.pack(PERM_ID),
+        "DSRS": Packets.DSRS.pack(PERM_ID, 0),
+        "DSRL": Packets.DSRL.pack(PERM_ID, 0),
+        "DSNM": Packets.DSNM.pack(0, tail=EncodeString("Bench")),
+        "DSRI": Packets.DSRI.pack(PERM_ID, 1),
+        "DSRD GLOB 1k": Packets.DSRD.pack(PERM_ID, b"GLOB", 3, 0, 0x100, 1024),
+        "DSRD GLRG 1k": Packets.DSRD.pack(PERM_ID, b"GLRG", 1, 3, 0x100, 1024),
+        "DSRD GLRG 16k": Packets.DSRD.pack(PERM_ID, b"GLRG", 1, 3, 0, 0x4000),
+        "DSRD PCSA 1k": Packets.DSRD.pack(PERM_ID, b"PCSA", 0, 0, 0x100, 1024),
+        "DSRD PCIN 1k": Packets.DSRD.pack(PERM_ID, b"PCIN", PERM_ID, 0, 0, 1024),
+        "DSWQ GLOB 1k": Packets.DSWQ.pack(PERM_ID, b"GLOB", 3, 0, 0, 0x100, 1024, tail=block),
+        "DSWQ GLRG 1k": Packets.DSWQ.pack(PERM_ID, b"GLRG", 1, 3, 0, 0x100, 1024, tail=block),
+        "DSWT PCSA 1k": Packets.DSWT.pack(PERM_ID, b"PCSA", 0, 0, 0, 0x100, 1024, tail=block),
+        "DSWT PCIN 1k": Packets.DSWT.pack(PERM_ID, b"PCIN", PERM_ID, 0, 0, 0, 1024, tail=block),
+    }
+
+    def handle(data):
+        connection.handle(data, state)
+        # the socket would take it all, skip the flush
+        connection.outgoing.clear()
+        connection.queued = 0
+
+    for name, data in packets.items():
+        yield f"handle/{name}", lambda data=data: handle(data), 1
+
+    # the cost of counting them
+    metered = Connection(NullSocket(), CompressionPolicy(), set(), metrics=Metrics())
+    metered.player = connection.player
+
+    def handle_metered(data):
+        metered.handle(data, state)
+        metered.outgoing.clear()
+        metered.queued = 0
+
+    for name in ("DSSL", "DSPS", "DSRD GLRG 1k"):
+        yield f"handle/{name} +metrics", lambda data=packets[name]: handle_metered(data), 1
+
+    # login needs a fresh token, and the player dropped again after
+    dsit = Packets.DSIT.pack(tail=EncodeString("benchtoken"))
+
+    def ten_init():
+        state.tokens["benchtoken"] = 1000
+        handle(dsit)
+        state.drop_player(1000)
+
+    yield "handle/DSIT", ten_init, 1
+
+
+def multicast_cases():
+    state = State(Database())
+    multicast = Multicast(CompressionPolicy())
+    connections = []
+    for id in range(1, 101):
+        c = Connection(NullSocket(), multicast.policy, set(), multicast=multicast)
+        c.player = state.add_player(id)
+        multicast.join(c)
+        connections.append(c)
+    # an announcement long enough to be worth compressing
+    packet = b"dsNR" + EncodeString("The server will restart in five minutes. " * 8) + bytes(256)
+
+    def clear():
+        for c in connections:
+            c.outgoing.clear()
+            c.queued = 0
+
+    def unicast():
+        for c in connections:
+            c.send(packet)
+        clear()
+
+    def fan_out():
+        multicast.send(packet, multicast.everyone())
+        clear()
+
+    yield "send/100 players one by one", unicast, 1
+    yield "send/100 players multicast", fan_out, 1
+
+
+def timer_cases():
+    wheel = TimerWheel()
+    rng = Random(14902)
+    # a server's worth of pending timers, from the next tick to hours away
+    for _ in range(10000):
+        wheel.after(rng.uniform(0, 10000), int)
+
+    def schedule_cancel():
+        wheel.cancel(wheel.after(60, int))
+
+    yield "timers/after + cancel", schedule_cancel, 1
+    yield "timers/timeout", wheel.timeout, 1
+    yield "timers/run (nothing due)", wheel.run, 1
+
+
+def database_cases(tmp):
+    rng = Random(14902)
+    # a region as the client leaves it: mostly empty blocks of various sizes
+    glrg = {}
+    for data_type in range(6):
+        data = bytearray(0x1000 << (data_type % 3))
+        for _ in range(len(data) // 32):
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        glrg[data_type] = Block.from_bytes(data)
+
+    with Sqlite3(Path(tmp) / "bench.db") as db:
+
+        def round_trip():
+            db.save_glrg(7, glrg)
+            return db.get_glrg(7)
+
+        yield "sqlite/save_glrg", lambda: db.save_glrg(7, glrg), 1
+        yield "sqlite/get_glrg", lambda: db.get_glrg(7), 1
+        yield "sqlite/glrg round trip", round_trip, 1
+
+
+def cases(tmp):
+    """Yield (name, function, calls per function call) for every benchmark"""
+    yield from codec_cases()
+    yield from memory_cases()
+    yield from handler_cases()
+    yield from multicast_cases()
+    yield from timer_cases()
+    yield from database_cases(tmp)
+
+
+def measure(func, calls, repeat):
+    """Best time per call in seconds"""
+    timer = Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number / calls
+
+
+def compare(results, baseline, threshold):
+    """Print results next to the baseline.  Returns the number of cases that got slower than the threshold."""
+    failures = 0
+    print(f"{'case':<36} {'us/call':>10} {'baseline':>10} {'change':>8}")
+    for name, seconds in results.items():
+        try:
+            base = baseline[name]
+        except KeyError:
+            print(f"{name:<36} {seconds * 1e6:>10.2f} {'-':>10}")
+            continue
+        change = seconds / base - 1
+        failed = change > threshold
+        failures += failed
+        print(
+            f"{name:<36} {seconds * 1e6:>10.2f} {base * 1e6:>10.2f} {change:>+8.1%}"
+            + ("  FAIL" if failed else "")
+        )
+    return failures
+
+
+def main():
+    parser = ArgumentParser(description="Run the DSOServer micro-benchmarks.")
+    parser.add_argument("-k", "--filter", default="", help="only run cases whose name contains this")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="timing runs per case, the best is kept (default: %(default)s)")
+    parser.add_argument("-s", "--save", type=Path, help="write results to this JSON file")
+    parser.add_argument("-c", "--compare", type=Path, help="compare results to this JSON file")
+    parser.add_argument(
+        "-t",
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="fraction slower than the baseline that fails a case (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    with TemporaryDirectory() as tmp:
+        for name, func, calls in cases(tmp):
+            if args.filter in name:
+                results[name] = measure(func, calls, args.repeat)
+                if not args.compare:
+                    print(f"{name:<36} {results[name] * 1e6:>10.2f} us")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(
+                {"python": platform.python_version(), "machine": platform.machine(), "results": results},
+                file,
+                indent=1,
+            )
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        failures = compare(results, baseline, args.threshold)
+        if failures:
+            print(f"{failures} cases more than {args.threshold:.0%} slower than the baseline")
+            exit(1)
+        print(f"No case more than {args.threshold:.0%} slower than the baseline")
+
+
+if __name__ == "__main__":
+    main()
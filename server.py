@@ -8,8 +8,10 @@ This software is released under the GNU AGPL 3.0.  See file LICENSE for more inf
 """
 
 import logging
-from argparse import ArgumentParser
+from argparse import ArgumentParser, BooleanOptionalAction
+from datetime import datetime
 from pathlib import Path
+from sys import exit
 
 # need at least one provider for persistent storage
 #  sqlite3 is fine, you could replace this with something else
@@ -17,6 +19,12 @@ from DSOServer.Database import Sqlite3
 
 # the guts of a running server
 from DSOServer.Server import Server
+from DSOServer.AsyncServer import AsyncServer
+from DSOServer.Cluster import Cluster
+from DSOServer.Capture import Capture
+from DSOServer.Journal import Journal
+from DSOServer.Replication import Follower, Primary, parse_address
+from DSOServer.State import State
 
 # Read CLI args we want to use to set up everything
 parser = ArgumentParser(
@@ -44,6 +52,85 @@ parser.add_argument(
     type=Path,
     default="server.db",
 )
+parser.add_argument(
+    "-w",
+    "--high-water",
+    help="Outgoing bytes a client can fall behind by before it is disconnected (default: %(default)s)",
+    type=int,
+    default=0x100000,
+)
+parser.add_argument(
+    "-e",
+    "--engine",
+    help="Event loop implementation to run the server on (default: %(default)s)",
+    choices=["selectors", "asyncio"],
+    default="selectors",
+)
+parser.add_argument(
+    "-n",
+    "--workers",
+    help="Number of worker processes sharing the port, with regions split between them.  Needs SO_REUSEPORT and the selectors engine (default: %(default)s)",
+    type=int,
+    default=1,
+)
+parser.add_argument(
+    "-c",
+    "--capture",
+    help="Record all client traffic to this packet capture file, for tools/replay.py (default: off)",
+    type=Path,
+)
+parser.add_argument(
+    "--capture-size",
+    help="Megabytes per capture file before starting a new one (default: %(default)s)",
+    type=int,
+    default=64,
+)
+parser.add_argument(
+    "-m",
+    "--metrics-port",
+    help="Serve metrics in Prometheus format on this local port (default: off)",
+    type=int,
+)
+parser.add_argument(
+    "--region-memory",
+    help="Megabytes of GLRG region memory to keep loaded (per worker) before unloading regions nobody is using (default: %(default)s)",
+    type=int,
+    default=State.region_memory >> 20,
+)
+parser.add_argument(
+    "--reply-cache",
+    help="Megabytes of encoded GLOB / GLRG replies to keep for sending again (per worker, default: %(default)s)",
+    type=int,
+    default=State.reply_memory >> 20,
+)
+parser.add_argument(
+    "--journal",
+    help="Record every world and player memory write in <database>.journal.*, to recover them after a crash (default: on, except with --workers, which can't be journaled)",
+    action=BooleanOptionalAction,
+)
+parser.add_argument(
+    "--journal-sync",
+    help="fsync the journal after each batch of writes, so they survive the machine going down too",
+    action="store_true",
+)
+parser.add_argument(
+    "--recover-until",
+    help="Replay only the journaled writes made up to this local time (like 2024-05-01T18:30), rewinding the world to it",
+    type=lambda text: datetime.fromisoformat(text).timestamp(),
+)
+parser.add_argument(
+    "--replicate",
+    help="Stream every write to hot-standby followers connecting to this host:port or Unix socket path (needs the journal)",
+)
+parser.add_argument(
+    "--follow",
+    help="Run as a hot standby of the primary at this host:port or Unix socket path, keeping a copy of its world in --database, until promoted ('promote' on the console)",
+)
+parser.add_argument(
+    "--promote",
+    help="With --follow, take over serving on --port as soon as the primary goes away",
+    action="store_true",
+)
 parser.add_argument(
     "-l",
     "--level",
@@ -56,7 +143,67 @@ args = parser.parse_args()
 # set up logger level
 logging.basicConfig(level=logging.getLevelName(args.level))
 
-# open the db
-with Sqlite3(args.database) as db:
+# every State made from here on (workers are forked, so theirs too)
+State.region_memory = args.region_memory << 20
+State.reply_memory = args.reply_cache << 20
+
+if args.workers > 1:
+    if (
+        args.capture
+        or args.metrics_port
+        or args.replicate
+        or args.follow
+        or args.engine != "selectors"
+        or args.recover_until is not None
+    ):
+        parser.error(
+            "--capture, --metrics-port, --replicate, --follow, --recover-until and --engine asyncio are not supported with --workers"
+        )
+    if args.journal or args.journal_sync:
+        parser.error("--journal and --journal-sync are not supported with --workers")
+    logging.warning("Running %d workers without a journal: writes since the last checkpoint are lost in a crash", args.workers)
+    # each process opens the db for itself
+    Cluster((args.address, args.port), args.database, args.workers, args.high_water, args.level).run()
+    exit()
+
+# on unless turned off
+if args.journal is None:
+    args.journal = True
+if args.replicate and not args.journal:
+    parser.error("--replicate needs the journal")
+
+if args.follow:
+    # the follower's own copy, which it serves from if promoted
+    with Sqlite3(args.database, check_same_thread=False) as db:
+        promoted = Follower(parse_address(args.follow), db, args.metrics_port, args.promote).run()
+    if not promoted:
+        exit()
+
+capture = Capture(args.capture, args.capture_size << 20) if args.capture else None
+journal = (
+    Journal(f"{args.database}.journal", args.journal_sync, args.recover_until)
+    if args.journal
+    else None
+)
+if args.replicate:
+    journal.primary = Primary(parse_address(args.replicate))
+
+# open the db - the server runs it on a thread of its own
+with Sqlite3(args.database, check_same_thread=False) as db:
     # Run the server!
-    Server((args.address, args.port), db).run()
+    if args.engine == "asyncio":
+        AsyncServer(
+            (args.address, args.port), db, args.high_water, capture, args.metrics_port, journal
+        ).run()
+    else:
+        Server(
+            (args.address, args.port),
+            db,
+            args.high_water,
+            capture=capture,
+            metrics_port=args.metrics_port,
+            journal=journal,
+        ).run()
+
+if capture:
+    capture.close()
@@ -0,0 +1,11 @@
+from benchmarks.suite import cases
+
+
+def test_cases_run(tmp_path):
+    # every benchmark works against the current code, so the suite doesn't quietly rot
+    names = set()
+    for name, func, calls in cases(tmp_path):
+        func()
+        assert name not in names
+        names.add(name)
+    assert any(name.startswith("handle/") for name in names)
@@ -0,0 +1,49 @@
+from DSOServer import Capture
+from DSOServer.Compression import CompressionPolicy, RLEUncompress
+from DSOServer.Database import Database
+from DSOServer.Server import CapturingConnection
+from DSOServer.State import State
+
+from .test_framing import FakeSocket, frame
+
+
+def test_capture_split(tmp_path):
+    # records keep the decoded packet, and the wire frame of compressed ones, even when split up
+    log = b"DSLG" + bytes([200, 0, 0, 0]) + bytes(199) + b"\0"
+    stream = frame(b"LAHI") + frame(log, True) + frame(b"DSSL", True)
+    socket = FakeSocket([stream[i : i + 3] for i in range(0, len(stream), 3)])
+
+    capture = Capture.Capture(tmp_path / "capture.bin")
+    connection = CapturingConnection(capture, socket, CompressionPolicy(), set())
+    state = State(Database())
+    while socket.chunks:
+        assert connection.recv(state)
+    connection.close(state)
+    capture.close()
+
+    records = list(Capture.read(tmp_path / "capture.bin"))
+    received = [(data, raw) for _, _, direction, data, raw in records if direction == Capture.IN]
+    assert [data for data, _ in received] == [b"LAHI", log, b"DSSL"]
+    assert received[0][1] == b""
+    assert received[1][1] == frame(log, True)
+    assert received[2][1] == frame(b"DSSL", True)
+
+    sent = [(data, raw) for _, _, direction, data, raw in records if direction == Capture.OUT]
+    assert [data[:4] for data, _ in sent] == [b"laHI", b"dsSL"]
+    for data, raw in sent:
+        assert not raw or RLEUncompress(raw[2:]) == data
+
+    assert records[-1][2] == Capture.CLOSED
+
+
+def test_capture_rotate(tmp_path):
+    path = tmp_path / "capture.bin"
+    capture = Capture.Capture(path, max_bytes=150)
+    for i in range(10):
+        capture.write(1, Capture.IN, bytes([i]) * 40)
+    capture.close()
+
+    # oldest first
+    files = [tmp_path / f"capture.bin.{i}" for i in range(4, 0, -1)] + [path]
+    data = [data[0] for file in files for _, _, _, data, _ in Capture.read(file)]
+    assert data == list(range(10))
@@ -0,0 +1,101 @@
+import sqlite3
+from threading import current_thread
+
+from DSOServer.Database import Database, DatabaseThread, Sqlite3
+from DSOServer.Memory import PAGE_SIZE
+from DSOServer.State import State
+
+
+def page(data):
+    """A whole page starting with data"""
+    return data + bytes(PAGE_SIZE - len(data))
+
+
+class Recorder(Database):
+    """Remembers every checkpoint saved, and the thread it was saved from"""
+
+    def __init__(self):
+        self.saved = []
+
+    def save_checkpoint(self, glob, glrg, player):
+        self.saved.append((sorted(glob), sorted(glrg), sorted(player), current_thread().name))
+
+
+def test_checkpoint_dirty_blocks():
+    db = Recorder()
+    state = State(DatabaseThread(db))
+    state.write_glob(1, 4, b"ab")
+    state.write_glob(1, 0, b"x")
+    state.write_glrg(3, 2, 0, b"rg")
+    player = state.add_player(9)
+    player.write("PCSA", 2, b"pc")
+    state.read_glob(2, 0, 4)
+
+    state.checkpoint()
+    state.saving.result()
+    assert db.saved == [
+        (
+            [(1, 0, page(b"x\0\0\0ab"))],
+            [(3, 2, 0, page(b"rg"))],
+            [(9, "PCSA", 0, page(b"\0\0pc"))],
+            "database",
+        )
+    ]
+
+    # nothing changed since
+    state.checkpoint()
+    state.saving.result()
+    assert len(db.saved) == 1
+
+    # only the pages written
+    state.write_glrg(3, 5, 0, b"5")
+    state.write_glrg(3, 2, PAGE_SIZE * 9, b"far")
+    state.checkpoint()
+    state.saving.result()
+    assert db.saved[-1][:3] == ([], [(3, 2, 9, page(b"far")), (3, 5, 0, page(b"5"))], [])
+
+    # the rest is saved by close, which waits for it
+    state.write_glob(2, 0, b"g")
+    state.close()
+    assert db.saved[-1][:3] == ([(2, 0, page(b"g"))], [], [])
+    state.database.close()
+
+
+def test_checkpoint_retired_player():
+    db = Recorder()
+    state = State(DatabaseThread(db))
+    state.add_player(9).write("PCSA", 0, b"one")
+    state.drop_player(9)
+
+    # back before they were saved: the db doesn't have their data yet
+    assert state.add_player(9).read("PCSA", 0, 3) == b"one"
+    state.players[9].write("PCSA", 3, b"two")
+    state.drop_player(9)
+
+    state.checkpoint()
+    state.saving.result()
+    assert db.saved[-1][2] == [(9, "PCSA", 0, page(b"onetwo"))]
+    # forgotten once written
+    state.checkpoint()
+    assert state.retired == {}
+    state.close()
+    state.database.close()
+
+
+def test_checkpoint_sqlite(tmp_path):
+    path = tmp_path / "world.db"
+    with Sqlite3(path, check_same_thread=False) as db:
+        db.connection.execute("INSERT INTO login(id, username, password) VALUES(9, 'u', 'p')")
+        db.connection.commit()
+        state = State(DatabaseThread(db))
+        state.write_glrg(3, 2, 0, b"region")
+        state.add_player(9).write("PCSA", 0, b"save")
+        state.checkpoint()
+        state.saving.result()
+
+        # in the file already, without closing
+        with sqlite3.connect(path) as other:
+            assert other.execute("SELECT page, data FROM glrg WHERE region=3 AND key=2").fetchall() == [(0, page(b"region"))]
+            assert other.execute("SELECT page, data FROM player WHERE id=9").fetchall() == [(0, page(b"save"))]
+        state.close()
+        state.database.close()
@@ -0,0 +1,122 @@
+import selectors
+import socket
+from multiprocessing.connection import Connection, wait
+from threading import Thread
+from time import monotonic
+
+from DSOServer.Cluster import Broker, ClusterState, Worker
+from DSOServer.Database import Database
+
+
+def channels(count):
+    """Broker and worker ends of a channel for each of count workers"""
+    pairs = [socket.socketpair() for _ in range(count)]
+    return [Connection(a.detach()) for a, _ in pairs], [Connection(b.detach()) for _, b in pairs]
+
+
+def deliver(broker):
+    """Have the broker handle every message the workers sent it"""
+    while ready := wait(broker.channels, 0.1):
+        for channel in ready:
+            broker.dispatch(channel, channel.recv())
+
+
+def answered(broker, function, owner=None):
+    """
+    Run a worker's call of the broker on a thread of its own, passing messages along here (to the
+    worker that owns what it's about, if it's forwarded) until it returns
+    """
+    result = []
+    thread = Thread(target=lambda: result.append(function()))
+    thread.start()
+    deadline = monotonic() + 5
+    while thread.is_alive():
+        assert monotonic() < deadline, "timed out"
+        for channel in wait(broker.channels, 0.01):
+            broker.dispatch(channel, channel.recv())
+        while owner and owner.channel.poll():
+            assert owner.receive() is None
+    thread.join()
+    return result[0]
+
+
+def test_proxied_glrg():
+    ends, (w0, w1) = channels(2)
+    broker = Broker(Database(), ends)
+    first = ClusterState(Database(), w0, 0, 2)
+    second = ClusterState(Database(), w1, 1, 2)
+
+    # region 3 belongs to the second worker: the first one's write goes there through the broker
+    assert not first.owns_region(3) and second.owns_region(3)
+    answered(broker, lambda: first.write_glrg(3, 2, 4, b"hello"), second)
+    assert bytes(second.read_glrg(3, 2, 4, 5)) == b"hello"
+    assert 3 not in first.glrg
+    assert answered(broker, lambda: first.read_glrg(3, 2, 4, 5), second) == b"hello"
+    # and nothing is cached for memory somebody else writes
+    assert first.glrg_version(3, 2) is None and second.glrg_version(3, 2)
+
+
+def test_claim_and_release():
+    ends, (w0, w1) = channels(2)
+    broker = Broker(Database(), ends)
+    first = ClusterState(Database(), w0, 0, 2)
+    second = ClusterState(Database(), w1, 1, 2)
+
+    assert answered(broker, lambda: first.add_player(5))
+    assert broker.directory[5] == [0, 0]
+    # on one worker at a time
+    assert answered(broker, lambda: second.add_player(5)) is None
+    assert answered(broker, second.player_count) == 1
+
+    first.players[5].set_position(1, 1, 4)
+    deliver(broker)
+    assert broker.directory[5] == [0, 4]
+    assert answered(broker, lambda: second.ids_in_region(4)) == (5,)
+
+    first.drop_player(5)
+    deliver(broker)
+    assert 5 not in broker.directory
+    assert answered(broker, lambda: second.add_player(5))
+    assert broker.directory[5] == [1, 0]
+
+
+def worker(channel, index):
+    """A Worker ready to take clients, without its loop running"""
+    worker = Worker(("127.0.0.1", 0), Database(), channel, index, 2)
+    worker.sel = selectors.DefaultSelector()
+    worker.db_thread = Database()
+    worker.state = worker.make_state()
+    return worker
+
+
+def test_handoff():
+    ends, (w0, w1) = channels(2)
+    broker = Broker(Database(), ends)
+    first = worker(w0, 0)
+    second = worker(w1, 1)
+
+    client, server = socket.socketpair()
+    c = first.add_connection(server)
+    c.player = answered(broker, lambda: first.state.add_player(5))
+    first.multicast.join(c)
+
+    # moving into a region of the second worker hands the client socket over there
+    c.player.set_position(1, 1, 3)
+    assert first.state.migrations == {5: 1}
+    first.flush()
+    assert not first.connections and 5 not in first.state.players
+    deliver(broker)
+    assert broker.directory[5] == [1, 3]
+
+    second.on_broker(selectors.EVENT_READ)
+    second.flush()
+    (adopted,) = second.connections.values()
+    assert adopted.player.id == 5 and adopted.player.slots["position"] == [1, 1]
+    assert second.state.regions[3] == {5}
+
+    client.sendall(b"still there")
+    assert adopted.socket.recv(0x100) == b"still there"
+    adopted.socket.sendall(b"yes")
+    assert client.recv(0x100) == b"yes"
+    client.close()
+    adopted.socket.close()
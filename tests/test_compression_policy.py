@@ -0,0 +1,31 @@
+from DSOServer.Compression import CompressionPolicy, RLECompress, i32
+
+
+def test_learns_to_skip():
+    policy = CompressionPolicy(warmup=4, probe=10)
+
+    # a reply that never shrinks: tried during warmup, then skipped until a re-probe
+    data = bytes("dsSL", "ascii") + bytes([1, 2, 3, 4])
+    assert all(policy.compress(data) is None for _ in range(20))
+    stats = policy.stats[b"dsSL"]
+    assert stats.packets == 20
+    assert stats.won == 0
+    assert stats.tried == 6
+    assert stats.skipped == 14
+    assert stats.saved == 0
+
+    # another opcode that does shrink is unaffected
+    data = bytes("dsRS", "ascii") + i32(1) + i32(0) + i32(2)
+    for _ in range(20):
+        assert policy.compress(data) == RLECompress(data)
+    assert policy.stats[b"dsRS"].skipped == 0
+    assert policy.stats[b"dsRS"].saved == 20 * (len(data) - len(RLECompress(data)))
+
+
+def test_zero_estimate():
+    policy = CompressionPolicy(large=64)
+
+    assert policy.compress(bytes("dsRD", "ascii") + bytes(range(1, 250))) is None
+    assert policy.stats[b"dsRD"].skipped == 1
+    assert policy.compress(bytes("dsRD", "ascii") + bytes(250)) is not None
+    assert policy.stats[b"dsRD"].won == 1
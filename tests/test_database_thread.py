@@ -0,0 +1,94 @@
+from threading import Event
+
+from DSOServer.Compression import CompressionPolicy, EncodeString
+from DSOServer.Database import Database, DatabaseThread, Sqlite3
+from DSOServer.Memory import Block
+from DSOServer.Server import Connection
+from DSOServer.State import State
+
+from .test_framing import FakeSocket, frame, replies
+
+
+class Batches(Database):
+    """Records each save_batch, and can hold the thread up until told to go on"""
+
+    def __init__(self):
+        self.batches = []
+        self.go = Event()
+
+    def get_login(self, username, password):
+        self.go.wait()
+        return 7 if password == "p" else None
+
+    def save_batch(self, calls):
+        self.batches.append([method for method, _ in calls])
+
+
+def test_saves_batched():
+    db = Batches()
+    thread = DatabaseThread(db)
+    # queued up behind a slow request, then done together
+    login = thread.submit("get_login", "u", "p")
+    saves = [thread.submit("save_glob", {1: b"x"}) for _ in range(3)]
+    saves.append(thread.submit("save_checkpoint", [], [], []))
+    after = thread.submit("get_login", "u", "nope")
+    db.go.set()
+
+    assert login.result() == 7 and after.result() is None
+    assert [save.result() for save in saves] == [None] * 4
+    assert db.batches == [["save_glob", "save_glob", "save_glob", "save_checkpoint"]]
+    thread.close()
+    assert not thread.thread.is_alive()
+
+
+def test_login_waits_on_database():
+    db = Batches()
+    thread = DatabaseThread(db)
+    state = State(thread)
+    login = frame(b"LAUP" + EncodeString("u") + EncodeString("p"))
+    socket = FakeSocket([login + frame(b"DSSL")])
+    connection = Connection(socket, CompressionPolicy(), set())
+
+    # the reply waits for the database, and so do the packets behind it
+    assert connection.recv(state)
+    assert connection.waiting
+    assert not connection.outgoing
+
+    db.go.set()
+    connection.waiting[0].result()
+    assert connection.resume(state)
+    assert connection.waiting is None
+    assert connection.flush()
+    assert replies(socket.sent) == [b"laOK", b"dsSL"]
+    assert list(state.tokens.values()) == [7]
+    thread.close()
+
+
+def test_player_loads_on_thread():
+    with Sqlite3(":memory:", check_same_thread=False) as db:
+        db.connection.execute("INSERT INTO login(id, username, password) VALUES(9, 'u', 'p')")
+        db.save_player(9, {"PCSA": Block.from_bytes(b"saved")})
+        thread = DatabaseThread(db)
+        # stopped before the db is closed, even if the test fails
+        try:
+            state = State(thread)
+            token = state.issue_token(9)
+
+            socket = FakeSocket([frame(b"DSIT" + EncodeString(token))])
+            connection = Connection(socket, CompressionPolicy(), set())
+            assert connection.recv(state)
+            if connection.waiting:
+                connection.waiting[0].result()
+                assert connection.resume(state)
+            assert connection.player.read("PCSA", 0, 5) == b"saved"
+            assert connection.flush()
+            assert replies(socket.sent) == [b"dsIN"]
+
+            # back before their changes were saved: nothing to load
+            connection.player.write("PCSA", 0, b"S")
+            connection.close(state)
+            assert state.load_player(9).done()
+            state.close()
+        finally:
+            thread.close()
+        assert db.get_player(9)["PCSA"].read(0, 6) == b"Saved\0"
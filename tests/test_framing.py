@@ -0,0 +1,111 @@
+from DSOServer.Compression import CompressionPolicy, RLECompress, RLEUncompress
+from DSOServer.Server import Connection
+from DSOServer.State import State
+from DSOServer.Database import Database
+
+
+class FakeSocket:
+    """Stands in for a client socket: serves queued chunks to recv_into, collects sends"""
+
+    def __init__(self, chunks, limit=None):
+        self.chunks = list(chunks)
+        self.sent = bytearray()
+        # most bytes accepted per send call
+        self.limit = limit
+        self.calls = 0
+
+    def recv_into(self, buffer):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        data = b"".join(buffers)[: self.limit]
+        if not data:
+            raise BlockingIOError
+        self.sent += data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def frame(data, compress=False):
+    if compress:
+        data = RLECompress(data)
+        return ((2 + len(data)) | 0x8000).to_bytes(2, "little") + data
+    return (2 + len(data)).to_bytes(2, "little") + data
+
+
+def replies(data):
+    """Split a stream of sent packets back up, returning their tags"""
+    tags = []
+    while data:
+        length = int.from_bytes(data[0:2], "little")
+        packet = data[2 : length & 0x7FFF]
+        if length & 0x8000:
+            packet = RLEUncompress(packet)
+        tags.append(bytes(packet[0:4]))
+        data = data[length & 0x7FFF :]
+    return tags
+
+
+def test_pipelined():
+    # many packets in one read, all handled at once
+    stream = frame(b"DSSL") * 5 + frame(b"LAHI") + frame(b"DSSL", True)
+    socket = FakeSocket([stream])
+    connection = Connection(socket, CompressionPolicy(), set())
+    assert connection.recv(State(Database()))
+    assert connection.flush()
+    assert socket.calls == 1
+    assert replies(socket.sent) == [b"dsSL"] * 5 + [b"laHI", b"dsSL"]
+
+
+def test_split():
+    # packets split at every possible point, compressed ones included
+    stream = frame(b"LAHI") + frame(b"DSSL", True) + frame(b"DSLG" + bytes([4, 0, 0, 0]) + b"abc\0", True) + frame(b"DSSL")
+    socket = FakeSocket([stream[i : i + 1] for i in range(len(stream))])
+    connection = Connection(socket, CompressionPolicy(), set())
+    state = State(Database())
+    while socket.chunks:
+        assert connection.recv(state)
+    assert connection.flush()
+    assert replies(socket.sent) == [b"laHI", b"dsSL", b"dsSL"]
+    assert not connection.recv(state)
+
+
+def test_wraparound():
+    # enough traffic to push packets across the end of the receive buffer
+    packet = frame(b"DSLG" + bytes([199, 0, 0, 0]) + bytes(range(1, 100)) * 2 + b"\0")
+    stream = packet * 1000
+    socket = FakeSocket([stream[i : i + 4000] for i in range(0, len(stream), 4000)])
+    connection = Connection(socket, CompressionPolicy(), set())
+    state = State(Database())
+    while socket.chunks:
+        assert connection.recv(state)
+    assert connection.start == connection.end
+
+
+def test_partial_writes():
+    socket = FakeSocket([frame(b"DSSL") * 10], limit=7)
+    pending = set()
+    connection = Connection(socket, CompressionPolicy(), pending)
+    assert connection.recv(State(Database()))
+    assert pending == {connection}
+
+    # each flush gets a little further, until everything is out in order
+    while connection.outgoing:
+        assert connection.flush()
+    assert connection.queued == 0
+    assert replies(socket.sent) == [b"dsSL"] * 10
+
+
+def test_high_water():
+    socket = FakeSocket([frame(b"DSSL") * 10], limit=0)
+    connection = Connection(socket, CompressionPolicy(), set(), high_water=50)
+    assert not connection.recv(State(Database()))
+    assert connection.flush()
+    assert connection.queued > 50
@@ -0,0 +1,66 @@
+from random import Random
+
+from DSOServer.Compression import CompressionPolicy
+from DSOServer.Database import Database
+from DSOServer.Interest import Interest
+from DSOServer.Server import Connection
+from DSOServer.State import State
+
+from .test_framing import FakeSocket
+
+
+def test_interest_matches_brute_force():
+    rng = Random(14902)
+    interest = Interest(view_range=50)
+    where = {}
+    for _ in range(20):
+        moved = []
+        for _ in range(100):
+            id = rng.randrange(200)
+            if rng.random() < 0.05:
+                interest.left(id)
+                where.pop(id, None)
+                if id in moved:
+                    moved.remove(id)
+                continue
+            position = (rng.randrange(3), rng.randrange(400), rng.randrange(400))
+            interest.moved(id, *position, id, id)
+            where[id] = position
+            if id not in moved:
+                moved.append(id)
+
+        # everyone hears about every move in their region and within range, in order
+        expected = {}
+        for mover in moved:
+            region, x, y = where[mover]
+            for other, (other_region, ox, oy) in where.items():
+                if other_region == region and abs(ox - x) <= 50 and abs(oy - y) <= 50:
+                    expected.setdefault(other, []).append(mover)
+
+        assert interest.tick() == expected
+        assert not interest.dirty
+
+
+def test_interest_left_clears_grid():
+    interest = Interest()
+    interest.moved(1, 3, 10, 10, b"a", "one")
+    interest.moved(1, 4, 10, 10, b"b", "one")
+    assert list(interest.regions) == [4]
+    interest.left(1)
+    assert interest.regions == {} and interest.tick() == {}
+
+
+def test_position_under_own_id():
+    state = State(Database())
+    c = Connection(FakeSocket([]), CompressionPolicy(), set())
+    # before logging in, ignored
+    assert c.on_position(state, 7, 0, 10, 10, 3)
+    assert not state.interest.players
+
+    c.player = state.add_player(7)
+    # whatever id the client claims to be
+    assert c.on_position(state, 99, 0, 10, 10, 3)
+    assert list(state.interest.players) == [7]
+    assert state.interest.players[7].entry[:4] == (7).to_bytes(4, "little")
+    c.close(state)
+    assert not state.interest.players and not state.interest.regions
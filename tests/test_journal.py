@@ -0,0 +1,84 @@
+from DSOServer import Journal as journal_module
+from DSOServer.Database import DatabaseThread, Sqlite3
+from DSOServer.Journal import Journal
+from DSOServer.State import State
+
+
+def crash(state):
+    """Stop without the final save, as if the process died after the last loop iteration"""
+    state.journal.commit()
+    state.journal.file.close()
+    state.database.close()
+
+
+def start(path, until=None):
+    db = Sqlite3(path, check_same_thread=False)
+    db.connection.execute("INSERT OR IGNORE INTO login(id, username, password) VALUES(9, 'u', 'p')")
+    db.connection.commit()
+    return State(DatabaseThread(db), Journal(f"{path}.journal", until=until))
+
+
+def test_journal_recovers_after_crash(tmp_path):
+    path = tmp_path / "world.db"
+    state = start(path)
+    state.write_glob(1, 4, b"glob")
+    state.write_glrg(3, 2, 0x2000, b"region")
+    state.add_player(9).write("PCSA", 0, b"save")
+    crash(state)
+
+    state = start(path)
+    assert state.read_glob(1, 4, 4) == b"glob"
+    assert state.read_glrg(3, 2, 0x2000, 6) == b"region"
+    assert state.add_player(9).read("PCSA", 0, 4) == b"save"
+
+    # saved to the database as soon as recovered, and the journal dropped once it is
+    state.saving.result()
+    state.checkpoint()
+    assert state.journal.numbers() == [state.journal.number]
+    state.close()
+    assert state.database.database.get_glrg(3)[2].read(0x2000, 6) == b"region"
+    assert list(tmp_path.glob("world.db.journal.*")) == []
+    state.database.close()
+
+
+def test_journal_truncated_by_checkpoint(tmp_path):
+    path = tmp_path / "world.db"
+    state = start(path)
+    journal = state.journal
+    state.write_glob(1, 0, b"one")
+    state.checkpoint()
+    state.write_glob(1, 0, b"two")
+    journal.commit()
+    assert journal.number == 2 and journal.numbers()[-1] == 2
+
+    # each file goes once a checkpoint after it is saved
+    state.saving.result()
+    state.checkpoint()
+    state.saving.result()
+    state.checkpoint()
+    assert journal.numbers() == [3]
+
+    state.write_glob(1, 0, b"new")
+    crash(state)
+    state = start(path)
+    assert state.read_glob(1, 0, 3) == b"new"
+    state.close()
+    state.database.close()
+
+
+def test_journal_point_in_time(tmp_path, monkeypatch):
+    path = tmp_path / "world.db"
+    state = start(path)
+    for now, data in ((100.0, b"early"), (200.0, b"later")):
+        monkeypatch.setattr(journal_module, "time", lambda: now)
+        state.write_glrg(3, 2, 0, data)
+    crash(state)
+
+    # a partial entry at the end, as if cut off mid-write
+    with open(f"{path}.journal.1", "ab") as file:
+        file.write(b"\0" * 10)
+
+    state = start(path, until=150.0)
+    assert state.read_glrg(3, 2, 0, 5) == b"early"
+    state.close()
+    state.database.close()
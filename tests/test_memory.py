@@ -0,0 +1,62 @@
+import sqlite3
+from random import Random
+
+from DSOServer.Database import Sqlite3
+from DSOServer.Memory import PAGE_SIZE, Block
+
+
+def test_block_matches_bytearray():
+    # random reads and writes, some across pages, compared against a plain buffer
+    rng = Random(14902)
+    block = Block()
+    plain = bytearray(PAGE_SIZE * 8)
+    for _ in range(500):
+        addr = rng.randrange(PAGE_SIZE * 7)
+        length = rng.choice((1, 16, PAGE_SIZE // 2, PAGE_SIZE + 3))
+        if rng.randrange(2):
+            data = rng.randbytes(length)
+            block.write(addr, data)
+            plain[addr : addr + length] = data
+        else:
+            assert block.read(addr, length) == plain[addr : addr + length]
+    assert bytes(block) == bytes(plain[: len(bytes(block))])
+
+
+def test_block_sparse():
+    block = Block()
+    block.write(PAGE_SIZE * 100 + 10, b"far")
+    # one page allocated, and the rest reads back as zeros
+    assert list(block.pages) == [100] and block.memory() == PAGE_SIZE
+    assert block.read(0, 4) == bytes(4)
+    assert block.read(PAGE_SIZE * 100 + 8, 6) == b"\0\0far\0"
+
+    # a read within a page is a view of it, not a copy
+    view = block.read(PAGE_SIZE * 100 + 10, 3)
+    assert isinstance(view, memoryview) and view.obj is block.pages[100]
+
+    block.write(PAGE_SIZE * 2 - 1, b"ab")
+    # pages written since last asked, copied
+    changed = block.changes()
+    assert [page for page, _ in changed] == [1, 2, 100]
+    assert changed[0][1][-1:] == b"a" and changed[1][1][:1] == b"b"
+    assert block.changes() == []
+
+
+def test_old_database_split_into_pages(tmp_path):
+    path = tmp_path / "world.db"
+    # blocks stored whole, as before pages
+    with sqlite3.connect(path) as old:
+        old.execute("CREATE TABLE login(id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL COLLATE NOCASE, password TEXT NOT NULL, UNIQUE(username)) STRICT")
+        old.execute("CREATE TABLE glob(key INTEGER PRIMARY KEY, data BLOB NOT NULL) STRICT")
+        old.execute("CREATE TABLE glrg(region INTEGER NOT NULL, key INTEGER NOT NULL, data BLOB NOT NULL, PRIMARY KEY(region, key)) WITHOUT ROWID, STRICT")
+        old.execute("INSERT INTO glob VALUES(1, ?)", (b"g",))
+        old.execute("INSERT INTO glrg VALUES(3, 2, ?)", (bytes(PAGE_SIZE * 50) + b"tail",))
+    old.close()
+
+    with Sqlite3(path) as db:
+        assert db.get_glob()[1].read(0, 2) == b"g\0"
+        block = db.get_glrg(3)[2]
+        # the zeros before it aren't stored
+        assert list(block.pages) == [50]
+        assert block.read(PAGE_SIZE * 50, 5) == b"tail\0"
+        assert db.connection.execute("SELECT count(*) FROM player").fetchone() == (0,)
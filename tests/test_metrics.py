@@ -0,0 +1,31 @@
+from DSOServer.Compression import CompressionPolicy
+from DSOServer.Database import Database
+from DSOServer.Metrics import Metrics
+from DSOServer.State import State
+from DSOServer.Server import Connection
+
+from .test_framing import FakeSocket, frame
+
+
+def test_metrics_counts():
+    metrics = Metrics()
+    socket = FakeSocket([frame(b"DSSL") * 3 + frame(b"LAHI") + frame(b"XXXX")])
+    connection = Connection(socket, CompressionPolicy(), set(), metrics=metrics)
+    state = State(Database())
+    state.add_player(5).set_position(1, 2, 7)
+    assert connection.recv(state)
+
+    assert metrics.wire_in == 6 * 5
+    assert metrics.unknown == 1
+    assert metrics.opcodes[b"DSSL"].received == 3
+    assert sum(metrics.opcodes[b"DSSL"].buckets) == 3
+    assert metrics.opcodes[b"dsSL"].sent == 3
+    assert metrics.opcodes[b"dsSL"].wire_out == 3 * (2 + 8)
+    assert metrics.opcodes[b"laHI"].sent == 1
+
+    text = metrics.prometheus(state, 1)
+    assert 'dso_packets_received_total{opcode="DSSL"} 3' in text
+    assert 'dso_handler_seconds_bucket{opcode="DSSL",le="+Inf"} 3' in text
+    assert 'dso_region_players{region="7"} 1' in text
+    assert "dso_connections_open 1" in text
+    assert metrics.report(state, 1)[0].startswith("1 connections, 1 players online")
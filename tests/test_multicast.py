@@ -0,0 +1,62 @@
+from DSOServer.Compression import CompressionPolicy, EncodeString
+from DSOServer.Database import Database
+from DSOServer.Metrics import Metrics
+from DSOServer.Multicast import Multicast
+from DSOServer.Server import Connection
+from DSOServer.State import State
+
+from .test_framing import FakeSocket
+
+
+def connect(state, multicast, id, region, high_water=0x100000):
+    c = Connection(FakeSocket([]), multicast.policy, set(), high_water, multicast=multicast)
+    c.player = state.add_player(id)
+    c.player.set_position(0, 0, region)
+    multicast.join(c)
+    return c
+
+
+def test_multicast_encodes_once():
+    state = State(Database())
+    metrics = Metrics()
+    multicast = Multicast(CompressionPolicy(), metrics)
+    connections = [connect(state, multicast, id, id % 2) for id in range(1, 7)]
+
+    packet = b"dsNR" + EncodeString("hello " * 20)
+    assert multicast.send(packet, multicast.everyone()) == []
+    # the same buffers queued everywhere
+    header, payload = connections[0].outgoing
+    assert all(c.outgoing[0] is header and c.outgoing[1] is payload for c in connections)
+    assert multicast.policy.stats[b"dsNR"].packets == 1
+    assert metrics.opcodes[b"dsNR"].sent == 6
+
+    for c in connections:
+        assert c.flush()
+        assert c.socket.sent == bytes(header) + bytes(payload)
+
+    multicast.send(b"dsNR" + EncodeString("odd"), multicast.region(state, 1))
+    assert [bool(c.outgoing) for c in connections] == [True, False] * 3
+    multicast.send(b"dsNR" + EncodeString("two"), multicast.players([2, 4, 99]))
+    assert [len(c.outgoing) for c in connections] == [2, 2, 2, 2, 2, 0]
+
+
+def test_multicast_backpressure():
+    state = State(Database())
+    multicast = Multicast(CompressionPolicy())
+    behind = connect(state, multicast, 1, 0, high_water=64)
+    ok = connect(state, multicast, 2, 0, high_water=64)
+    behind.send(b"dsXX" + bytes(range(48)), False)
+
+    packet = b"dsNR" + EncodeString("x" * 20)
+    # skipped for the recipient that can't take it, not dropped
+    assert multicast.send(packet, multicast.everyone(), False) == []
+    assert len(behind.outgoing) == 2 and len(ok.outgoing) == 2
+    assert multicast.skipped == 1
+
+    # unless it has to arrive
+    assert multicast.send(packet, multicast.everyone(), False, droppable=False) == [behind]
+
+    # leaving the world, or a connection that never joined
+    behind.close(state)
+    multicast.leave(Connection(FakeSocket([]), multicast.policy, set()))
+    assert multicast.everyone() == (ok,)
@@ -0,0 +1,56 @@
+from os import getpid
+
+from DSOServer import Packets
+from DSOServer.Compression import EncodeString
+from DSOServer.Database import Database
+from DSOServer.Memory import PAGE_SIZE, zeros
+from DSOServer.Server import buildSlotResults, handlers
+from DSOServer.State import State
+
+
+def test_registry():
+    for tag, packet in Packets.registry.items():
+        assert len(tag) == 4
+        assert packet.tag == tag
+        assert len(packet.names) == len(packet.struct.unpack(bytes(packet.struct.size))) - 1
+
+
+def test_round_trip():
+    data = Packets.DSRD.pack(1, b"GLRG", 2, 3, 4, 5)
+    assert data == b"DSRD" + bytes([1, 0, 0, 0]) + b"GLRG" + bytes([2, 0, 0, 0, 3, 0, 0, 0, 4, 0, 0, 0, 5, 0, 0, 0])
+    assert Packets.DSRD.unpack(data) == (1, b"GLRG", 2, 3, 4, 5)
+
+    data = Packets.DSWQ.pack(1, b"GLOB", 2, 0, 0, 8, 3, tail=b"abc")
+    assert Packets.DSWQ.unpack(data) == (1, b"GLOB", 2, 0, 0, 8, 3, b"abc")
+
+    data = Packets.dsRI.pack(1, 2, -3, tail=bytes(12))
+    assert data[12:16] == bytes([0xFD, 0xFF, 0xFF, 0xFF])
+
+
+def test_handlers():
+    # every client request (upper-case tag) has a handler, and every handler a request
+    requests = {tag for tag in Packets.registry if tag.isupper()}
+    assert set(handlers) == requests
+    for tag, (packet, _) in handlers.items():
+        assert Packets.registry[tag] is packet
+
+
+def test_pack_parts():
+    parts = [b"ab", memoryview(b"cd"), bytearray(b"e")]
+    assert Packets.dsPS.pack_parts((1, 2), parts) == Packets.dsPS.pack(1, 2, tail=b"abcde")
+
+    player = State(Database()).add_player(7)
+    player.slots["name"] = ["one", "", "three", ""]
+    player.slots["slot"] = 2
+    expect = EncodeString("three")
+    for name in player.slots["name"]:
+        expect += bytes(4) + EncodeString(name)
+    expect += getpid().to_bytes(4, "little")
+    assert buildSlotResults(player) == Packets.dsIN.pack(7, 1, 1, 1, 1, tail=expect)
+
+
+def test_zeros():
+    # short runs of zeros are views of one shared buffer, nothing allocated
+    assert zeros(16) == bytes(16) and isinstance(zeros(16), memoryview)
+    assert zeros(PAGE_SIZE + 1) == bytes(PAGE_SIZE + 1)
+    assert Packets.dsRD.pack(1, b"GLRG", 0, 0, 1, 0, 4, tail=zeros(4))[-4:] == bytes(4)
@@ -0,0 +1,126 @@
+from random import Random
+
+from DSOServer.Database import Database, Sqlite3
+from DSOServer.Memory import PAGE_SIZE, Block
+from DSOServer.State import REGION_IDLE, State
+from DSOServer.Timers import TimerWheel
+
+from .test_timers import Clock
+
+
+def scan(state, region):
+    # what ids_in_region used to do
+    return tuple(sorted(id for id, player in state.players.items() if player.slots["region"] == region))
+
+
+def test_region_index():
+    rng = Random(14902)
+    state = State(Database())
+    for _ in range(2000):
+        action = rng.randrange(10)
+        id = rng.randrange(1, 100)
+        if action == 0:
+            state.add_player(id)
+        elif action == 1 and id in state.players:
+            state.drop_player(id)
+        elif id in state.players:
+            state.players[id].set_position(0, 0, rng.randrange(8))
+
+        region = rng.randrange(8)
+        ids = state.ids_in_region(region)
+        assert ids == scan(state, region)
+        assert state.packed_ids_in_region(region) == b"".join(id.to_bytes(4, "little") for id in ids)
+
+    # nothing left behind for empty regions
+    assert all(state.regions.values())
+
+
+def test_region_cache():
+    state = State(Database())
+    state.add_player(1).set_position(0, 0, 5)
+    packed = state.packed_ids_in_region(5)
+    # unrelated movement keeps the cached list
+    state.add_player(2).set_position(0, 0, 6)
+    assert state.packed_ids_in_region(5) is packed
+    state.players[2].set_position(1, 1, 5)
+    assert state.ids_in_region(5) == (1, 2)
+
+
+class Loads(Database):
+    """Counts the regions loaded"""
+
+    def __init__(self):
+        self.loaded = []
+
+    def get_glrg(self, region):
+        self.loaded.append(region)
+        return {}
+
+
+def test_region_lazy_load():
+    db = Loads()
+    state = State(db)
+    assert db.loaded == [] and state.glrg == {}
+
+    assert state.read_glrg(4, 1, 0, 3) == bytes(3)
+    state.write_glrg(4, 1, 0, b"abc")
+    assert state.read_glrg(4, 1, 0, 3) == b"abc"
+    assert db.loaded == [4]
+
+    # asked for as soon as someone walks in (not at login, before they say where they are), used when first read
+    player = state.add_player(1)
+    assert db.loaded == [4]
+    player.set_position(0, 0, 6)
+    assert db.loaded == [4, 6] and 6 in state.loading
+    state.read_glrg(6, 1, 0, 1)
+    assert db.loaded == [4, 6] and 6 not in state.loading and state.region_loads == 2
+    # a first position in the region players start out in
+    state.add_player(2).set_position(0, 0, 0)
+    assert db.loaded == [4, 6, 0]
+    # loaded but never used: taken in at the next checkpoint
+    state.checkpoint()
+    assert state.loading == {} and sorted(state.glrg) == [0, 4, 6]
+
+
+def walked(state):
+    # what region_memory_used used to do
+    return sum(block.memory() for blocks in state.glrg.values() for block in blocks.values())
+
+
+class Small(State):
+    region_memory = 2 * PAGE_SIZE
+
+
+def test_region_eviction():
+    with Sqlite3(":memory:") as db:
+        db.save_glrg(3, {0: Block.from_bytes(b"3")})
+        state = Small(db)
+        clock = Clock(1000.0)
+        state.timers = TimerWheel(clock=clock)
+
+        state.write_glrg(1, 0, 0, bytes(60))
+        state.write_glrg(2, 0, 0, b"2" * 60)
+        # over budget, but both were just used
+        assert sorted(state.glrg) == [1, 2]
+        assert state.region_memory_used() == walked(state) == 2 * PAGE_SIZE
+        state.write_glrg(2, 0, 10, b"same page")
+        state.write_glrg(2, 0, PAGE_SIZE - 1, b"and the next")
+        assert state.region_memory_used() == walked(state) == 3 * PAGE_SIZE
+
+        clock.now += REGION_IDLE + 1
+        state.read_glrg(1, 0, 0, 1)
+        state.add_player(5).set_position(0, 0, 3)
+        state.read_glrg(3, 0, 0, 1)
+        # the least recently used goes, written back as it does
+        assert sorted(state.glrg) == [1, 3] and state.region_evictions == 1
+        assert state.region_memory_used() == walked(state) == 2 * PAGE_SIZE
+        assert db.get_glrg(2)[0].read(0, 61) == b"2" * 10 + b"same page" + b"2" * 41 + b"\0"
+        assert (2, 0) not in state.dirty_glrg
+        assert state.read_glrg(2, 0, 58, 4) == b"22\0\0"
+        assert state.region_memory_used() == walked(state)
+
+        # nobody unloads a region with a player in it
+        clock.now += REGION_IDLE + 1
+        state.checkpoint()
+        assert 3 in state.glrg and state.region_memory_used() <= 2 * PAGE_SIZE
+        state.close()
@@ -0,0 +1,93 @@
+import socket
+from threading import Thread
+from time import monotonic, sleep
+
+from DSOServer.Database import DatabaseThread, Sqlite3
+from DSOServer.Journal import Journal
+from DSOServer import Replication
+from DSOServer.Replication import ENTRIES, Follower, Link, Primary, header, parse_address
+from DSOServer.State import State
+
+
+def until(condition, timeout=5.0):
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline, "timed out"
+        sleep(0.01)
+
+
+def test_parse_address():
+    assert parse_address("127.0.0.1:9000") == (socket.AF_INET, ("127.0.0.1", 9000))
+    assert parse_address(":9000") == (socket.AF_INET, ("", 9000))
+    assert parse_address("/tmp/dso.sock") == (socket.AF_UNIX, "/tmp/dso.sock")
+
+
+def test_link_queue(monkeypatch, caplog):
+    monkeypatch.setattr(Replication, "MAX_QUEUED", 100000)
+    ours, theirs = socket.socketpair()
+    link = Link(ours, "test")
+    for _ in range(100):
+        link.put(ENTRIES, b"x" * 500)
+    received = 0
+    while received < 100 * (header.size + 500):
+        received += len(theirs.recv(0x10000))
+    until(lambda: link.queued == 0)
+
+    # more than the follower reads, until it's too far behind and dropped
+    while link.alive:
+        link.put(ENTRIES, bytes(50000))
+    assert "too far behind" in caplog.text
+    theirs.close()
+    link.thread.join(5)
+    assert not link.thread.is_alive()
+
+
+def test_follower_copies_and_takes_over(tmp_path):
+    address = parse_address(str(tmp_path / "replication.sock"))
+    with Sqlite3(tmp_path / "primary.db", check_same_thread=False) as db, Sqlite3(
+        tmp_path / "follower.db", check_same_thread=False
+    ) as copy:
+        db.connection.execute("INSERT INTO login(id, username, password) VALUES(9, 'u', 'p')")
+        db.save_glrg(4, {})
+        db.connection.commit()
+
+        journal = Journal(tmp_path / "primary.db.journal")
+        journal.primary = Primary(address)
+        primary = State(DatabaseThread(db), journal)
+        # before the follower: it gets these in the snapshot, some saved and some only in memory
+        primary.write_glrg(3, 2, 0, b"saved")
+        primary.checkpoint()
+        primary.write_glob(1, 0, b"memory")
+        journal.commit()
+
+        follower = Follower(address, copy, promote_on_loss=True, console=False)
+        promoted = []
+        thread = Thread(target=lambda: promoted.append(follower.run()))
+        thread.start()
+        try:
+            until(lambda: journal.primary.links or journal.primary.tick())
+            until(lambda: follower.state)
+            assert follower.state.read_glob(1, 0, 6) == b"memory"
+            assert follower.state.read_glrg(3, 2, 0, 5) == b"saved"
+
+            # then the stream, as it's committed
+            primary.write_glrg(3, 2, 0, b"after")
+            primary.add_player(9).write("PCSA", 0, b"save")
+            journal.commit()
+            until(lambda: follower.applied == 2)
+            assert follower.state.read_glrg(3, 2, 0, 5) == b"after"
+            journal.primary.tick()
+            until(lambda: follower.newest is not None)
+            assert 0 <= follower.lag < 1
+        finally:
+            # the primary going away promotes the follower, with everything saved
+            primary.close()
+            primary.database.close()
+            thread.join(5)
+        assert promoted == [True]
+
+    with Sqlite3(tmp_path / "follower.db") as copy:
+        assert copy.get_login("u", "p") == 9
+        assert copy.get_glob()[1].read(0, 6) == b"memory"
+        assert copy.get_glrg(3)[2].read(0, 5) == b"after"
+        assert copy.get_player(9)["PCSA"].read(0, 4) == b"save"
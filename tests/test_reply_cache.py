@@ -0,0 +1,102 @@
+from DSOServer import Capture, Packets
+from DSOServer.Compression import CompressionPolicy, RLEUncompress
+from DSOServer.Database import Database
+from DSOServer.Metrics import Metrics
+from DSOServer.ReplyCache import ReplyCache
+from DSOServer.Server import CapturingConnection, Connection
+from DSOServer.State import State
+
+from .test_framing import FakeSocket, frame
+
+
+class Uncompressed:
+    def compress(self, data):
+        return None
+
+
+def read(state, perm_id, block, index1, index2, addr, length, policy=None):
+    """Send a DSRD from perm_id, and return the dsRD that comes back (uncompressed) and its frame"""
+    socket = FakeSocket([frame(Packets.DSRD.pack(perm_id, block, index1, index2, addr, length))])
+    c = Connection(socket, policy or CompressionPolicy(), set(), metrics=Metrics())
+    assert c.recv(state) and c.flush()
+    sent = bytes(socket.sent)
+    header = int.from_bytes(sent[0:2], "little")
+    packet = sent[2:]
+    if header & 0x8000:
+        packet = RLEUncompress(packet)
+    return packet, sent
+
+
+def test_reads_cached_until_written():
+    state = State(Database())
+    state.write_glrg(3, 2, 0x100, b"chest")
+    state.write_glob(1, 0, bytes(range(1, 200)))
+
+    # mostly zeros, so compressed
+    first, wire = read(state, 7, b"GLRG", 3, 2, 0, 0x400)
+    assert first == Packets.dsRD.pack(7, b"GLRG", 3, 2, 1, 0, 0x400, tail=state.read_glrg(3, 2, 0, 0x400))
+    assert wire[1] & 0x80 and state.replies.misses == 1
+
+    # the same encoding, with someone else's id in it
+    again, wire_again = read(state, 8, b"GLRG", 3, 2, 0, 0x400)
+    assert again == first[:4] + (8).to_bytes(4, "little") + first[8:]
+    assert wire_again[:7] == wire[:7] and wire_again[11:] == wire[11:]
+    assert state.replies.hits == 1
+
+    # uncompressed too
+    glob, wire = read(state, 7, b"GLOB", 1, 0, 0, 199, Uncompressed())
+    assert not wire[1] & 0x80
+    assert read(state, 9, b"GLOB", 1, 0, 0, 199)[0] == glob[:4] + (9).to_bytes(4, "little") + glob[8:]
+
+    # a write anywhere in the block is a new version
+    state.write_glrg(3, 2, 0x3FF, b"!")
+    changed, _ = read(state, 8, b"GLRG", 3, 2, 0, 0x400)
+    assert changed[-1:] == b"!" and changed[0x100 + 32 : 0x105 + 32] == b"chest"
+    assert (state.replies.hits, state.replies.misses) == (2, 3)
+    assert len(state.replies.entries) == 3
+
+    # cached per player, never
+    state.add_player(7).write("PCSA", 0, b"mine")
+    read(state, 7, b"PCIN", 7, 0, 0, 4)
+    assert len(state.replies.entries) == 3
+
+
+def test_hits_queue_the_cached_payload(tmp_path):
+    state = State(Database())
+    state.write_glrg(3, 2, 0x100, b"chest")
+    request = frame(Packets.DSRD.pack(7, b"GLRG", 3, 2, 0, 0x400))
+    read(state, 7, b"GLRG", 3, 2, 0, 0x400)
+    (entry,) = state.replies.entries.values()
+
+    # views of the cached buffer around the reader's id, not a copy
+    capture = Capture.Capture(tmp_path / "capture.bin")
+    c = CapturingConnection(capture, FakeSocket([request]), CompressionPolicy(), set())
+    assert c.recv(state)
+    header, before, id, after = c.outgoing
+    assert header is entry[1] and before.obj is entry[2] and after.obj is entry[2]
+    assert id == (7).to_bytes(4, "little")
+    assert c.flush()
+    capture.close()
+
+    # the capture still gets the packet as sent
+    ((data, raw),) = [(data, raw) for _, _, direction, data, raw in Capture.read(tmp_path / "capture.bin") if direction == Capture.OUT]
+    assert data == Packets.dsRD.pack(7, b"GLRG", 3, 2, 1, 0, 0x400, tail=state.read_glrg(3, 2, 0, 0x400))
+    assert raw == bytes(c.socket.sent)
+
+
+def test_cache_bounded():
+    cache = ReplyCache(max_bytes=1400)
+    packet = Packets.dsRD.pack(0xFFFFFFFF, b"GLOB", 0, 0, 1, 0, 100, tail=bytes(range(1, 101)))
+    header = (2 + len(packet)).to_bytes(2, "little")
+    for key in range(5):
+        cache.put(key, packet, header, packet)
+    # oldest out first, unless used since
+    assert list(cache.entries) == [1, 2, 3, 4] and cache.bytes <= 1400
+    assert cache.get(1) and cache.get(0) is None
+    cache.put(5, packet, header, packet)
+    assert list(cache.entries) == [3, 4, 1, 5]
+    assert cache.hit_rate() == 0.5
+
+    # too big to keep, but still sendable
+    big = packet + bytes(1400)
+    assert cache.put(6, big, header, big)[2] is big and 6 not in cache.entries
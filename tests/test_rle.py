@@ -1,4 +1,8 @@
-from DSOServer.Compression import RLECompress, RLEUncompress
+from random import Random
+
+import pytest
+
+from DSOServer.Compression import RLECompress, RLEDecoder, RLEUncompress
 
 
 def test_uncompress():
@@ -27,3 +31,76 @@ def test_reversible():
     data_in = bytes([0x64, 0x73, 0x49, 0x4e, 0x1, 0x0, 0x0, 0x0, 0x1, 0x1, 0x1, 0x1, 0xa, 0x0, 0x0, 0x0, 0x35, 0x37, 0x30, 0x38, 0x38, 0x30, 0x31, 0x36, 0x34, 0x0, 0x1, 0x0, 0x0, 0x0, 0xa, 0x0, 0x0, 0x0, 0x35, 0x37, 0x30, 0x38, 0x38, 0x30, 0x31, 0x36, 0x34, 0x0, 0x0, 0x0, 0x0, 0x0, 0x1, 0x0, 0x0, 0x0, 0x0, 0x0, 0x0, 0x0, 0x0, 0x1, 0x0, 0x0, 0x0, 0x0, 0x0, 0x0, 0x0, 0x0, 0x1, 0x0, 0x0, 0x0, 0x0, 0x1, 0x0, 0x0, 0x0])
 
     assert RLEUncompress(RLECompress(data_in)) == data_in
+
+
+# byte-at-a-time codec the run-based one replaced, kept as the reference
+def reference_compress(data):
+    result = bytearray()
+
+    start = 0
+    length = len(data)
+    while start < length:
+        end = start + 1
+
+        if end < length and data[start] == 0 and data[end] == 0:
+            end += 1
+            while end - start < 129 and end < length and data[end] == 0:
+                end += 1
+            result.append(0x101 - (end - start))
+            start = end
+
+        else:
+            while end - start < 128 and end < length:
+                if end + 1 < length and data[end] == 0 and data[end + 1] == 0:
+                    break
+                else:
+                    end += 1
+
+            result.append(end - start - 1)
+            while start < end:
+                result.append(data[start])
+                start += 1
+
+    return result
+
+
+def test_equivalence():
+    rng = Random(14902)
+    for _ in range(2000):
+        # mix of dense and zero-heavy payloads, with long runs either way
+        zero_chance = rng.random()
+        data = bytearray()
+        target = rng.randrange(600)
+        while len(data) < target:
+            if rng.random() < zero_chance:
+                data += bytes(rng.randrange(1, 300))
+            else:
+                data += rng.randbytes(rng.randrange(1, 300))
+
+        compressed = RLECompress(data)
+        assert compressed == reference_compress(data)
+        assert RLEUncompress(compressed) == data
+        assert RLECompress(memoryview(data)) == compressed
+        assert RLEUncompress(memoryview(compressed)) == data
+
+
+def test_truncated():
+    with pytest.raises(ValueError):
+        RLEUncompress(bytes([4, 1, 2]))
+
+
+def test_decoder_chunks():
+    rng = Random(14902)
+    for _ in range(200):
+        data = bytes(rng.randrange(200)) + rng.randbytes(rng.randrange(400)) + bytes(rng.randrange(200))
+        compressed = RLECompress(data)
+
+        # feed in random-sized pieces, with extra trailing bytes that belong to the next packet
+        stream = compressed + b"next"
+        decoder = RLEDecoder(len(compressed))
+        ptr = 0
+        while not decoder.done:
+            ptr += decoder.feed(memoryview(stream)[ptr : ptr + rng.randrange(1, 64)])
+
+        assert ptr == len(compressed)
+        assert decoder.finish() == data
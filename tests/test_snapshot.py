@@ -0,0 +1,55 @@
+from DSOServer.Database import Sqlite3
+from DSOServer.Memory import PAGE_SIZE
+from DSOServer.Snapshot import Snapshot, export, restore, write
+
+
+def world(db):
+    db.connection.execute("INSERT INTO login(id, username, password) VALUES(7, 'Someone', 'secret')")
+    db.save_checkpoint(
+        [(1, 0, b"glob")],
+        [(3, 2, 0, b"region"), (3, 2, 5, b"far page"), (8, 0x10, 1, b"other")],
+        [(7, "PCSA", 0, b"player")],
+    )
+
+
+def test_export_and_restore(tmp_path):
+    with Sqlite3(tmp_path / "world.db") as db:
+        world(db)
+        export(db, tmp_path / "world.snap")
+    assert not (tmp_path / "world.snap.tmp").exists()
+
+    snapshot = Snapshot(tmp_path / "world.snap")
+    assert snapshot.get_login("someone", "secret") == 7
+    assert snapshot.get_login("someone", "wrong") is None
+    assert snapshot.get_regions() == {3, 8}
+    assert snapshot.get_glob()[1].read(0, 4) == b"glob"
+    region = snapshot.get_glrg(3)[2]
+    assert region.read(0, 6) == b"region"
+    assert region.read(5 * PAGE_SIZE, 8) == b"far page"
+    assert region.read(PAGE_SIZE, 4) == bytes(4)
+    assert snapshot.get_glrg(8)[0x10].read(PAGE_SIZE, 5) == b"other"
+    assert snapshot.get_glrg(9) == {}
+    assert snapshot.get_player(7)["PCSA"].read(0, 6) == b"player"
+
+    with Sqlite3(tmp_path / "copy.db") as copy:
+        restore(tmp_path / "world.snap", copy)
+        assert copy.get_login("Someone", "secret") == 7
+        assert copy.get_glrg(3)[2].read(5 * PAGE_SIZE, 8) == b"far page"
+        assert copy.get_player(7)["PCSA"].read(0, 6) == b"player"
+
+
+def test_pages_are_mapped_copy_on_write(tmp_path):
+    path = tmp_path / "world.snap"
+    write(path, [], [], [(3, 2, 0, b"region")], [])
+    snapshot = Snapshot(path)
+    block = snapshot.get_glrg(3)[2]
+    assert isinstance(block.pages[0], memoryview)
+
+    block.write(0, b"change")
+    assert block.read(0, 6) == b"change"
+    assert b"change" not in path.read_bytes()
+
+    # a new snapshot replaces the file whole, while the old one stays mapped
+    write(path, [], [], [(3, 2, 0, b"newer")], [])
+    assert Snapshot(path).get_glrg(3)[2].read(0, 5) == b"newer"
+    assert block.read(0, 6) == b"change"
@@ -0,0 +1,90 @@
+from random import Random
+
+from DSOServer.Database import Sqlite3
+from DSOServer.State import TOKEN_LIFETIME, State
+from DSOServer.Timers import TimerWheel
+
+
+class Clock:
+    """A clock that only moves when told to"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_timer_wheel():
+    # timers spread over every wheel and past the last, compared against their deadlines
+    rng = Random(14902)
+    clock = Clock(rng.uniform(0, 1e5))
+    wheel = TimerWheel(0.01, clock)
+    fired = []
+    deadlines = {}
+    timers = {}
+    for i in range(500):
+        delay = rng.choice((rng.uniform(0, 1), rng.uniform(0, 100), rng.uniform(0, 3e5)))
+        deadlines[i] = clock.now + delay
+        timers[i] = wheel.after(delay, fired.append, i)
+    for i in rng.sample(range(500), 100):
+        wheel.cancel(timers[i])
+        del deadlines[i]
+    assert len(wheel) == 400
+
+    end = clock.now + 3.1e5
+    while clock.now < end:
+        timeout = wheel.timeout()
+        clock.now += rng.choice((timeout if timeout is not None else 1000, rng.uniform(0, 2000)))
+        done = len(fired)
+        wheel.run()
+        # never early, and never more than a tick late
+        assert all(deadlines[i] <= clock.now for i in fired[done:])
+        assert all(i in fired for i, deadline in deadlines.items() if deadline < clock.now - 0.01)
+
+    assert sorted(fired) == sorted(deadlines)
+    assert len(wheel) == 0 and wheel.timeout() is None
+
+
+def test_timer_every():
+    clock = Clock(10.0)
+    wheel = TimerWheel(0.01, clock)
+    calls = []
+    timer = wheel.every(0.5, calls.append, "tick")
+    wheel.after(0.2, wheel.cancel, timer)
+    assert abs(wheel.timeout() - 0.2) < 1e-6
+
+    clock.now = 10.1
+    assert wheel.run() == 0
+    clock.now = 10.6
+    assert wheel.run() == 1
+    assert calls == [] and len(wheel) == 0
+
+    timer = wheel.every(0.5, calls.append, "tick")
+    for now in (11.2, 11.3, 11.7, 14.0, 14.4):
+        clock.now = now
+        wheel.run()
+    # one call per due time, without catching up on the ones missed
+    assert len(calls) == 4
+    wheel.cancel(timer)
+    wheel.cancel(timer)
+    assert len(wheel) == 0
+
+
+def test_token_expiry():
+    with Sqlite3(":memory:") as db:
+        db.connection.execute("INSERT INTO login(id, username, password) VALUES(7, 'u', 'p')")
+        state = State(db)
+        clock = Clock(100.0)
+        state.timers = TimerWheel(clock=clock)
+
+        token = state.get_login_token("u", "p")
+        assert state.get_login_token("u", "nope") is None
+        clock.now += TOKEN_LIFETIME - 1
+        state.timers.run()
+        assert state.return_login_token(token) == 7
+
+        clock.now += 2
+        state.timers.run()
+        assert state.return_login_token(token) is None
+        assert state.tokens == {}
@@ -0,0 +1,414 @@
+#!/bin/env python3
+
+"""
+loadgen.py - Simulate many DSO clients against a running server
+Greg Kennedy, 2025
+
+Each bot logs in like the real client does:
+ * LAUP launcher login, to get a token
+ * DSIT with that token on a new connection, then DSNS / DSNM to pick a character slot and name
+and then loops until the time is up, sending one request at a time from a weighted mix of
+ * DSPS movement, DSRI region queries, DSRD / DSWQ GLRG reads and writes, DSSL pings
+with a random think time in between.  The time from sending each request to receiving its reply
+is recorded, and throughput and latency percentiles are reported per opcode at the end.  DSPS has no
+reply of its own: the server pushes batched dsPS position updates every tick, to everyone near a
+player who moved, so those are counted separately.
+
+Bots log in as <prefix>0, <prefix>1, ... with the same password.  Pass -d with the server's database
+to create those accounts first.
+
+Run from the root folder with e.g.: python3 -m tools.loadgen -d server.db --bots 200
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+import asyncio
+import random
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from DSOServer import Packets
+from DSOServer.Compression import RLECompress, RLEUncompress, DecodeString, EncodeString
+
+# the reply (or replies) each request is answered with
+REPLIES = {
+    "LAUP": ("laOK", "laNO"),
+    "DSIT": ("dsIN", "dsNI"),
+    "DSNS": ("dsIN",),
+    "DSNM": ("dsNM",),
+    # answered, along with everyone else nearby who moved, by the next dsPS push
+    "DSPS": (),
+    "DSRI": ("dsRI",),
+    "DSRD": ("dsRD",),
+    "DSWQ": ("dsWT", "dsWE"),
+    "DSSL": ("dsSL",),
+}
+
+# sent by the server on its own: batched position updates, every tick
+PUSHES = ("dsPS",)
+
+# opcodes bots may send in their main loop
+MIX = ("DSPS", "DSRI", "DSRD", "DSWQ", "DSSL")
+
+
+def frame(data):
+    """Add the length header, compressing the packet if that makes it smaller"""
+    compressed = RLECompress(data)
+    if len(compressed) < len(data):
+        return ((2 + len(compressed)) | 0x8000).to_bytes(2, "little") + compressed
+    return (2 + len(data)).to_bytes(2, "little") + data
+
+
+async def read_packet(reader):
+    header = await reader.readexactly(2)
+    length = int.from_bytes(header, "little")
+    data = await reader.readexactly((length & 0x7FFF) - 2)
+    return bytes(RLEUncompress(data)) if length & 0x8000 else data
+
+
+class Stats:
+    """Latencies of every request sent, by opcode"""
+
+    __slots__ = "latency", "sent", "pushes", "positions", "errors", "unexpected"
+
+    def __init__(self):
+        # opcode => list of seconds
+        self.latency = {}
+        # requests with no reply to time: opcode => count
+        self.sent = {}
+        # dsPS pushes received, and the position entries in them
+        self.pushes = 0
+        self.positions = 0
+        # bots that gave up, reason => count
+        self.errors = {}
+        # packets received that weren't the reply being waited on
+        self.unexpected = 0
+
+    def add(self, opcode, seconds):
+        try:
+            self.latency[opcode].append(seconds)
+        except KeyError:
+            self.latency[opcode] = [seconds]
+
+    def add_sent(self, opcode):
+        self.sent[opcode] = self.sent.get(opcode, 0) + 1
+
+    def add_push(self, packet):
+        self.pushes += 1
+        self.positions += Packets.dsPS.unpack(packet)[1]
+
+    def error(self, reason):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def report(self, elapsed):
+        """Return lines of a per-opcode summary table"""
+        lines = [
+            f"{'opcode':<6} {'count':>8} {'per sec':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        ]
+        total = 0
+        for opcode, times in sorted(self.latency.items()):
+            times.sort()
+            total += len(times)
+            lines.append(
+                f"{opcode:<6} {len(times):>8} {len(times) / elapsed:>9.1f}"
+                f" {percentile(times, 0.5) * 1000:>8.2f} {percentile(times, 0.9) * 1000:>8.2f}"
+                f" {percentile(times, 0.99) * 1000:>8.2f} {times[-1] * 1000:>8.2f}"
+            )
+        for opcode, count in sorted(self.sent.items()):
+            total += count
+            lines.append(f"{opcode:<6} {count:>8} {count / elapsed:>9.1f} {'(no reply)':>8}")
+        lines.append(f"{'total':<6} {total:>8} {total / elapsed:>9.1f}")
+
+        if self.pushes:
+            lines.append(
+                f"{self.pushes} dsPS pushes received ({self.pushes / elapsed:.1f} per sec), with {self.positions} positions"
+            )
+        if self.unexpected:
+            lines.append(f"{self.unexpected} unexpected packets received")
+        for reason, count in sorted(self.errors.items()):
+            lines.append(f"{count} bots failed: {reason}")
+        return lines
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Bot:
+    """One simulated client"""
+
+    __slots__ = (
+        "args",
+        "stats",
+        "username",
+        "random",
+        "reader",
+        "writer",
+        "receiver",
+        "waiting",
+        "perm_id",
+        "region",
+    )
+
+    def __init__(self, args, stats, number):
+        self.args = args
+        self.stats = stats
+        self.username = f"{args.prefix}{number}"
+        self.random = random.Random(args.seed * 100003 + number)
+
+        self.reader = None
+        self.writer = None
+        # Task reading the game connection, and (replies, Future) of the request waiting on it
+        self.receiver = None
+        self.waiting = None
+        self.perm_id = 0
+        self.region = self.random.randrange(args.regions)
+
+    async def request(self, opcode, data, writer=None, reader=None):
+        """
+        Send one packet and wait for its reply, which is returned.  The game connection's packets are
+        read by receive(), a given reader (the launcher's) here.  Requests with no reply return None.
+        """
+        replies = REPLIES[opcode]
+        if not replies:
+            (writer or self.writer).write(frame(data))
+            self.stats.add_sent(opcode)
+            return None
+
+        start = perf_counter()
+        if reader:
+            writer.write(frame(data))
+            while True:
+                reply = await read_packet(reader)
+                if str(reply[:4], "ascii") in replies:
+                    break
+                self.stats.unexpected += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.waiting = (replies, future)
+            self.writer.write(frame(data))
+            await asyncio.wait((future, self.receiver), return_when=asyncio.FIRST_COMPLETED)
+            if not future.done():
+                # the connection closed: raises why
+                self.receiver.result()
+            reply = future.result()
+
+        self.stats.add(opcode, perf_counter() - start)
+        return reply
+
+    async def receive(self):
+        """Read the game connection: pushes are counted, and replies handed to the request waiting on them"""
+        while True:
+            packet = await read_packet(self.reader)
+            tag = str(packet[:4], "ascii")
+            if tag in PUSHES:
+                self.stats.add_push(packet)
+            elif self.waiting and tag in self.waiting[0]:
+                future = self.waiting[1]
+                self.waiting = None
+                future.set_result(packet)
+            else:
+                self.stats.unexpected += 1
+
+    async def login(self):
+        """Launcher login, then the game connection: returns False if the server said no"""
+        args = self.args
+
+        # launcher connection just gets the token
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+        reply = await self.request(
+            "LAUP",
+            Packets.LAUP.pack(tail=EncodeString(self.username) + EncodeString(args.password)),
+            writer,
+            reader,
+        )
+        writer.close()
+        if reply[:4] != b"laOK":
+            self.stats.error("login denied")
+            return False
+        token = str(reply[8:], "ascii").rstrip("\0")
+
+        self.reader, self.writer = await asyncio.open_connection(args.host, args.port)
+        self.receiver = asyncio.create_task(self.receive())
+        reply = await self.request("DSIT", Packets.DSIT.pack(tail=EncodeString(token)))
+        if reply[:4] != b"dsIN":
+            self.stats.error("account still logged on")
+            return False
+        self.perm_id = Packets.dsIN.unpack(reply)[0]
+
+        # pick the first slot and give it a name
+        await self.request("DSNS", Packets.DSNS.pack(0))
+        reply = await self.request(
+            "DSNM", Packets.DSNM.pack(0, tail=EncodeString(self.username))
+        )
+        if DecodeString(reply[8:]) != self.username:
+            self.stats.error("name not accepted")
+            return False
+
+        return True
+
+    def build(self, opcode):
+        """Make a random request of one opcode"""
+        args = self.args
+        rng = self.random
+
+        if opcode == "DSPS":
+            # mostly wander around, sometimes walk into another region
+            if rng.random() < args.region_change:
+                self.region = rng.randrange(args.regions)
+            return Packets.DSPS.pack(
+                self.perm_id, 0, rng.randrange(0x1000), rng.randrange(0x1000), self.region
+            )
+        if opcode == "DSRI":
+            return Packets.DSRI.pack(self.perm_id, self.region)
+        if opcode == "DSRD":
+            return Packets.DSRD.pack(
+                self.perm_id,
+                b"GLRG",
+                self.region,
+                rng.randrange(6),
+                rng.randrange(args.glrg_size - args.read_size)
+                if not args.read_tables
+                else rng.randrange(args.read_tables) * args.read_size,
+                args.read_size,
+            )
+        if opcode == "DSWQ":
+            # object tables are mostly zeros with a few values set
+            data = bytearray(args.write_size)
+            for _ in range(args.write_size // 8):
+                data[rng.randrange(args.write_size)] = rng.randrange(256)
+            return Packets.DSWQ.pack(
+                self.perm_id,
+                b"GLRG",
+                self.region,
+                rng.randrange(6),
+                0,
+                rng.randrange(args.glrg_size - args.write_size),
+                args.write_size,
+                tail=bytes(data),
+            )
+        return Packets.DSSL.pack()
+
+    async def run(self, deadline):
+        try:
+            if not await self.login():
+                return
+
+            opcodes = tuple(self.args.mix)
+            weights = tuple(self.args.mix.values())
+            loop = asyncio.get_running_loop()
+            while loop.time() < deadline:
+                opcode = self.random.choices(opcodes, weights)[0]
+                await self.request(opcode, self.build(opcode))
+                if self.args.think:
+                    await asyncio.sleep(self.random.expovariate(1000 / self.args.think))
+
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.stats.error(type(e).__name__)
+        finally:
+            if self.receiver and not self.receiver.cancel():
+                # already ended with the connection, and why doesn't matter now
+                self.receiver.exception()
+            if self.writer:
+                self.writer.close()
+
+
+async def run(args, stats):
+    loop = asyncio.get_running_loop()
+    bots = [Bot(args, stats, number) for number in range(args.bots)]
+
+    start = loop.time()
+    deadline = start + args.ramp * args.bots + args.duration
+    tasks = []
+    for bot in bots:
+        tasks.append(asyncio.create_task(bot.run(deadline)))
+        if args.ramp:
+            await asyncio.sleep(args.ramp)
+    await asyncio.gather(*tasks)
+
+    return loop.time() - start
+
+
+def create_accounts(args):
+    """Add any bot logins missing from the server database"""
+    from DSOServer.Database import Sqlite3
+
+    with Sqlite3(args.database) as db:
+        with db.connection:
+            db.connection.executemany(
+                "INSERT OR IGNORE INTO login(username, password) VALUES(?, ?)",
+                ((f"{args.prefix}{number}", args.password) for number in range(args.bots)),
+            )
+
+
+def parse_mix(text):
+    """Read a packet mix like DSPS=4,DSRD=2 into opcode => weight"""
+    mix = {}
+    for item in text.split(","):
+        opcode, _, weight = item.partition("=")
+        opcode = opcode.strip().upper()
+        if opcode not in MIX:
+            raise ValueError(f"unknown opcode {opcode}, choose from {', '.join(MIX)}")
+        mix[opcode] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = ArgumentParser(description="Put a DSO server under load with simulated clients.")
+    parser.add_argument("-a", "--host", default="127.0.0.1", help="server address (default: %(default)s)")
+    parser.add_argument("-p", "--port", type=int, default=14902, help="server port (default: %(default)s)")
+    parser.add_argument("-b", "--bots", type=int, default=100, help="number of bots (default: %(default)s)")
+    parser.add_argument(
+        "-t", "--duration", type=float, default=30, help="seconds to run after all bots have started (default: %(default)s)"
+    )
+    parser.add_argument(
+        "-r", "--ramp", type=float, default=0.01, help="seconds between starting each bot (default: %(default)s)"
+    )
+    parser.add_argument(
+        "-k", "--think", type=float, default=50, help="mean milliseconds a bot waits between requests, 0 for none (default: %(default)s)"
+    )
+    parser.add_argument(
+        "-m",
+        "--mix",
+        type=parse_mix,
+        default="DSPS=4,DSRI=1,DSRD=3,DSWQ=1,DSSL=1",
+        help="relative weights of the looped requests (default: %(default)s)",
+    )
+    parser.add_argument("--regions", type=int, default=16, help="number of regions bots roam (default: %(default)s)")
+    parser.add_argument(
+        "--region-change", type=float, default=0.05, help="chance a DSPS moves to another region (default: %(default)s)"
+    )
+    parser.add_argument("--glrg-size", type=int, default=0x4000, help="bytes of each GLRG block used (default: %(default)s)")
+    parser.add_argument("--read-size", type=int, default=256, help="bytes per DSRD (default: %(default)s)")
+    parser.add_argument(
+        "--read-tables",
+        type=int,
+        default=0,
+        help="read only this many fixed, read-size tables at the start of each block, as clients do, instead of anywhere (default: anywhere)",
+    )
+    parser.add_argument("--write-size", type=int, default=64, help="bytes per DSWQ (default: %(default)s)")
+    parser.add_argument("--prefix", default="bot", help="bot username prefix (default: %(default)s)")
+    parser.add_argument("--password", default="bot", help="bot password (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: %(default)s)")
+    parser.add_argument(
+        "-d", "--database", type=Path, help="create the bot accounts in this server database before starting"
+    )
+    args = parser.parse_args()
+
+    if args.database:
+        create_accounts(args)
+
+    stats = Stats()
+    try:
+        elapsed = asyncio.run(run(args, stats))
+    except KeyboardInterrupt:
+        return
+
+    print(f"{args.bots} bots for {elapsed:.1f} seconds")
+    for line in stats.report(elapsed):
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/bin/env python3
+
+"""
+replay.py - Feed a packet capture back through a fresh server State
+Greg Kennedy, 2025
+
+Reads capture files written by `server.py --capture`, and hands every packet the clients sent to
+Connection.handle again, in the original order, against a new State in an in-memory database.
+By default packets are replayed as fast as possible and the throughput is reported; with --realtime
+the original pacing is kept.
+
+Logins are recreated from the LAUP / dsIN packets in the capture, so the same account ids are used.
+Every reply is compared with the one the server originally sent, apart from the parts that depend on
+the time or process, so a capture of a real session doubles as a regression check.  Position updates
+go out on ticks of the capture's clock, but which moves land in which dsPS batch depends on timing, so
+those aren't compared.
+
+Pass the files oldest first, e.g.: python3 -m tools.replay capture.bin.2 capture.bin.1 capture.bin
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+import sqlite3
+from argparse import ArgumentParser
+from collections import deque
+from contextlib import closing
+from pathlib import Path
+from sys import exit
+from time import perf_counter, sleep
+
+from DSOServer import Capture
+from DSOServer.Compression import CompressionPolicy, DecodeString
+from DSOServer.Database import Sqlite3
+from DSOServer.Server import Connection, Server, send_positions
+from DSOServer.State import State
+
+# replies whose contents depend on the time or the process, not the world
+VOLATILE = {b"laOK", b"dsSL", b"dsDT"}
+# batched position updates, not compared at all
+POSITIONS = b"dsPS"
+
+
+class NullSocket:
+    """Takes everything sent to it"""
+
+    __slots__ = ()
+
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+
+    def send(self, data):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class ReplayConnection(Connection):
+    """A Connection that remembers what it sent"""
+
+    __slots__ = "sent"
+
+    def __init__(self, policy, pending):
+        super().__init__(NullSocket(), policy, pending)
+        self.sent = []
+
+    def queue(self, data, header, payload):
+        self.sent.append(bytes(data))
+        return super().queue(data, header, payload)
+
+
+class ReplayState(State):
+    """A State that also accepts the login tokens issued in the capture"""
+
+    __slots__ = "captured"
+
+    def __init__(self, database, captured):
+        super().__init__(database)
+        # captured token => account id
+        self.captured = captured
+
+    def return_login_token(self, token):
+        return self.captured.pop(token, None) or super().return_login_token(token)
+
+
+def find_logins(records):
+    """
+    Work out the accounts used in a capture.
+
+    Returns {account id: (username, password)} and {login token: account id}
+    """
+    # LAUP waiting on its reply, and DSIT waiting on its reply: connection id => details
+    launching = {}
+    joining = {}
+    # login token => (username, password)
+    issued = {}
+
+    accounts = {}
+    tokens = {}
+    for _, id, direction, data, _ in records:
+        tag = data[:4]
+        if direction == Capture.IN:
+            if tag == b"LAUP":
+                user_len = 8 + int.from_bytes(data[4:8], "little")
+                launching[id] = (DecodeString(data[4:user_len]), DecodeString(data[user_len:]))
+            elif tag == b"DSIT":
+                joining[id] = DecodeString(data[4:])
+
+        elif direction == Capture.OUT:
+            if tag == b"laOK" and id in launching:
+                issued[str(data[8:], "ascii").rstrip("\0")] = launching.pop(id)
+            elif tag == b"dsIN" and id in joining:
+                token = joining.pop(id)
+                if token in issued:
+                    account = int.from_bytes(data[4:8], "little")
+                    accounts[account] = issued[token]
+                    tokens[token] = account
+
+    return accounts, tokens
+
+
+def comparable(data):
+    """The part of a reply that should be the same on every run"""
+    if data[:4] in VOLATILE:
+        return data[:4]
+    if data[:4] == b"dsIN":
+        # ends with the server's process id
+        return data[:-4]
+    return data
+
+
+def replay(records, db, realtime=False, speed=1.0):
+    """
+    Replay a list of capture records.
+
+    Returns the number of packets handled, the seconds taken, the number of replies that differ
+    from the capture, and {opcode: [count, seconds]} of time spent in Connection.handle.
+    """
+    accounts, tokens = find_logins(records)
+    with db.connection:
+        db.connection.executemany(
+            "INSERT OR IGNORE INTO login(id, username, password) VALUES(?, ?, ?)",
+            ((id, username, password) for id, (username, password) in accounts.items()),
+        )
+
+    # what the server sent each connection: connection id => deque of packets
+    expected = {}
+    for _, id, direction, data, _ in records:
+        if direction == Capture.OUT and data[:4] != POSITIONS:
+            expected.setdefault(id, deque()).append(comparable(data))
+
+    state = ReplayState(db, tokens)
+    policy = CompressionPolicy()
+    pending = set()
+    connections = {}
+    mismatches = 0
+    opcodes = {}
+
+    handled = 0
+    first = records[0][0] if records else 0
+    next_tick = first + Server.tick_interval
+    start = perf_counter()
+    for timestamp, id, direction, data, _ in records:
+        if direction == Capture.OUT:
+            continue
+
+        if timestamp >= next_tick:
+            send_positions(state)
+            next_tick = timestamp + Server.tick_interval
+
+        if realtime:
+            delay = (timestamp - first) / speed - (perf_counter() - start)
+            if delay > 0:
+                sleep(delay)
+
+        try:
+            c = connections[id]
+        except KeyError:
+            c = connections[id] = ReplayConnection(policy, pending)
+
+        if direction == Capture.CLOSED:
+            c.close(state)
+            del connections[id]
+        else:
+            before = perf_counter()
+            ok = c.handle(data, state)
+            totals = opcodes.setdefault(str(data[:4], "ascii"), [0, 0.0])
+            totals[0] += 1
+            totals[1] += perf_counter() - before
+            handled += 1
+            if not ok:
+                # the server would have dropped them here too
+                c.close(state)
+                del connections[id]
+
+        for reply in c.sent:
+            if reply[:4] == POSITIONS:
+                continue
+            replies = expected.get(id)
+            if not replies or replies.popleft() != comparable(reply):
+                mismatches += 1
+        c.sent.clear()
+
+        for pending_c in pending:
+            pending_c.flush()
+        pending.clear()
+
+    elapsed = perf_counter() - start
+
+    # anything the server sent that the replay didn't
+    mismatches += sum(len(replies) for replies in expected.values())
+
+    for c in connections.values():
+        c.close(state)
+    state.close()
+
+    return handled, elapsed, mismatches, opcodes
+
+
+def main():
+    parser = ArgumentParser(description="Replay packet captures into a fresh server State.")
+    parser.add_argument("files", type=Path, nargs="+", help="capture files, oldest first")
+    parser.add_argument("-r", "--realtime", action="store_true", help="keep the original pacing")
+    parser.add_argument(
+        "-s",
+        "--speed",
+        type=float,
+        default=1.0,
+        help="speed-up of --realtime pacing (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-d",
+        "--database",
+        type=Path,
+        help="start from a copy of this database instead of an empty world",
+    )
+    args = parser.parse_args()
+
+    records = [record for path in args.files for record in Capture.read(path)]
+
+    with Sqlite3(":memory:") as db:
+        if args.database:
+            with closing(sqlite3.connect(args.database)) as source:
+                source.backup(db.connection)
+        handled, elapsed, mismatches, opcodes = replay(
+            records, db, args.realtime, args.speed
+        )
+
+    print(f"{handled} packets in {elapsed:.3f} seconds ({handled / elapsed:.0f} packets/sec)")
+    print(f"{'opcode':<6} {'count':>8} {'us each':>9}")
+    for opcode, (count, seconds) in sorted(opcodes.items()):
+        print(f"{opcode:<6} {count:>8} {seconds / count * 1e6:>9.1f}")
+
+    if mismatches:
+        print(f"{mismatches} replies differ from the capture")
+        exit(1)
+    print("All replies match the capture")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/bin/env python3
+
+"""
+snapshot.py - Copy a world between a sqlite3 server database and a snapshot file
+Greg Kennedy, 2025
+
+A snapshot is the whole world in one file: logins, then an index of every GLOB, GLRG and player
+page, then the pages.  It's always written whole and renamed into place, so it makes a quick,
+consistent backup of a database, and can be opened without reading more than its directory.
+
+  python3 -m tools.snapshot export server.db world.snap   (database to snapshot)
+  python3 -m tools.snapshot import world.snap server.db   (snapshot to database, replacing everything in it)
+  python3 -m tools.snapshot info world.snap
+
+Stop the server before importing into its database.
+
+This software is released under the GNU AGPL 3.0.  See file LICENSE for more information.
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from DSOServer.Database import Sqlite3
+from DSOServer.Snapshot import GLOB, GLRG, PLAYER, Snapshot, export, restore
+
+
+def main():
+    parser = ArgumentParser(description="Copy a world between a sqlite3 server database and a snapshot file.")
+    parser.add_argument("action", choices=["export", "import", "info"])
+    parser.add_argument("source", type=Path, help="database to export, or snapshot to import or describe")
+    parser.add_argument("target", type=Path, nargs="?", help="snapshot to write, or database to replace")
+    args = parser.parse_args()
+
+    start = perf_counter()
+    if args.action == "info":
+        snapshot = Snapshot(args.source)
+        print(f"{len(snapshot.logins)} logins")
+        for scope, name in (GLOB, "GLOB"), (GLRG, "GLRG regions"), (PLAYER, "players"):
+            counts = [count for (kind, _), (_, count) in snapshot.owners.items() if kind == scope]
+            print(f"{name}: {len(counts)} ({sum(counts)} pages)" if scope != GLOB else f"{name}: {sum(counts)} pages")
+        return
+
+    if args.target is None:
+        parser.error(f"{args.action} needs a target")
+    if args.action == "export":
+        with Sqlite3(args.source) as db:
+            export(db, args.target)
+    else:
+        with Sqlite3(args.target) as db:
+            restore(args.source, db)
+    print(f"Done in {perf_counter() - start:.2f} s")
+
+
+if __name__ == "__main__":
+    main()